@@ -0,0 +1,9 @@
+"""
+.. module:: benchmarks
+   :synopsis: Scripts measuring the performance of the weatheremail
+        application. Run them from the project root, e.g.:
+            $ python -m benchmarks.render
+            $ python -m benchmarks.throughput
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
@@ -0,0 +1,59 @@
+"""
+.. module:: render
+   :synopsis: Micro-benchmark comparing the per message cost of rendering the
+        weather email template for every recipient with rendering it once
+        per city through WeatherEmailRenderer.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+Example:
+    $ python -m benchmarks.render --messages 100000 --cities 100
+
+"""
+
+import argparse
+import timeit
+
+from flask import render_template
+
+from weatheremail2 import create_app
+from weatheremail2.emails import WeatherEmailRenderer
+
+
+def bench_render_template(messages, cities):
+    """Renders the template once per message, as before."""
+    for i in range(messages):
+        render_template('email/weather_update.html',
+                        username='user{i}'.format(i=i), conditions='cloudy',
+                        city='City {c}'.format(c=i % cities), state='MA',
+                        temp=51.2)
+
+
+def bench_renderer(messages, cities):
+    """Renders the template once per city and substitutes usernames."""
+    renderer = WeatherEmailRenderer()
+    for i in range(messages):
+        renderer.render('user{i}'.format(i=i), 'cloudy',
+                        'City {c}'.format(c=i % cities), 'MA', 51.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--cities', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    app = create_app(env='test')
+    with app.app_context():
+        for bench in (bench_render_template, bench_renderer):
+            best = min(timeit.repeat(
+                lambda: bench(args.messages, args.cities),
+                number=1, repeat=args.repeat))
+            print('{name}: {per_msg:.2f} us/message ({total:.3f}s for '
+                  '{messages} messages, {cities} cities)'.format(
+                      name=bench.__name__,
+                      per_msg=best / args.messages * 1e6, total=best,
+                      messages=args.messages, cities=args.cities))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+.. module:: signup_load
+   :synopsis: Load test posting concurrent signups, including racing
+        duplicates, to the signup route and reporting their latency and
+        outcome.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+Example:
+    $ python -m benchmarks.signup_load --threads 16 --signups 4000
+    $ python -m benchmarks.signup_load --output after.json --compare before.json
+    $ python -m benchmarks.signup_load --ingest buffered
+
+Notes:
+    Requests go through the WSGI app in process from --threads threads, so
+        the measured latency is the app's and the database's, not a
+        network's. Every --race-every'th email is posted by two threads at
+        once, and some emails of existing subscribers are posted again.
+    Without --database the test runs against a temporary SQLite file. A
+        --database URI has its tables dropped and recreated, so only point
+        it at a scratch database.
+    With --ingest buffered signups go through the signup buffer, journaled
+        in the temporary directory, and the flush batch sizes and latencies
+        are reported along with the request latencies.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+from benchmarks.throughput import (CONFIG_ENVAR, STATES, git_commit,
+                                   insert_persons, percentile, write_config)
+from weatheremail2 import create_app, db, signup_buffer
+from weatheremail2.loaders import load_cities
+from weatheremail2.models import City, Person
+
+
+def build_requests(signups, subscribers, race_every, rng):
+    """Returns the emails to post, in pairs of racing duplicates every
+    race_every emails and with existing subscribers mixed in."""
+    emails = []
+    for i in range(signups):
+        if race_every and i % race_every == 0:
+            emails.append(('race{i}@example.com'.format(i=i),) * 2)
+        elif subscribers and i % 10 == 5:
+            emails.append(('subscriber{i}@example.com'.format(
+                i=rng.randrange(subscribers)),))
+        else:
+            emails.append(('load{i}@example.com'.format(i=i),))
+    return emails
+
+
+def run(options):
+    """Builds the dataset and posts the signups, returning the results."""
+    workdir = tempfile.mkdtemp(prefix='weatheremail2-signup-load-')
+    try:
+        database = options['database'] or 'sqlite:///' + os.path.join(
+            workdir, 'signup_load.db')
+        write_config(workdir, database, 0, 'suppress')
+        app = create_app(config_envar=CONFIG_ENVAR, env='default')
+        if options['ingest'] == 'buffered':
+            app.config.update(SIGNUP_INGEST_MODE='buffered',
+                              SIGNUP_JOURNAL_DIR=os.path.join(workdir,
+                                                              'journal'))
+            signup_buffer.init_app(app)
+        rng = random.Random(options['seed'])
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            load_cities(['City {i}'.format(i=i), STATES[i % len(STATES)]]
+                        for i in range(100))
+            city_ids = [row[0] for row in db.session.query(City.id)]
+            insert_persons(options['subscribers'], city_ids, rng)
+            db.session.remove()
+        posts = build_requests(options['signups'], options['subscribers'],
+                               options['race_every'], rng)
+        results = _post_all(app, posts, city_ids, options['threads'])
+        signup_buffer.close()
+        with app.app_context():
+            persons = db.session.query(Person).count()
+            db.session.remove()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    latencies = [latency for latency, _ in results['timings']]
+    statuses = {}
+    for _, status in results['timings']:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {'commit': git_commit(),
+            'database': options['database'] or 'sqlite',
+            'ingest': options['ingest'],
+            'threads': options['threads'],
+            'requests': len(latencies),
+            'seconds': round(results['seconds'], 3),
+            'signups_per_second': round(len(latencies) / results['seconds'],
+                                        1),
+            'p50_ms': percentile(latencies, 0.50),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': percentile(latencies, 1.0),
+            'statuses': statuses,
+            'persons_added': persons - options['subscribers'],
+            'flushes': signup_buffer.stats()}
+
+
+def _post_all(app, posts, city_ids, threads):
+    """Posts every signup from a pool of threads, racing duplicate pairs
+    against each other."""
+    def post(email, city_id, barrier=None):
+        client = app.test_client()
+        if barrier is not None:
+            barrier.wait()
+        started = time.perf_counter()
+        response = client.post('/', data={'email': email,
+                                           'location': city_id})
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = []
+        for i, emails in enumerate(posts):
+            city_id = city_ids[i % len(city_ids)]
+            barrier = Barrier(len(emails)) if len(emails) > 1 else None
+            futures.extend(executor.submit(post, email, city_id, barrier)
+                           for email in emails)
+        timings = [future.result() for future in futures]
+    return {'timings': timings, 'seconds': time.time() - started}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Posts concurrent signups to the signup route.')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--signups', type=int, default=2000)
+    parser.add_argument('--subscribers', type=int, default=10000,
+                        help='existing subscribers in the dataset')
+    parser.add_argument('--race-every', type=int, default=10,
+                        help='post every Nth email twice at once')
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--ingest', choices=('direct', 'buffered'),
+                        default='direct')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='signup_load_results.json')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    if args.threads < 2 and args.race_every:
+        parser.error('racing duplicates need at least 2 threads')
+    result = run(vars(args))
+    print('{requests} signups from {threads} threads: {signups_per_second}/s,'
+          ' p50 {p50_ms}ms p99 {p99_ms}ms max {max_ms}ms, statuses '
+          '{statuses}, {persons_added} persons added'.format(**result))
+    with open(args.output, 'w') as output_file:
+        json.dump(result, output_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        for key in ('signups_per_second', 'p50_ms', 'p99_ms'):
+            if baseline.get(key):
+                print('  {key:<20} {old:>10} -> {new:>10} ({change:+.1f}%)'.
+                      format(key=key, old=baseline[key], new=result[key],
+                             change=(result[key] / baseline[key] - 1) * 100))
+        print('  statuses {old} -> {new}'.format(old=baseline['statuses'],
+                                                 new=result['statuses']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+.. module:: stubs
+   :synopsis: Local stand-ins for the Wunderground API and an SMTP server so
+        benchmarks run without network access or real credentials. They
+        are run by the benchmark's parent process so they do not compete
+        with the measured code for the GIL.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import asyncore
+import json
+import smtpd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+FORECAST_BODY = b'{ "current_observation": { "temp_f": 51.2, "icon": "cloudy" } }'
+
+
+class _ForecastHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests += 1
+        body = FORECAST_BODY
+        if self.path.startswith('/batch'):
+            locations = parse_qs(urlparse(self.path).query)['q'][0]
+            body = json.dumps({'forecasts': [
+                dict(zip(('state', 'city'), location.split('/', 1)),
+                     temperature=51.2, conditions='cloudy')
+                for location in locations.split(';')]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubWeatherAPI(ThreadingHTTPServer):
+    """Answers every forecast request with the same cloudy forecast.
+
+    Attributes:
+        uri (str): value for Forecast.API_URI pointing at this server.
+        batch_uri (str): value for WEATHER_PROVIDER_URI of the json provider
+            pointing at this server.
+        requests (int): number of requests served.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), _ForecastHandler)
+        self.requests = 0
+        self.uri = 'http://127.0.0.1:{port}/api/{{api_key}}/{{feature_path}}' \
+                   '/q/{{state}}/{{city}}.{{response_format}}'.format(
+                       port=self.server_address[1])
+        self.batch_uri = 'http://127.0.0.1:{port}/batch?key={{api_key}}&' \
+                         'q={{locations}}'.format(port=self.server_address[1])
+        self._thread = Thread(target=self.serve_forever,
+                              kwargs={'poll_interval': 0.05}, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class StubSMTPServer(smtpd.SMTPServer):
+    """Accepts and counts messages without storing them.
+
+    Attributes:
+        port (int): port the server listens on.
+        messages (int): number of messages received.
+    """
+
+    def __init__(self):
+        self._map = {}
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None, map=self._map)
+        self.port = self.socket.getsockname()[1]
+        self.messages = 0
+        self._thread = Thread(target=asyncore.loop,
+                              kwargs={'timeout': 0.05, 'map': self._map},
+                              daemon=True)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        for channel in list(self._map.values()):
+            channel.close()
+        self._thread.join()
@@ -0,0 +1,297 @@
+"""
+.. module:: throughput
+   :synopsis: Benchmark of signup latency and mailing throughput against
+        synthetic subscriber datasets, with the weather API and SMTP server
+        stubbed locally. Results are written to a JSON file so runs on
+        different commits can be compared.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+Example:
+    $ python -m benchmarks.throughput --sizes 1000,100000,1000000
+    $ python -m benchmarks.throughput --compare benchmark_results.json
+    $ python -m benchmarks.throughput --provider json
+
+Notes:
+    Each dataset size runs in a freshly spawned process so its peak RSS is
+        not inflated by the previous one, while the stubs run in the parent.
+    Without --database every size gets its own SQLite file in a temporary
+        directory. A --database URI (e.g. a local Postgres database) has
+        its tables dropped and recreated for every size, so only point it
+        at a scratch database.
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.stubs import StubSMTPServer, StubWeatherAPI
+from weatheremail2 import create_app, db
+from weatheremail2.async_mailing import run_async_weather_emails
+from weatheremail2.loaders import load_cities
+from weatheremail2.mailing import run_weather_emails
+from weatheremail2.models import City, Person
+from weatheremail2.wunderground import Forecast
+
+CONFIG_ENVAR = 'WEATHEREMAIL2_BENCHMARK_CONFIG'
+STATES = ('MA', 'TX', 'NY', 'CA', 'WA', 'IL', 'FL', 'CO', 'GA', 'OR')
+PERSON_INSERT_BATCH = 10000
+
+
+def run_size(subscribers, options, api_uri, smtp_port, batch_uri=None):
+    """Builds a dataset of the given size and measures it, in a child.
+
+    Args:
+        subscribers (int): number of Person rows to generate.
+        options (dict): parsed command line arguments.
+        api_uri (str): Forecast.API_URI of the stub weather API.
+        smtp_port (int): port of the stub SMTP server.
+        batch_uri (str): WEATHER_PROVIDER_URI of the stub weather API for
+            the json provider.
+            Defaults to None.
+
+    Returns:
+        dict of the measurements
+    """
+    workdir = tempfile.mkdtemp(prefix='weatheremail2-bench-')
+    try:
+        database = options['database'] or 'sqlite:///' + os.path.join(
+            workdir, 'benchmark.db')
+        write_config(workdir, database, smtp_port, options['smtp'],
+                     WEATHER_PROVIDER=options['provider'],
+                     WEATHER_PROVIDER_URI=batch_uri,
+                     EMAIL_RECIPIENTS_PER_MESSAGE=options[
+                         'recipients_per_message'])
+        app = create_app(config_envar=CONFIG_ENVAR, env='default')
+        Forecast.API_URI = api_uri
+        rng = random.Random(options['seed'])
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            started = time.time()
+            city_count = max(10, min(1000, subscribers // 1000))
+            load_cities(['City {i}'.format(i=i), STATES[i % len(STATES)]]
+                        for i in range(city_count))
+            city_ids = [row[0] for row in db.session.query(City.id)]
+            insert_persons(subscribers, city_ids, rng)
+            setup_seconds = time.time() - started
+
+            latencies = _measure_signups(app, options['signups'], city_ids,
+                                         rng)
+
+            runner = run_async_weather_emails \
+                if options['engine'] == 'asyncio' else run_weather_emails
+            started = time.time()
+            summary = runner(run_id='benchmark')
+            mailing_seconds = time.time() - started
+            db.session.remove()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'subscribers': subscribers,
+            'cities': city_count,
+            'setup_seconds': round(setup_seconds, 3),
+            'emails': summary['sent'],
+            'emails_failed': summary['failed'],
+            'messages': summary['messages'],
+            'mailing_seconds': round(mailing_seconds, 3),
+            'emails_per_second': round(summary['sent'] / mailing_seconds, 1)
+                                 if mailing_seconds else None,
+            'signups': len(latencies),
+            'signup_p50_ms': percentile(latencies, 0.50),
+            'signup_p99_ms': percentile(latencies, 0.99),
+            'peak_rss_mb': _peak_rss_mb(),
+            'timings': summary.get('timings', {})}
+
+
+def write_config(workdir, database, smtp_port, smtp_mode, **extra):
+    """Writes the settings file create_app() loads from CONFIG_ENVAR, with
+    any extra settings given as keyword arguments.
+
+    Every file the app writes is kept under workdir, so nothing is left
+    behind in the current directory."""
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': database,
+        'SECRET_KEY': 'benchmark',
+        'API_KEY_WUNDERGROUND': 'benchmark',
+        'MAIL_USERNAME': 'weather@example.com',
+        'MAIL_PASSWORD': '',
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': smtp_port,
+        'MAIL_USE_TLS': False,
+        'MAIL_SUPPRESS_SEND': smtp_mode == 'suppress',
+        'WTF_CSRF_ENABLED': False,
+        'RECAPTCHA_ENABLED': False,
+        'FORECAST_CACHE_BACKEND': 'memory',
+        'FORECAST_SINGLE_FLIGHT': 'file',
+        'FORECAST_LOCK_DIR': os.path.join(workdir, 'forecast_locks'),
+        'WEATHER_API_RATE_STATE_PATH': os.path.join(workdir,
+                                                    'weather_api_rate.json'),
+        'OUTBOX_DIR': os.path.join(workdir, 'outbox'),
+        'SIGNUP_JOURNAL_DIR': os.path.join(workdir, 'signup_journal'),
+        'METRICS_RUN_DIR': None,
+    }
+    settings.update(extra)
+    path = os.path.join(workdir, 'benchmark_config.py')
+    with open(path, 'w') as config_file:
+        for key, value in settings.items():
+            config_file.write('{key} = {value!r}\n'.format(key=key,
+                                                           value=value))
+    os.environ[CONFIG_ENVAR] = path
+
+
+def insert_persons(subscribers, city_ids, rng):
+    """Bulk inserts subscribers spread randomly over the cities."""
+    for start in range(0, subscribers, PERSON_INSERT_BATCH):
+        rows = [{'email': 'subscriber{i}@example.com'.format(i=i),
+                 'city_id': rng.choice(city_ids)}
+                for i in range(start, min(start + PERSON_INSERT_BATCH,
+                                          subscribers))]
+        db.session.execute(Person.__table__.insert(), rows)
+    db.session.commit()
+
+
+def _measure_signups(app, signups, city_ids, rng):
+    """Posts new signups to the signup route, returning their latencies in
+    milliseconds."""
+    client = app.test_client()
+    client.get('/')
+    latencies = []
+    for i in range(signups):
+        data = {'email': 'signup{i}@example.com'.format(i=i),
+                'location': rng.choice(city_ids)}
+        started = time.perf_counter()
+        response = client.post('/', data=data)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 303:
+            raise RuntimeError('Signup {i} failed with status {status}'.
+                               format(i=i, status=response.status_code))
+    return latencies
+
+
+def percentile(values, quantile):
+    """Returns the nearest rank quantile of a list of numbers, or None."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(quantile * len(ordered)))
+    return round(ordered[index], 3)
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+def git_commit():
+    """Returns the short hash of the checked out commit, or None."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, report):
+    """Prints the change in throughput and latency against a baseline."""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    before = {result['subscribers']: result
+              for result in baseline['results']}
+    print('Compared to {path} (commit {commit}):'.format(
+        path=baseline_path, commit=baseline.get('commit')))
+    for result in report['results']:
+        old = before.get(result['subscribers'])
+        if old is None:
+            continue
+        for key in ('emails_per_second', 'signup_p50_ms', 'signup_p99_ms',
+                    'peak_rss_mb'):
+            if old.get(key) and result.get(key) is not None:
+                print('  {size:>9} {key:<18} {old:>10} -> {new:>10} '
+                      '({change:+.1f}%)'.format(
+                          size=result['subscribers'], key=key, old=old[key],
+                          new=result[key],
+                          change=(result[key] / old[key] - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures signup latency and mailing throughput.')
+    parser.add_argument('--sizes', default='1000',
+                        help='comma separated subscriber counts, '
+                             'e.g. 1000,100000,1000000')
+    parser.add_argument('--database', default=None,
+                        help='SQLAlchemy URI of a scratch database; defaults '
+                             'to a temporary SQLite file')
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'),
+                        default='threaded')
+    parser.add_argument('--provider', choices=('wunderground', 'json'),
+                        default='wunderground',
+                        help='fetch one city per request or batches of '
+                             'cities from the stub weather API')
+    parser.add_argument('--smtp', choices=('local', 'suppress'),
+                        default='local',
+                        help='send to a local SMTP stub or only record '
+                             'messages')
+    parser.add_argument('--recipients-per-message', type=int, default=1,
+                        help='subscribers of a city sent one message at a '
+                             'time (EMAIL_RECIPIENTS_PER_MESSAGE)')
+    parser.add_argument('--signups', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    options = vars(args)
+    report = {'commit': git_commit(),
+              'started': datetime.utcnow().isoformat() + 'Z',
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'database': args.database or 'sqlite',
+              'engine': args.engine,
+              'provider': args.provider,
+              'smtp': args.smtp,
+              'recipients_per_message': args.recipients_per_message,
+              'seed': args.seed,
+              'results': []}
+    context = multiprocessing.get_context('spawn')
+    for size in (int(size) for size in args.sizes.split(',')):
+        api = StubWeatherAPI()
+        smtp = StubSMTPServer()
+        api.start()
+        smtp.start()
+        try:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_size,
+                                    (size, options, api.uri, smtp.port,
+                                     api.batch_uri))
+        finally:
+            smtp.stop()
+            api.stop()
+        result.update(smtp_received=smtp.messages,
+                      forecast_requests=api.requests)
+        report['results'].append(result)
+        print('{subscribers:>9} subscribers: {emails_per_second} emails/s, '
+              'signup p50 {signup_p50_ms}ms p99 {signup_p99_ms}ms, '
+              'peak RSS {peak_rss_mb}MB'.format(**result))
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+    print('Results written to {path}'.format(path=args.output))
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,47 @@ class DefaultConfig(object):
 	DEBUG = False
 	TESTING = False
 	API_KEY_WUNDERGROUND = ''
+	FORECAST_PREFETCH_CONCURRENCY = 10
+	WEATHER_PROVIDER = 'wunderground'
+	WEATHER_PROVIDER_URI = None
+	WEATHER_PROVIDER_BATCH_SIZE = 100
+	FORECAST_CACHE_BACKEND = 'sqlite'
+	FORECAST_CACHE_PATH = 'forecast_cache.db'
+	FORECAST_CACHE_REDIS_URL = 'redis://localhost:6379/0'
+	FORECAST_CACHE_TTL = 1200
+	FORECAST_CACHE_STALE_TTL = 3600
+	FORECAST_REFRESH_TIMEOUT = 30
+	FORECAST_SINGLE_FLIGHT = 'file'
+	FORECAST_LOCK_DIR = 'forecast_locks'
+	FORECAST_LOCK_STRIPES = 64
+	FORECAST_LAST_KNOWN_GOOD_TTL = 86400
+	FORECAST_CITY_RETRIES = 2
+	FORECAST_CITY_BACKOFF = 1.0
+	FORECAST_FALLBACK = 'last_known_good'
+	FORECAST_BREAKER_THRESHOLD = 5
+	FORECAST_BREAKER_COOLDOWN = 60
+	FORECAST_SOURCE = 'api'
+	FORECAST_SNAPSHOT_TTL = 1800
+	FORECAST_SNAPSHOT_BATCH_SIZE = 500
+	WEATHER_API_POOL_SIZE = 10
+	WEATHER_API_CONNECT_TIMEOUT = 3.05
+	WEATHER_API_READ_TIMEOUT = 10
+	WEATHER_API_MAX_RETRIES = 3
+	WEATHER_API_BACKOFF_FACTOR = 0.5
+	WEATHER_API_RETRY_BUDGET = 100
+	WEATHER_API_CALLS_PER_MINUTE = None
+	WEATHER_API_CALLS_PER_DAY = None
+	WEATHER_API_BURST = None
+	WEATHER_API_MAX_RATE_WAIT = 60
+	WEATHER_API_RATE_STATE_PATH = 'weather_api_rate.json'
 	SECRET_KEY = ''
 	WTF_CSRF_SECRET_KEY = ''
 	SQLALCHEMY_TRACK_MODIFICATIONS = False
 	SQLALCHEMY_ECHO = False
 	SQLALCHEMY_DATABASE_URI = 'postgresql://localhost:5432/weatheremail2_dev'
+	SUBSCRIBER_FETCH_SIZE = 1000
+	CITY_LOAD_BATCH_SIZE = 1000
+	CACHE_TYPE = 'simple'
 	MAIL_SERVER = 'smtp.gmail.com'
 	MAIL_PORT = 587
 	MAIL_USE_SSL = False
@@ -16,6 +52,39 @@ class DefaultConfig(object):
 	MAIL_PASSWORD = ''
 	MAIL_SUPPRESS_SEND = False
 	MAIL_ASCII_ATTACHMENTS = False
+	EMAIL_DISPATCH_WORKERS = 8
+	EMAIL_DISPATCH_QUEUE_SIZE = 1000
+	EMAIL_SEND_MODE = 'pooled'
+	EMAIL_BATCH_SIZE = 50
+	EMAIL_RECIPIENTS_PER_MESSAGE = 1
+	EMAIL_DELIVERY = 'direct'
+	OUTBOX_DIR = 'outbox'
+	OUTBOX_FSYNC = True
+	OUTBOX_CLAIM_TIMEOUT = 600
+	OUTBOX_MAX_ATTEMPTS = 5
+	OUTBOX_RETRY_BACKOFF = 60
+	OUTBOX_POLL_INTERVAL = 5
+	SEND_PROGRESS_INTERVAL = 10000
+	SEND_LEDGER_BATCH_SIZE = 1000
+	SCHEDULE_SEND_TIMES = ['07:00']
+	SCHEDULE_TIMEZONE = 'UTC'
+	SCHEDULE_PER_TIMEZONE = True
+	SCHEDULE_JITTER = 120
+	SCHEDULE_REFRESH_LEAD = 900
+	SCHEDULE_MISFIRE_GRACE = 3600
+	SCHEDULE_POLL_INTERVAL = 30
+	SCHEDULE_LOCK_FILE = 'scheduler.lock'
+	SCHEDULE_HISTORY = 100
+	ASYNC_FETCH_CONCURRENCY = 10
+	ASYNC_SEND_CONCURRENCY = 8
+	ASYNC_QUEUE_SIZE = 1000
+	METRICS_ENABLED = True
+	METRICS_RUN_DIR = 'run_metrics'
+	SIGNUP_INGEST_MODE = 'direct'
+	SIGNUP_FLUSH_INTERVAL_MS = 200
+	SIGNUP_FLUSH_ROWS = 500
+	SIGNUP_JOURNAL_DIR = 'signup_journal'
+	MAIL_MAX_EMAILS = None
 	RECAPTCHA_ENABLED = True
 	RECAPTCHA_SITE_KEY = ''
 	RECAPTCHA_SECRET_KEY = ''
@@ -30,11 +99,47 @@ class TestingConfig(DefaultConfig):
 	DEBUG = False
 	TESTING = True
 	API_KEY_WUNDERGROUND = ''
+	FORECAST_PREFETCH_CONCURRENCY = 10
+	WEATHER_PROVIDER = 'wunderground'
+	WEATHER_PROVIDER_URI = None
+	WEATHER_PROVIDER_BATCH_SIZE = 100
+	FORECAST_CACHE_BACKEND = 'memory'
+	FORECAST_CACHE_PATH = 'forecast_cache_test.db'
+	FORECAST_CACHE_REDIS_URL = 'redis://localhost:6379/15'
+	FORECAST_CACHE_TTL = 1200
+	FORECAST_CACHE_STALE_TTL = 3600
+	FORECAST_REFRESH_TIMEOUT = 30
+	FORECAST_SINGLE_FLIGHT = 'thread'
+	FORECAST_LOCK_DIR = None
+	FORECAST_LOCK_STRIPES = 64
+	FORECAST_LAST_KNOWN_GOOD_TTL = 86400
+	FORECAST_CITY_RETRIES = 1
+	FORECAST_CITY_BACKOFF = 0
+	FORECAST_FALLBACK = 'last_known_good'
+	FORECAST_BREAKER_THRESHOLD = 5
+	FORECAST_BREAKER_COOLDOWN = 60
+	FORECAST_SOURCE = 'api'
+	FORECAST_SNAPSHOT_TTL = 1800
+	FORECAST_SNAPSHOT_BATCH_SIZE = 500
+	WEATHER_API_POOL_SIZE = 10
+	WEATHER_API_CONNECT_TIMEOUT = 1
+	WEATHER_API_READ_TIMEOUT = 1
+	WEATHER_API_MAX_RETRIES = 3
+	WEATHER_API_BACKOFF_FACTOR = 0.01
+	WEATHER_API_RETRY_BUDGET = 5
+	WEATHER_API_CALLS_PER_MINUTE = None
+	WEATHER_API_CALLS_PER_DAY = None
+	WEATHER_API_BURST = None
+	WEATHER_API_MAX_RATE_WAIT = 60
+	WEATHER_API_RATE_STATE_PATH = None
 	SECRET_KEY = ''
 	WTF_CSRF_SECRET_KEY = ''
 	SQLALCHEMY_TRACK_MODIFICATIONS = False
 	SQLALCHEMY_ECHO = False
 	SQLALCHEMY_DATABASE_URI = 'postgresql://localhost:5432/weatheremail2_test'
+	SUBSCRIBER_FETCH_SIZE = 1000
+	CITY_LOAD_BATCH_SIZE = 1000
+	CACHE_TYPE = 'simple'
 	WTF_CSRF_ENABLED = False # Needs to be False for test cases to work
 	MAIL_SERVER = 'smtp.gmail.com'
 	MAIL_PORT = 587
@@ -44,6 +149,39 @@ class TestingConfig(DefaultConfig):
 	MAIL_PASSWORD = ''
 	MAIL_SUPPRESS_SEND = True
 	MAIL_ASCII_ATTACHMENTS = False
+	EMAIL_DISPATCH_WORKERS = 2
+	EMAIL_DISPATCH_QUEUE_SIZE = 10
+	EMAIL_SEND_MODE = 'pooled'
+	EMAIL_BATCH_SIZE = 5
+	EMAIL_RECIPIENTS_PER_MESSAGE = 1
+	EMAIL_DELIVERY = 'direct'
+	OUTBOX_DIR = None
+	OUTBOX_FSYNC = False
+	OUTBOX_CLAIM_TIMEOUT = 600
+	OUTBOX_MAX_ATTEMPTS = 2
+	OUTBOX_RETRY_BACKOFF = 0
+	OUTBOX_POLL_INTERVAL = 0.1
+	SEND_PROGRESS_INTERVAL = 1
+	SEND_LEDGER_BATCH_SIZE = 2
+	SCHEDULE_SEND_TIMES = ['07:00']
+	SCHEDULE_TIMEZONE = 'UTC'
+	SCHEDULE_PER_TIMEZONE = True
+	SCHEDULE_JITTER = 0
+	SCHEDULE_REFRESH_LEAD = 900
+	SCHEDULE_MISFIRE_GRACE = 3600
+	SCHEDULE_POLL_INTERVAL = 0.01
+	SCHEDULE_LOCK_FILE = None
+	SCHEDULE_HISTORY = 100
+	ASYNC_FETCH_CONCURRENCY = 2
+	ASYNC_SEND_CONCURRENCY = 2
+	ASYNC_QUEUE_SIZE = 2
+	METRICS_ENABLED = True
+	METRICS_RUN_DIR = None
+	SIGNUP_INGEST_MODE = 'direct'
+	SIGNUP_FLUSH_INTERVAL_MS = 200
+	SIGNUP_FLUSH_ROWS = 500
+	SIGNUP_JOURNAL_DIR = None
+	MAIL_MAX_EMAILS = None
 	RECAPTCHA_ENABLED = False
 	SESSION_COOKIE_SECURE = False
 	PROPAGATE_EXCEPTIONS = True
@@ -5,30 +5,183 @@
 
 """
 
+import asyncore
+import json
+import os
+import re
+import shutil
+import smtpd
+import tempfile
 import time
 import unittest
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Event, Thread
+from urllib.parse import parse_qs, urlparse
 
 import mock
+from flask import render_template
+from sqlalchemy.engine import ResultProxy
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Query
 
-from weatheremail2 import create_app, db, mail
-from weatheremail2.emails import send_weather_email, get_email_subject
-from weatheremail2.models import City, Person
-from weatheremail2.utils import get_username_from_email
+from weatheremail2 import (create_app, db, mail, cache, forecast_cache,
+                           http_client, metrics)
+from weatheremail2.app_error import AppError
+from weatheremail2.async_mailing import aiosmtplib, run_async_weather_emails
+from weatheremail2.breaker import CircuitBreaker, CircuitOpen
+from weatheremail2.dispatcher import EmailDispatcher
+from weatheremail2.emails import (WeatherEmailRenderer, send_weather_email,
+                                  build_weather_email, get_email_subject,
+                                  render_weather_email)
+from weatheremail2.forecast_cache import ForecastCache, RedisBackend
+from weatheremail2.forecasts import get_subscribed_cities, prefetch_forecasts
+from weatheremail2.ledger import SendLedgerWriter
+from weatheremail2.loaders import load_cities
+from weatheremail2.mailing import get_user_data, run_sharded, run_weather_emails
+from weatheremail2.models import City, ForecastSnapshot, Person, SendLedger
+from weatheremail2.outbox import Outbox, OutboxDeliverer
+from weatheremail2.providers import PROVIDERS, FakeProvider, WundergroundProvider
+from weatheremail2.ratelimit import QuotaExceeded, TokenBucket
+from weatheremail2.scheduler import ScheduledJob, Scheduler
+from weatheremail2.signups import insert_person, insert_persons, signup_buffer
+from weatheremail2.singleflight import FileSingleFlight
+from weatheremail2.snapshots import refresh_snapshots
+from weatheremail2.utils import get_city_data, get_username_from_email
+from weatheremail2.views import get_all_cities
 from weatheremail2.wunderground import Forecast
 
 
+class RefusingSMTPChannel(smtpd.SMTPChannel):
+    """SMTP channel refusing the RCPT TO of the server's 'refused'
+    addresses."""
+    def smtp_RCPT(self, arg):
+        if arg and any(address in arg for address in self.smtp_server.refused):
+            self.push('550 No such user here')
+            return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """Local stand-in for an SMTP server that records the messages it receives.
+
+        Note:
+            Answers with a 421 once a connection has carried
+            max_per_connection messages, the way providers enforce
+            message-per-connection limits, and refuses the recipients in
+            its 'refused' attribute.
+
+    """
+    channel_class = RefusingSMTPChannel
+
+    def __init__(self, max_per_connection=None):
+        self._map = {}
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None, map=self._map)
+        self.port = self.socket.getsockname()[1]
+        self.max_per_connection = max_per_connection
+        self.refused = set()
+        self.messages = []
+        self.per_connection = {}
+        self._thread = Thread(target=asyncore.loop,
+                              kwargs={'timeout': 0.05, 'map': self._map})
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        count = self.per_connection.get(peer, 0)
+        if self.max_per_connection and count >= self.max_per_connection:
+            return '421 Too many messages for this connection'
+        self.per_connection[peer] = count + 1
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        for channel in list(self._map.values()):
+            channel.close()
+        self._thread.join()
+
+
+class StubWeatherAPIHandler(BaseHTTPRequestHandler):
+    """Serves canned Wunderground responses, or JSON batch provider responses
+    under /batch, failing or stalling the first requests as told by the
+    server's 'failures' and 'delay' attributes, and answering for the cities
+    in its 'unknown' attribute with an error body."""
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            self.send_response(self.server.failure_status)
+            self.end_headers()
+            return
+        body = b'{ "current_observation": { "temp_f": 51.2, "icon": "cloudy" } }'
+        if any(self.path.endswith('/{city}.json'.format(city=city))
+               for city in self.server.unknown):
+            body = b'{ "response": { "error": { "type": "querynotfound" } } }'
+        if self.path.startswith('/batch'):
+            query = parse_qs(urlparse(self.path).query)['q'][0]
+            body = json.dumps({'forecasts': [
+                {'state': location.split('/')[0], 'city': location.split('/')[1],
+                 'temperature': 51.2, 'conditions': 'cloudy'}
+                for location in query.split(';')]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalWeatherAPI(HTTPServer):
+    """Local stand-in for the Wunderground API."""
+    def __init__(self, failures=0, delay=0, failure_status=503):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubWeatherAPIHandler)
+        self.failures = failures
+        self.failure_status = failure_status
+        self.delay = delay
+        self.unknown = set()
+        self.paths = []
+        self.uri = 'http://127.0.0.1:{port}/api/{{api_key}}/{{feature_path}}/q/' \
+                   '{{state}}/{{city}}.{{response_format}}'.format(
+                       port=self.server_address[1])
+        self.batch_uri = 'http://127.0.0.1:{port}/batch?key={{api_key}}&' \
+                         'q={{locations}}'.format(port=self.server_address[1])
+        self._thread = Thread(target=self.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class FakeRedis(object):
+    """Local stand-in for a Redis client."""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode('utf-8')
+
+
 class WeatherEmailTestCase(unittest.TestCase):
     """WeatherEmailTestCase tests the core functionality
     of the application.
 
 	    Note:
-	        Email tests in test_send_weather_email() contains a
-	        time.sleep() to account for the time it takes emails to
-	        be sent in the background and end up in the testing
-	        'outbox' so they can be evaluated.
-	        If the sleep weren't there, the test would run till finish
-	        while the emails were still processing and any assertions
-	        would fail.
+	        Email tests send through an EmailDispatcher and only make
+	        assertions once its 'with' block has exited, at which point
+	        every email sent in the background has ended up in the
+	        testing 'outbox'.
 
     """
     def setUp(self):
@@ -59,6 +212,57 @@ class WeatherEmailTestCase(unittest.TestCase):
         self.assertIn(b'Boston, MA', response.data)
         self.assertIn(b'Houston, TX', response.data)
 
+    def test_city_choices_cached_as_fragment(self):
+        """Test that the drop-down is cached as tuples and escaped option
+        markup until cities are loaded"""
+        with self.app.app_context():
+            cache.clear()
+            boston = City.query.filter_by(name='Boston').first()
+            choices = get_all_cities()
+            self.assertEqual((boston.id, 'Boston', 'MA'), choices.cities[0])
+            self.assertIn('<option value="{id}">Boston, MA</option>'.format(id=boston.id),
+                          choices.options_html)
+            self.client().get('/')
+            db.session.add(City(name='Winston <&> Salem', state='NC'))
+            db.session.commit()
+            with mock.patch('weatheremail2.views.db') as mock_db:
+                self.assertNotIn(b'Winston', self.client().get('/').data)
+            self.assertFalse(mock_db.session.query.called)
+            load_cities([['Boston', 'NH']])
+            response = self.client().get('/')
+            self.assertIn(b'Winston &lt;&amp;&gt; Salem, NC', response.data)
+            self.assertIn(b'Boston, NH', response.data)
+
+    def test_signup_page_cache_validators(self):
+        """Test that the cached signup page gets each session's CSRF token,
+        answers conditional GETs with a 304 and references fingerprinted
+        static files that may be cached for good"""
+        self.app.config.update(WTF_CSRF_ENABLED=True)
+        first, second = self.client(), self.client()
+        response = first.get('/')
+        other = second.get('/')
+        with first.session_transaction() as sess:
+            token = sess['csrf_token']
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(response.data, other.data)
+        self.assertIn(b'name="csrf_token" type="hidden" value="', response.data)
+        etag = response.headers['ETag']
+        self.assertNotEqual(etag, other.headers['ETag'])
+        self.assertIn('Cookie', response.headers['Vary'])
+        self.assertIsNotNone(response.headers['Last-Modified'])
+        revalidated = first.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(304, revalidated.status_code)
+        self.assertEqual(b'', revalidated.data)
+        with first.session_transaction() as sess:
+            self.assertEqual(token, sess['csrf_token'])
+        response = first.post('/', data={'email': ''}, follow_redirects=True)
+        self.assertIn(b'Please provide an email address', response.data)
+        css = re.search(rb'href="(/static/css/main.css\?v=\w+)"', response.data).group(1)
+        static = first.get(css.decode('utf-8'))
+        self.assertEqual(200, static.status_code)
+        self.assertIn('immutable', static.headers['Cache-Control'])
+        static.close()
+
     def test_valid_email_signup(self):
         """Test valid email and city signup"""
         test_email = 'hello111@domain.com'
@@ -79,6 +283,315 @@ class WeatherEmailTestCase(unittest.TestCase):
 
 
 
+    def test_concurrent_duplicate_signups(self):
+        """Test that racing signups with the same email add one person and
+        get the duplicate flash instead of an error"""
+        city = City.query.filter_by(name='Houston').first()
+        responses = []
+
+        def post_signup():
+            responses.append(self.client().post(
+                '/', data={'email': 'racer@domain.com', 'location': city.id}))
+
+        threads = [Thread(target=post_signup) for _ in range(4)]
+        for thr in threads:
+            thr.start()
+        for thr in threads:
+            thr.join()
+        self.assertEqual([200, 200, 200, 303],
+                         sorted(response.status_code for response in responses))
+        for response in responses:
+            if response.status_code == 200:
+                self.assertIn(b'We have your email', response.data)
+        with self.app.app_context():
+            self.assertEqual(1, Person.query.filter_by(email='racer@domain.com').count())
+            self.assertIsNone(insert_person('racer@domain.com', city.id))
+            self.assertRaises(IntegrityError, insert_person, None, city.id)
+
+    def test_signup_rejects_unknown_city(self):
+        """Test that a city id missing from the drop-down is refused"""
+        response = self.client().post('/', data={'email': 'hello111@domain.com',
+                                                 'location': 9999},
+                                      follow_redirects=True)
+        self.assertIn(b'Please select a city from the list', response.data)
+        self.assertIsNone(Person.query.filter_by(email='hello111@domain.com').first())
+
+    def test_buffered_signups_are_journaled_and_flushed(self):
+        """Test that buffered signups are journaled before the redirect and
+        inserted in one batch, with pending duplicates refused, and that a
+        failed last flush or journal cleanup is logged rather than raised"""
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.app.config.update(SIGNUP_INGEST_MODE='buffered',
+                               SIGNUP_FLUSH_INTERVAL_MS=60000,
+                               SIGNUP_JOURNAL_DIR=journal_dir)
+        signup_buffer.init_app(self.app)
+        self.addCleanup(signup_buffer.close)
+        city = City.query.filter_by(name='Houston').first()
+        for email in ('first@domain.com', 'second@domain.com',
+                      'someguy@whatevs.com'):
+            response = self.client().post('/', data={'email': email,
+                                                     'location': city.id})
+            self.assertEqual(303, response.status_code)
+        response = self.client().post('/', data={'email': 'first@domain.com',
+                                                 'location': city.id})
+        self.assertIn(b'We have your email', response.data)
+        self.assertIsNone(Person.query.filter_by(email='first@domain.com').first())
+        journaled = [line for name in os.listdir(journal_dir)
+                     for line in open(os.path.join(journal_dir, name))]
+        self.assertEqual(3, len(journaled))
+
+        signup_buffer.flush()
+        db.session.remove()
+        self.assertEqual([], os.listdir(journal_dir))
+        self.assertEqual(2, Person.query.filter_by(city_id=city.id).count())
+        stats = signup_buffer.stats()
+        self.assertEqual((1, 2, 1, 3), (stats['flushes'], stats['flushed'],
+                                        stats['duplicates'], stats['max_batch']))
+
+        with mock.patch('weatheremail2.signups.SignupBuffer._append_journal',
+                        side_effect=OSError('disk full')):
+            response = self.client().post('/', data={'email': 'third@domain.com',
+                                                     'location': city.id})
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'We could not save your signup', response.data)
+
+        signup_buffer.add('fourth@domain.com', city.id)
+        with mock.patch('weatheremail2.signups.insert_persons',
+                        side_effect=OperationalError('INSERT', {},
+                                                     Exception('locked'))):
+            signup_buffer.close()
+        self.assertEqual(1, signup_buffer.stats()['pending'])
+        with mock.patch('weatheremail2.signups.os.remove',
+                        side_effect=OSError('read-only file system')):
+            signup_buffer.flush()
+        db.session.remove()
+        self.assertIsNotNone(Person.query.filter_by(email='fourth@domain.com').first())
+        self.assertEqual(1, len(os.listdir(journal_dir)))
+
+    def test_buffered_signups_drop_rejected_rows(self):
+        """Test that a signup the database rejects is split out of its batch
+        and set aside while the rest of the batch is inserted"""
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.app.config.update(SIGNUP_INGEST_MODE='buffered',
+                               SIGNUP_FLUSH_INTERVAL_MS=60000,
+                               SIGNUP_JOURNAL_DIR=journal_dir)
+        signup_buffer.init_app(self.app)
+        self.addCleanup(signup_buffer.close)
+        city = City.query.filter_by(name='Houston').first()
+        for i in range(4):
+            signup_buffer.add('user{i}@domain.com'.format(i=i), city.id)
+        signup_buffer.add('poison@domain.com', 9999)
+
+        def insert_checking_city(rows):
+            if any(row['city_id'] == 9999 for row in rows):
+                raise IntegrityError('INSERT', rows, Exception('FOREIGN KEY'))
+            return insert_persons(rows)
+
+        with mock.patch('weatheremail2.signups.insert_persons',
+                        side_effect=insert_checking_city):
+            signup_buffer.flush()
+        db.session.remove()
+        self.assertEqual(4, Person.query.filter_by(city_id=city.id).count())
+        self.assertEqual(['rejected.jsonl'], os.listdir(journal_dir))
+        stats = signup_buffer.stats()
+        self.assertEqual((0, 4, 1, 0), (stats['pending'], stats['flushed'],
+                                        stats['rejected'], stats['duplicates']))
+
+    def test_signup_journals_replayed_on_start(self):
+        """Test that journals left behind are inserted at startup, skipping a
+        torn last line"""
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        city = City.query.filter_by(name='Boston').first()
+        with open(os.path.join(journal_dir, '1234-1.journal'), 'w') as journal:
+            journal.write('{{"email": "lost@domain.com", "city_id": {id}}}\n'
+                          '{{"email": "lost@domain.com", "city_id": {id}}}\n'
+                          '{{"email": "torn@dom'.format(id=city.id))
+        self.app.config.update(SIGNUP_INGEST_MODE='buffered',
+                               SIGNUP_JOURNAL_DIR=journal_dir)
+        signup_buffer.init_app(self.app)
+        self.addCleanup(signup_buffer.close)
+        db.session.remove()
+        self.assertEqual([], os.listdir(journal_dir))
+        self.assertEqual(1, Person.query.filter_by(email='lost@domain.com').count())
+        self.assertIsNone(Person.query.filter_by(email='torn@domain.com').first())
+
+    def test_get_user_data_streams_rows(self):
+        """Test that subscriber rows are streamed from a server side cursor
+        and fetched lazily, fetch_size rows at a time"""
+        queries, fetches = [], []
+        yield_per, fetchmany = Query.yield_per, ResultProxy.fetchmany
+
+        def recording_yield_per(query, count):
+            queries.append(yield_per(query, count))
+            return queries[-1]
+
+        def recording_fetchmany(result, size=None):
+            fetches.append(size)
+            return fetchmany(result, size)
+
+        with self.app.app_context():
+            houston = City.query.filter_by(name='Houston').first()
+            db.session.add(Person(email='hello111@domain.com', city_id=houston.id))
+            db.session.commit()
+            with mock.patch.object(Query, 'yield_per', recording_yield_per), \
+                    mock.patch.object(ResultProxy, 'fetchmany',
+                                      recording_fetchmany):
+                user_data = get_user_data(fetch_size=1)
+                rows = [next(user_data)]
+                self.assertEqual([1], fetches)
+                rows.extend(user_data)
+            self.assertEqual(1, len(queries))
+            self.assertTrue(queries[0]._execution_options['stream_results'])
+            self.assertEqual([1, 1, 1], fetches)
+        self.assertEqual([('hello111@domain.com', 'Houston', 'TX'),
+                          ('someguy@whatevs.com', 'Boston', 'MA')],
+                         sorted(row[1:] for row in rows))
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_shards_send_each_subscriber_once(self, mock_factory):
+        """Test that every subscriber is emailed by exactly one shard, whether
+        shards run in this process or in a pool of local processes"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        forecast = Forecast(api_key)
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+        with self.app.app_context():
+            houston = City.query.filter_by(name='Houston').first()
+            for i in range(4):
+                db.session.add(Person(email='user{i}@domain.com'.format(i=i),
+                                      city_id=houston.id))
+            db.session.commit()
+            recipients = []
+            with self.mail.record_messages() as outbox:
+                for shard_index in range(3):
+                    summary = run_weather_emails(shard_index, 3)
+                    self.assertEqual(summary['queued'], summary['sent'])
+                recipients = sorted(msg.recipients[0] for msg in outbox)
+            self.assertEqual(5, len(recipients))
+            self.assertEqual(5, len(set(recipients)))
+            summaries = run_sharded(2)
+        self.assertEqual(['0/2', '1/2'], [summary['shard'] for summary in summaries])
+        self.assertEqual(5, sum(summary['sent'] for summary in summaries))
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_resume_skips_delivered_subscribers(self, mock_factory):
+        """Test that resuming a run only emails subscribers the send ledger has
+        no delivery for, and records the new deliveries"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        forecast = Forecast(api_key)
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+        with self.app.app_context():
+            houston = City.query.filter_by(name='Houston').first()
+            for i in range(3):
+                db.session.add(Person(email='user{i}@domain.com'.format(i=i),
+                                      city_id=houston.id))
+            delivered = Person.query.filter_by(email='someguy@whatevs.com').first()
+            failed = Person.query.filter_by(email='user0@domain.com').first()
+            db.session.add(SendLedger(run_id='run-1', person_id=delivered.id,
+                                      status=SendLedger.DELIVERED))
+            db.session.add(SendLedger(run_id='run-1', person_id=failed.id,
+                                      status=SendLedger.FAILED))
+            db.session.add(SendLedger(run_id='run-0', person_id=failed.id,
+                                      status=SendLedger.DELIVERED))
+            db.session.commit()
+            with self.mail.record_messages() as outbox:
+                summary = run_weather_emails(run_id='run-1', resume=True)
+            self.assertEqual(3, summary['sent'])
+            self.assertNotIn(['someguy@whatevs.com'], [msg.recipients for msg in outbox])
+            self.assertEqual(4, SendLedger.query.filter_by(
+                run_id='run-1', status=SendLedger.DELIVERED).count())
+            with self.mail.record_messages() as outbox:
+                run_weather_emails(run_id='run-1', resume=True)
+            self.assertEqual(0, len(outbox))
+
+    def test_send_ledger_drops_rejected_rows_and_defers_failures(self):
+        """Test that send ledger rows the database rejects are split out of
+        their batch and dropped, and that other failures are retried with the
+        next batch and only logged by the final flush"""
+        with self.app.app_context():
+            person = Person.query.filter_by(email='someguy@whatevs.com').first()
+            with SendLedgerWriter('run-1', batch_size=3) as ledger:
+                ledger.record(person.id, SendLedger.DELIVERED)
+                ledger.record(None, SendLedger.DELIVERED)
+                ledger.record(person.id, SendLedger.SKIPPED)
+            self.assertEqual(1, ledger.rejected)
+            self.assertEqual(2, SendLedger.query.filter_by(run_id='run-1').count())
+
+            with mock.patch.object(type(db), 'engine', new_callable=mock.PropertyMock) \
+                    as mock_engine:
+                mock_engine.return_value.execute.side_effect = \
+                    OperationalError('INSERT', {}, Exception('database is locked'))
+                with SendLedgerWriter('run-2', batch_size=1) as ledger:
+                    ledger.record(person.id, SendLedger.DELIVERED)
+                    ledger.record(person.id, SendLedger.FAILED)
+                    self.assertEqual(2, len(ledger._rows))
+            self.assertEqual([], ledger._rows)
+            self.assertEqual(0, ledger.rejected)
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_run_metrics_summary_and_endpoint(self, mock_factory):
+        """Test that a run times each stage in its summary and that the saved
+        histograms are exposed by the /metrics route as per shard histograms,
+        dropping those of another shard layout, unless disabled"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        forecast = Forecast(api_key)
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+        run_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, run_dir)
+        self.app.config.update(METRICS_RUN_DIR=run_dir)
+        metrics.init_app(self.app)
+        with self.app.app_context():
+            summary = run_weather_emails(run_id='run-1')
+            timings = summary['timings']
+            self.assertEqual(['db_fetch', 'forecast_fetch_miss', 'render',
+                              'smtp_send'], sorted(timings))
+            self.assertEqual(1, timings['smtp_send']['count'])
+            self.assertTrue(os.path.exists(os.path.join(run_dir, 'shard_0_of_1.json')))
+            metrics.init_app(self.app)
+            response = self.client().get('/metrics')
+            self.assertEqual(200, response.status_code)
+            self.assertNotIn(b'weatheremail2_smtp_send_seconds_count', response.data)
+            self.assertIn(b'# TYPE weatheremail2_last_run_smtp_send_seconds histogram', response.data)
+            self.assertIn(b'weatheremail2_last_run_smtp_send_seconds_count{shard="0/1",run_id="run-1"} 1',
+                          response.data)
+            self.assertIn(b'weatheremail2_last_run_forecast_fetch_seconds_bucket'
+                          b'{shard="0/1",run_id="run-1",result="miss",le="+Inf"} 1',
+                          response.data)
+            run_weather_emails(shard_index=1, shard_count=2, run_id='run "2"\n')
+            self.assertEqual(['shard_1_of_2.json'], os.listdir(run_dir))
+            response = self.client().get('/metrics')
+            self.assertNotIn(b'run-1', response.data)
+            self.assertIn(b'shard="1/2",run_id="run \\"2\\"\\n"', response.data)
+            self.app.config.update(METRICS_ENABLED=False)
+            metrics.init_app(self.app)
+            self.assertEqual({}, run_weather_emails()['timings'])
+            self.assertEqual(404, self.client().get('/metrics').status_code)
+
+    def test_load_cities_upserts_without_losing_persons(self):
+        """Test that loading city data upserts by name in batches and keeps
+        existing subscribers"""
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as csv_file:
+            csv_file.write('Boston, MA\nHouston, FL\nHouston, TX\nAustin, TX\n'
+                           '\nDallas, TX\nSeattle, WA\n')
+        try:
+            with self.app.app_context():
+                boston_id = City.query.filter_by(name='Boston').first().id
+                loaded, _ = load_cities(get_city_data(path), batch_size=2)
+                cities = dict(db.session.query(City.name, City.state).all())
+                self.assertEqual(boston_id, City.query.filter_by(name='Boston').first().id)
+                self.assertEqual(1, Person.query.count())
+        finally:
+            os.remove(path)
+        self.assertEqual(6, loaded)
+        self.assertEqual({'Boston': 'MA', 'Houston': 'TX', 'Austin': 'TX',
+                          'Dallas': 'TX', 'Seattle': 'WA'}, cities)
+
     def test_get_username_from_email(self):
         """Test splitting off username out of email address to get a pseudo-username"""
         email_addr = 'john_whatevs@email.com'
@@ -94,7 +607,7 @@ class WeatherEmailTestCase(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
-    @mock.patch('weatheremail2.wunderground.requests.get')
+    @mock.patch('weatheremail2.webclient.requests.Session.get')
     def test_get_weather_from_api(self, mock_get):
         """Test getting back correct (temp, conditions) tuple from weather api
 		call and subsequent JSON parsing"""
@@ -111,6 +624,445 @@ class WeatherEmailTestCase(unittest.TestCase):
         self.assertEqual(expected_conditions, mock_forecast.conditions)
 
 
+    def test_forecast_retries_within_budget(self):
+        """Test that failed API requests are retried over pooled connections
+        until the per-run retry budget runs out, without counting the backoff
+        in the request latency"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        server = LocalWeatherAPI(failures=2)
+        server.start()
+        sleep = time.sleep
+        try:
+            with mock.patch.object(Forecast, 'API_URI', server.uri):
+                with mock.patch('weatheremail2.webclient.time.sleep',
+                                side_effect=lambda delay: sleep(0.2)):
+                    forecast = Forecast.forecast_factory(api_key, 'MA', 'Boston')
+                self.assertEqual('cloudy', forecast.conditions)
+                self.assertEqual(2, http_client.stats()['retries'])
+                self.assertLess(http_client.stats()['max_latency'], 0.2)
+                self.assertEqual(3, len(server.paths))
+                server.failures = 10
+                with self.assertRaises(AppError):
+                    Forecast.forecast_factory(api_key, 'TX', 'Houston')
+        finally:
+            server.stop()
+        self.assertEqual(0, http_client.stats()['retries_left'])
+        self.assertEqual(7, http_client.stats()['requests'])
+
+    def test_rate_limiter_token_bucket(self):
+        """Test that the token bucket spaces calls out past its burst, refuses
+        them once the day's quota is used and is shared through its state file"""
+        bucket = TokenBucket(per_minute=600, burst=2)
+        started = time.time()
+        for _ in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - started, 0.15)
+        self.assertEqual(2, bucket.stats()['waits'])
+        bucket = TokenBucket(per_minute=6, burst=1, max_wait=1)
+        bucket.acquire()
+        with self.assertRaises(QuotaExceeded):
+            bucket.acquire()
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        processes = [TokenBucket(per_day=3, state_path=path) for _ in range(2)]
+        for bucket in processes + processes[:1]:
+            bucket.acquire()
+        with self.assertRaises(QuotaExceeded):
+            processes[1].acquire()
+        self.assertEqual({'acquired': 1, 'waits': 0, 'wait_time': 0.0,
+                          'rejected': 1, 'used_today': 3}, processes[1].stats())
+
+    def test_quota_goes_to_cities_with_most_subscribers(self):
+        """Test that forecasts are fetched for the cities with the most
+        subscribers first and that cities beyond the quota are skipped
+        instead of failing the run"""
+        server = LocalWeatherAPI()
+        server.start()
+        self.app.config.update(WEATHER_API_CALLS_PER_DAY=1)
+        http_client.init_app(self.app)
+        try:
+            with mock.patch.object(Forecast, 'API_URI', server.uri), \
+                    self.app.app_context():
+                houston = City.query.filter_by(name='Houston').first()
+                for i in range(2):
+                    db.session.add(Person(email='user{i}@domain.com'.format(i=i),
+                                          city_id=houston.id))
+                db.session.commit()
+                self.assertEqual([('Houston', 'TX'), ('Boston', 'MA')],
+                                 get_subscribed_cities())
+                with self.mail.record_messages() as outbox:
+                    summary = run_weather_emails()
+        finally:
+            server.stop()
+        self.assertEqual((2, 1), (summary['sent'], summary['skipped']))
+        self.assertEqual(['/TX/Houston.json'],
+                         [path[path.rindex('/TX'):] for path in server.paths])
+        self.assertNotIn(['someguy@whatevs.com'], [msg.recipients for msg in outbox])
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_failing_city_only_skips_its_subscribers(self, mock_factory):
+        """Test that a city whose forecast keeps failing is retried and then
+        skipped, or served its last known good forecast, while the other
+        cities are emailed"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        forecast = Forecast(api_key)
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+
+        def factory(api_key, state, city):
+            if city == 'Boston':
+                raise AppError('Boston is down', ValueError(city))
+            return forecast
+
+        mock_factory.side_effect = factory
+        with self.app.app_context():
+            houston = City.query.filter_by(name='Houston').first()
+            db.session.add(Person(email='hello111@domain.com', city_id=houston.id))
+            db.session.commit()
+            with self.mail.record_messages() as outbox:
+                summary = run_weather_emails()
+            self.assertEqual((1, 1), (summary['sent'], summary['skipped']))
+            self.assertEqual([['hello111@domain.com']], [msg.recipients for msg in outbox])
+            self.assertEqual({'fetched': 1, 'failed': 1}, summary['forecasts']['outcomes'])
+            boston = summary['forecasts']['cities']['Boston, MA']
+            self.assertEqual(('failed', 1), (boston['outcome'], boston['skipped']))
+            self.assertIn('Boston is down', boston['error'])
+            self.assertEqual(2, len([call for call in mock_factory.call_args_list
+                                     if call[0][2] == 'Boston']))
+
+            stored_at = time.time() - forecast_cache.ttl - forecast_cache.stale_ttl - 60
+            forecast_cache.backend.set('MA/Boston', {'temperature': 40.0,
+                                                     'conditions': 'rain'}, stored_at)
+            with self.mail.record_messages() as outbox:
+                summary = run_weather_emails()
+            self.assertEqual((2, 0), (summary['sent'], summary['skipped']))
+            boston = summary['forecasts']['cities']['Boston, MA']
+            self.assertEqual('last_known_good', boston['outcome'])
+            self.assertGreaterEqual(boston['age'], forecast_cache.ttl)
+            self.assertIn('rain', [msg for msg in outbox
+                                   if msg.recipients == ['someguy@whatevs.com']][0].html)
+
+    def test_unknown_city_only_skips_its_subscribers(self):
+        """Test that an API response without conditions, as for a city the
+        API does not know, only skips that city's subscribers"""
+        server = LocalWeatherAPI()
+        server.unknown.add('Boston')
+        server.start()
+        try:
+            with self.app.app_context():
+                houston = City.query.filter_by(name='Houston').first()
+                db.session.add(Person(email='hello111@domain.com', city_id=houston.id))
+                db.session.commit()
+                with mock.patch.object(Forecast, 'API_URI', server.uri), \
+                        self.mail.record_messages() as outbox:
+                    summary = run_weather_emails()
+        finally:
+            server.stop()
+        self.assertEqual((1, 1), (summary['sent'], summary['skipped']))
+        self.assertEqual([['hello111@domain.com']], [msg.recipients for msg in outbox])
+        boston = summary['forecasts']['cities']['Boston, MA']
+        self.assertEqual('failed', boston['outcome'])
+        self.assertIn('current_observation', boston['error'])
+
+    def test_circuit_breaker_counts_only_transport_failures(self):
+        """Test that unknown cities do not open the circuit, that failures to
+        reach the API do, and that a half open trial call refused by the
+        quota lets the next call through"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        self.app.config.update(WEATHER_API_MAX_RETRIES=0)
+        http_client.init_app(self.app)
+        provider = WundergroundProvider({'FORECAST_BREAKER_THRESHOLD': 2,
+                                         'FORECAST_BREAKER_COOLDOWN': 0.05})
+        unknown = [('Nowhere{i}'.format(i=i), 'MA') for i in range(5)]
+        server = LocalWeatherAPI()
+        server.unknown.update(city for city, _ in unknown)
+        server.start()
+        try:
+            with mock.patch.object(Forecast, 'API_URI', server.uri):
+                forecasts, errors = provider.fetch_many(
+                    api_key, unknown + [('Houston', 'TX')])
+                self.assertEqual([('Houston', 'TX')], list(forecasts))
+                self.assertEqual(5, len(errors))
+                self.assertEqual('closed', provider.breaker.state)
+                server.failures = 2
+                provider.fetch_many(api_key, [('Houston', 'TX'), ('Austin', 'TX')])
+                self.assertEqual('open', provider.breaker.state)
+                time.sleep(0.06)
+                with mock.patch('weatheremail2.providers.Forecast.forecast_factory',
+                                side_effect=QuotaExceeded('No quota', RuntimeError())):
+                    _, errors = provider.fetch_many(api_key, [('Houston', 'TX')])
+                self.assertNotIsInstance(errors[('Houston', 'TX')], CircuitOpen)
+                forecasts, _ = provider.fetch_many(api_key, [('Houston', 'TX')])
+                self.assertEqual([('Houston', 'TX')], list(forecasts))
+                self.assertEqual('closed', provider.breaker.state)
+        finally:
+            server.stop()
+
+    def test_circuit_breaker_opens_and_half_opens(self):
+        """Test that the circuit opens after threshold failures in a row,
+        lets one trial call through after the cooldown, another one once the
+        first is released, and closes again once it succeeds"""
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+        breaker.allow()
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+        time.sleep(0.06)
+        breaker.allow()
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+        time.sleep(0.06)
+        breaker.allow()
+        breaker.release()
+        breaker.allow()
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+        breaker.record_success()
+        breaker.allow()
+        self.assertEqual({'state': 'closed', 'failures': 0, 'opened': 2,
+                          'rejected': 4}, breaker.stats())
+
+    def test_forecast_request_times_out(self):
+        """Test that a stalled API request gives up after the read timeout"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        self.app.config.update(WEATHER_API_READ_TIMEOUT=0.1,
+                               WEATHER_API_MAX_RETRIES=0)
+        http_client.init_app(self.app)
+        server = LocalWeatherAPI(delay=0.5)
+        server.start()
+        try:
+            with mock.patch.object(Forecast, 'API_URI', server.uri):
+                with self.assertRaises(AppError):
+                    Forecast.forecast_factory(api_key, 'MA', 'Boston')
+        finally:
+            server.stop()
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_forecast_cache_stale_while_revalidate(self, mock_factory):
+        """Test that a stale forecast is served while it is refreshed in the
+        background, and that waiting for refreshes can be bounded"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        stale = Forecast(api_key)
+        stale.temperature, stale.conditions = 40.0, 'rain'
+        fresh = Forecast(api_key)
+        fresh.temperature, fresh.conditions = 51.2, 'cloudy'
+        mock_factory.side_effect = [stale, fresh]
+        forecast_cache = ForecastCache(self.app)
+        self.assertEqual('rain', forecast_cache.get_forecast(api_key, 'MA', 'Boston').conditions)
+        self.assertEqual('rain', forecast_cache.get_forecast(api_key, 'MA', 'Boston').conditions)
+        forecast_cache.ttl = 0
+        self.assertEqual('rain', forecast_cache.get_forecast(api_key, 'MA', 'Boston').conditions)
+        forecast_cache.wait_for_refreshes()
+        forecast_cache.ttl = 1200
+        self.assertEqual('cloudy', forecast_cache.get_forecast(api_key, 'MA', 'Boston').conditions)
+        self.assertEqual({'hits': 2, 'misses': 1, 'stale': 1, 'refresh_errors': 0,
+                          'coalesced': 0, 'wait_time': 0.0},
+                         forecast_cache.stats())
+        self.assertEqual(2, mock_factory.call_count)
+
+        released = Event()
+        mock_factory.side_effect = lambda *args: released.wait(5) and fresh
+        forecast_cache.ttl = 0
+        forecast_cache.get_forecast(api_key, 'MA', 'Boston')
+        self.assertEqual(1, forecast_cache.wait_for_refreshes(timeout=0.05))
+        released.set()
+        self.assertEqual(0, forecast_cache.wait_for_refreshes(timeout=5))
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_forecast_cache_shared_between_processes(self, mock_factory):
+        """Test that forecasts cached in the sqlite and redis backends are seen
+        by other cache instances, as they would be from another process"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        forecast = Forecast(api_key)
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.app.config.update(FORECAST_CACHE_BACKEND='sqlite', FORECAST_CACHE_PATH=path)
+        try:
+            ForecastCache(self.app).get_forecast(api_key, 'MA', 'Boston')
+            other_process = ForecastCache(self.app)
+            self.assertEqual(51.2, other_process.get_forecast(api_key, 'MA', 'Boston').temperature)
+            self.assertEqual(1, other_process.stats()['hits'])
+        finally:
+            os.remove(path)
+        self.app.config.update(FORECAST_CACHE_BACKEND='memory')
+        redis = FakeRedis()
+        for _ in range(2):
+            other_process = ForecastCache(self.app)
+            other_process.backend = RedisBackend(client=redis)
+            other_process.get_forecast(api_key, 'TX', 'Houston')
+        self.assertEqual(1, other_process.stats()['hits'])
+        self.assertIn('forecast:TX/Houston', redis.data)
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_forecast_fetches_coalesced(self, mock_factory):
+        """Test that concurrent misses of a city make one API request, whether
+        the callers are threads of a process or processes sharing lock files"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        forecast = Forecast(api_key)
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+
+        def slow_factory(*args):
+            time.sleep(0.2)
+            return forecast
+        mock_factory.side_effect = slow_factory
+
+        def get_concurrently(caches):
+            results = []
+            threads = [Thread(target=lambda cache=cache: results.append(
+                cache.get_forecast(api_key, 'MA', 'Boston'))) for cache in caches]
+            for thr in threads:
+                thr.start()
+            for thr in threads:
+                thr.join()
+            return results
+
+        cache = ForecastCache(self.app)
+        results = get_concurrently([cache] * 5)
+        self.assertEqual(['cloudy'] * 5, [result.conditions for result in results])
+        self.assertEqual(1, mock_factory.call_count)
+        self.assertEqual(4, cache.stats()['coalesced'])
+
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.app.config.update(FORECAST_CACHE_BACKEND='sqlite',
+                               FORECAST_CACHE_PATH=os.path.join(workdir, 'cache.db'),
+                               FORECAST_SINGLE_FLIGHT='file',
+                               FORECAST_LOCK_DIR=os.path.join(workdir, 'locks'))
+        processes = [ForecastCache(self.app) for _ in range(3)]
+        get_concurrently(processes)
+        self.assertEqual(2, mock_factory.call_count)
+        self.assertEqual(2, sum(process.stats()['coalesced'] for process in processes))
+
+        guard = FileSingleFlight(os.path.join(workdir, 'striped'), stripes=4)
+        keys = ['key{i}'.format(i=i) for i in range(50)]
+        values, coalesced = guard.do_many(keys, lambda missing: {
+            key: len(os.listdir(guard.lock_dir)) for key in missing})
+        self.assertEqual(set(keys), set(values))
+        self.assertLessEqual(max(values.values()), 4)
+        self.assertEqual(set(), coalesced)
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_prefetch_forecasts_once_per_city(self, mock_factory):
+        """Test that forecasts are prefetched once for each city with subscribers"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        forecast = Forecast(api_key)
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+        with self.app.app_context():
+            boston = City.query.filter_by(name='Boston').first()
+            db.session.add(Person(email='another@whatevs.com', city_id=boston.id))
+            db.session.commit()
+            locations = get_subscribed_cities()
+            self.assertEqual([('Boston', 'MA')], locations)
+            forecasts = prefetch_forecasts(api_key, locations, concurrency=2)
+        mock_factory.assert_called_once_with(api_key, 'MA', 'Boston')
+        self.assertEqual('cloudy', forecasts[('Boston', 'MA')].conditions)
+
+    def test_json_provider_fetches_locations_in_batches(self):
+        """Test that the json provider fetches many locations per request and
+        that the mailing run uses it for every subscribed city"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        server = LocalWeatherAPI()
+        server.start()
+        self.app.config.update(WEATHER_PROVIDER='json',
+                               WEATHER_PROVIDER_URI=server.batch_uri,
+                               WEATHER_PROVIDER_BATCH_SIZE=2)
+        try:
+            forecast_cache.init_app(self.app)
+            locations = [('City {i}'.format(i=i), 'MA') for i in range(5)]
+            forecasts = prefetch_forecasts(api_key, locations, concurrency=2)
+            self.assertEqual(3, len(server.paths))
+            self.assertEqual({'cloudy'}, {forecast.conditions
+                                          for forecast in forecasts.values()})
+            self.assertEqual(5, len(forecasts))
+            prefetch_forecasts(api_key, locations)
+            self.assertEqual(3, len(server.paths))
+            with self.app.app_context():
+                houston = City.query.filter_by(name='Houston').first()
+                db.session.add(Person(email='another@whatevs.com', city_id=houston.id))
+                db.session.commit()
+                with self.mail.record_messages() as outbox:
+                    self.assertEqual(2, run_weather_emails()['sent'])
+            self.assertEqual(4, len(server.paths))
+            self.assertIn('MA%2FBoston%3BTX%2FHouston', server.paths[-1])
+            self.assertIn('cloudy', outbox[0].html)
+        finally:
+            server.stop()
+
+    def test_provider_registry(self):
+        """Test that providers are looked up by name and the fake provider
+        makes up the same forecast for a location every time"""
+        self.assertIs(FakeProvider, PROVIDERS['fake'])
+        provider = FakeProvider(self.app.config)
+        first, errors = provider.fetch_many('key', [('Boston', 'MA'), ('Houston', 'TX')])
+        second, _ = provider.fetch_many('key', [('Boston', 'MA')])
+        self.assertEqual({}, errors)
+        self.assertEqual(first[('Boston', 'MA')].temperature,
+                         second[('Boston', 'MA')].temperature)
+        self.assertEqual([[('Boston', 'MA'), ('Houston', 'TX')], [('Boston', 'MA')]],
+                         provider.batches)
+        self.app.config.update(WEATHER_PROVIDER='unknown')
+        with self.assertRaises(AppError):
+            ForecastCache(self.app)
+
+    def test_refresh_snapshots_and_send_from_them(self):
+        """Test that refreshing forecast snapshots only fetches the cities
+        whose snapshot is missing or stale, and that a run reading snapshots
+        emails from them without calling the weather provider"""
+        api_key = self.app.config['API_KEY_WUNDERGROUND']
+        self.app.config.update(WEATHER_PROVIDER='fake', WEATHER_PROVIDER_BATCH_SIZE=1)
+        forecast_cache.init_app(self.app)
+        with self.app.app_context():
+            boston = City.query.filter_by(name='Boston').first()
+            houston = City.query.filter_by(name='Houston').first()
+            for i in range(2):
+                db.session.add(Person(email='user{i}@domain.com'.format(i=i),
+                                      city_id=houston.id))
+            db.session.commit()
+            summary = refresh_snapshots(api_key, 1800, batch_size=1)
+            del summary['elapsed']
+            self.assertEqual({'stale': 2, 'refreshed': 2, 'failed': 0, 'remaining': 0},
+                             summary)
+            self.assertEqual([[('Houston', 'TX')], [('Boston', 'MA')]],
+                             forecast_cache.provider.batches)
+            self.assertEqual(0, refresh_snapshots(api_key, 1800)['stale'])
+
+            snapshot = ForecastSnapshot.query.get(boston.id)
+            snapshot.fetched_at -= timedelta(hours=2)
+            db.session.commit()
+            self.assertEqual(1, refresh_snapshots(api_key, 1800)['refreshed'])
+            self.assertEqual([('Boston', 'MA')], forecast_cache.provider.batches[-1])
+
+            self.app.config.update(FORECAST_SOURCE='snapshot')
+            snapshot = ForecastSnapshot.query.get(boston.id)
+            snapshot.fetched_at -= timedelta(hours=2)
+            db.session.commit()
+            houston_conditions = ForecastSnapshot.query.get(houston.id).conditions
+            with mock.patch.object(FakeProvider, 'fetch_batch') as mock_fetch, \
+                    self.mail.record_messages() as outbox:
+                summary = run_weather_emails()
+            mock_fetch.assert_not_called()
+            self.assertEqual(3, summary['sent'])
+            self.assertEqual({'snapshot': 1, 'last_known_good': 1},
+                             summary['forecasts']['outcomes'])
+            self.assertIn(houston_conditions, [msg for msg in outbox if
+                                               msg.recipients == ['user0@domain.com']][0].html)
+
+            ForecastSnapshot.query.filter_by(city_id=boston.id).delete()
+            db.session.commit()
+            with mock.patch.object(FakeProvider, 'fetch_batch') as mock_fetch:
+                summary = run_weather_emails()
+            mock_fetch.assert_not_called()
+            self.assertEqual((2, 1), (summary['sent'], summary['skipped']))
+            self.assertEqual('failed', summary['forecasts']['cities']['Boston, MA']['outcome'])
+
     def test_send_weather_email(self):
         """Test that we can send emails and get expected content"""
         sender = self.app.config['MAIL_USERNAME']
@@ -128,13 +1080,451 @@ class WeatherEmailTestCase(unittest.TestCase):
                         '51.2 F.</p>\n<p>Sincerely,</p>\n<p>The Weather Email team</p>'
         with self.app.app_context():
             with self.mail.record_messages() as outbox:
-                send_weather_email(sender, email_address, username, conditions, city, state, temp)
-                # not optimal but since sending async in thread, the above func will return
-                # before finished unless we put in a time delay
-                time.sleep(10)
+                with EmailDispatcher(self.app) as dispatcher:
+                    send_weather_email(sender, email_address, username, conditions, city,
+                                       state, temp, dispatcher=dispatcher)
                 self.assertEqual(1, len(outbox))
                 self.assertEqual(expected_body, outbox[0].html)
 
+    def test_cached_render_matches_template(self):
+        """Test that bodies built from the per city render cache are identical
+        to rendering the template for each recipient"""
+        renderer = WeatherEmailRenderer()
+        with self.app.test_request_context():
+            for username in ('hello111', "o'brien&co<x>", 'hello222'):
+                expected = render_template('email/weather_update.html',
+                                           username=username, conditions='cloudy',
+                                           city='Birmingham', state='AL', temp=51.2)
+                actual = renderer.render(username, 'cloudy', 'Birmingham', 'AL', 51.2)
+                self.assertEqual(expected, actual)
+        self.assertEqual(1, renderer.renders)
+
+    def test_email_dispatcher_sends_all_queued(self):
+        """Test that a small worker pool with a bounded queue sends every email
+        before its 'with' block exits"""
+        sender = self.app.config['MAIL_USERNAME']
+        with self.app.app_context():
+            with self.mail.record_messages() as outbox:
+                with EmailDispatcher(self.app, workers=2, queue_size=1) as dispatcher:
+                    for i in range(25):
+                        send_weather_email(sender, 'user{i}@domain.com'.format(i=i),
+                                           'user{i}'.format(i=i), 'cloudy', 'Boston',
+                                           'MA', 51.2, dispatcher=dispatcher)
+                self.assertEqual(25, len(outbox))
+                self.assertEqual(25, dispatcher.sent)
+                self.assertEqual(0, dispatcher.failed)
+
+    def test_email_dispatcher_survives_unexpected_errors(self):
+        """Test that a worker keeps going when sending raises an unexpected
+        error or on_result raises, so shutdown() returns"""
+        sender = self.app.config['MAIL_USERNAME']
+        results = []
+        dispatcher = EmailDispatcher(self.app, workers=1, queue_size=1)
+
+        def on_result(tag, sent, refused):
+            results.append((tag, sent))
+            raise ValueError('ledger is broken')
+
+        def send_all():
+            with self.app.app_context(), \
+                    mock.patch('weatheremail2.dispatcher.send_over_new_connection',
+                               side_effect=ValueError('bad header')):
+                with dispatcher:
+                    for i in range(5):
+                        send_weather_email(sender, 'user{i}@domain.com'.format(i=i),
+                                           'user{i}'.format(i=i), 'cloudy',
+                                           'Boston', 'MA', 51.2, dispatcher=dispatcher,
+                                           tag=i)
+
+        dispatcher.on_result = on_result
+        thr = Thread(target=send_all, daemon=True)
+        thr.start()
+        thr.join(5)
+        self.assertFalse(thr.is_alive())
+        self.assertEqual([(i, False) for i in range(5)], results)
+        self.assertEqual((0, 5), (dispatcher.sent, dispatcher.failed))
+
+    def test_pooled_dispatcher_reuses_smtp_connections(self):
+        """Test that pooled sends share one SMTP connection per worker and
+        reconnect when the server enforces a message-per-connection limit"""
+        server = LocalSMTPServer(max_per_connection=4)
+        server.start()
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.port,
+                               MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False)
+        self.mail.init_app(self.app)
+        sender = self.app.config['MAIL_USERNAME']
+        try:
+            with self.app.app_context():
+                with EmailDispatcher(self.app, workers=1, mode='pooled',
+                                     batch_size=5) as dispatcher:
+                    for i in range(10):
+                        send_weather_email(sender, 'user{i}@domain.com'.format(i=i),
+                                           'user{i}'.format(i=i), 'cloudy', 'Boston',
+                                           'MA', 51.2, dispatcher=dispatcher)
+        finally:
+            server.stop()
+        self.assertEqual(10, dispatcher.sent)
+        self.assertEqual(10, len(server.messages))
+        self.assertEqual(2, dispatcher.reconnects)
+        self.assertEqual(3, len(server.per_connection))
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_grouped_emails_fan_out_to_recipients(self, mock_factory):
+        """Test that with several recipients per message each city's
+        subscribers share SMTP transactions, one RCPT TO each, without
+        seeing each other, and that a refused recipient is recorded as failed
+        by both engines"""
+        forecast = Forecast(self.app.config['API_KEY_WUNDERGROUND'])
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+        server = LocalSMTPServer()
+        server.start()
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.port,
+                               MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False,
+                               EMAIL_RECIPIENTS_PER_MESSAGE=2)
+        self.mail.init_app(self.app)
+        try:
+            with self.app.app_context():
+                houston = City.query.filter_by(name='Houston').first()
+                for i in range(3):
+                    db.session.add(Person(email='user{i}@domain.com'.format(i=i),
+                                          city_id=houston.id))
+                db.session.commit()
+                summary = run_weather_emails(run_id='run-1')
+                self.assertEqual(4, SendLedger.query.filter_by(
+                    run_id='run-1', status=SendLedger.DELIVERED).count())
+                self.assertEqual((4, 3), (summary['sent'], summary['messages']))
+                self.assertEqual([['someguy@whatevs.com'],
+                                  ['user0@domain.com', 'user1@domain.com'],
+                                  ['user2@domain.com']],
+                                 sorted(sorted(rcpttos) for _, rcpttos, _ in server.messages))
+
+                server.refused.add('user1@domain.com')
+                runs = [run_weather_emails]
+                if aiosmtplib is not None:
+                    runs.append(run_async_weather_emails)
+                for number, run in enumerate(runs, 2):
+                    run_id = 'run-{0}'.format(number)
+                    summary = run(run_id=run_id)
+                    self.assertEqual((3, 1), (summary['sent'], summary['failed']))
+                    failed = [row.person_id for row in SendLedger.query.filter_by(
+                        run_id=run_id, status=SendLedger.FAILED)]
+                    user1 = Person.query.filter_by(email='user1@domain.com').first()
+                    self.assertEqual([user1.id], failed)
+        finally:
+            server.stop()
+        for _, _, data in server.messages:
+            self.assertIn(b'To: undisclosed-recipients:;', data)
+            self.assertNotIn(b'user0@domain.com', data)
+            self.assertIn(b'Hi there,', data)
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_outbox_spools_then_delivers_with_retries(self, mock_factory):
+        """Test that with the outbox a run only spools its emails, a resumed
+        run skips spooled subscribers, the deliverer sends them and records
+        them as delivered, and failed emails are retried then set aside"""
+        forecast = Forecast(self.app.config['API_KEY_WUNDERGROUND'])
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+        outbox_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outbox_dir)
+        server = LocalSMTPServer()
+        server.start()
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.port,
+                               MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False,
+                               EMAIL_DELIVERY='outbox', OUTBOX_DIR=outbox_dir)
+        self.mail.init_app(self.app)
+        try:
+            with self.app.app_context():
+                houston = City.query.filter_by(name='Houston').first()
+                for i in range(2):
+                    db.session.add(Person(email='user{i}@domain.com'.format(i=i),
+                                          city_id=houston.id))
+                db.session.commit()
+                summary = run_weather_emails(run_id='run-1')
+                self.assertEqual((3, 3), (summary['spooled'], summary['messages']))
+                self.assertEqual([], server.messages)
+                self.assertEqual(3, SendLedger.query.filter_by(
+                    run_id='run-1', status=SendLedger.SPOOLED).count())
+                self.assertEqual(0, run_weather_emails(
+                    run_id='run-1', resume=True)['spooled'])
+                summary = OutboxDeliverer.from_config(self.app).run(once=True)
+                self.assertEqual(3, summary['delivered'])
+                self.assertEqual({'new': 0, 'cur': 0, 'failed': 0},
+                                 summary['outbox'])
+                self.assertEqual(3, SendLedger.query.filter_by(
+                    run_id='run-1', status=SendLedger.DELIVERED).count())
+        finally:
+            server.stop()
+        self.assertEqual([['someguy@whatevs.com'], ['user0@domain.com'],
+                          ['user1@domain.com']],
+                         sorted(rcpttos for _, rcpttos, _ in server.messages))
+        self.assertIn(b'51.2', server.messages[0][2])
+
+        with self.app.app_context():
+            outbox = Outbox.from_config(self.app)
+            msg = build_weather_email('weather@domain.com', 'user0@domain.com',
+                                      'user0', 'cloudy', 'Houston', 'TX', 51.2)
+            outbox.put(msg, [1], 'run-2')
+            with mock.patch('flask_mail.Connection.send',
+                            side_effect=OSError('connection refused')):
+                summary = OutboxDeliverer.from_config(self.app).run(once=True)
+            self.assertEqual((0, 1, 1), (summary['delivered'],
+                                         summary['retried'], summary['failed']))
+            self.assertEqual(1, summary['outbox']['failed'])
+            self.assertEqual(1, SendLedger.query.filter_by(
+                run_id='run-2', status=SendLedger.FAILED).count())
+            self.assertEqual(1, outbox.requeue_failed())
+            self.assertEqual(1, len(outbox.claim()))
+
+            outbox.put(msg, [1], 'run-3')
+            self.app.config.update(MAIL_SUPPRESS_SEND=True)
+            self.mail.init_app(self.app)
+            with mock.patch.object(Outbox, 'complete',
+                                   side_effect=FileNotFoundError('recovered')):
+                summary = OutboxDeliverer.from_config(self.app).run(once=True)
+            self.assertEqual(1, summary['delivered'])
+            self.assertEqual(1, SendLedger.query.filter_by(
+                run_id='run-3', status=SendLedger.DELIVERED).count())
+
+    def test_outbox_deliverer_recovers_claims_and_retries_ledger_flushes(self):
+        """Test that a polling deliverer recovers claims going stale while it
+        runs, touches claims before sending them, skips claims recovered
+        from under it and keeps ledger rows a failed flush could not write"""
+        outbox_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outbox_dir)
+        self.app.config.update(EMAIL_DELIVERY='outbox', OUTBOX_DIR=outbox_dir,
+                               OUTBOX_POLL_INTERVAL=0)
+
+        class StopPolling(Exception):
+            pass
+
+        with self.app.app_context():
+            outbox = Outbox.from_config(self.app)
+            msg = build_weather_email('weather@domain.com', 'user0@domain.com',
+                                      'user0', 'cloudy', 'Houston', 'TX', 51.2)
+            outbox.put(msg, [1], 'run-1')
+            stale, = outbox.claim()
+            sleeps, flushes, touched = [], [], []
+            flush, touch = SendLedgerWriter.flush, Outbox.touch
+
+            def sleep(seconds):
+                sleeps.append(seconds)
+                if len(sleeps) == 1:
+                    os.utime(os.path.join(outbox_dir, 'cur', stale.name),
+                             (0, 0))
+                elif len(sleeps) == 3:
+                    raise StopPolling()
+
+            def flaky_flush(ledger):
+                flushes.append(ledger)
+                if len(flushes) == 1:
+                    raise OperationalError('INSERT', {},
+                                           Exception('database is locked'))
+                return flush(ledger)
+
+            def record_touch(outbox, entry):
+                touched.append(entry.name)
+                return touch(outbox, entry)
+
+            deliverer = OutboxDeliverer.from_config(self.app)
+            with mock.patch('weatheremail2.outbox.time.sleep', sleep), \
+                    mock.patch.object(SendLedgerWriter, 'flush', flaky_flush), \
+                    mock.patch.object(Outbox, 'touch', record_touch), \
+                    self.assertRaises(StopPolling):
+                deliverer.run()
+            self.assertEqual(1, deliverer.delivered)
+            self.assertEqual([stale.name], touched)
+            self.assertEqual(2, len(flushes))
+            self.assertEqual(1, SendLedger.query.filter_by(
+                run_id='run-1', status=SendLedger.DELIVERED).count())
+
+            outbox.put(msg, [1], 'run-2')
+            with mock.patch.object(Outbox, 'touch',
+                                   side_effect=FileNotFoundError('recovered')):
+                summary = OutboxDeliverer.from_config(self.app).run(once=True)
+            self.assertEqual((0, 0, 0), (summary['delivered'],
+                                         summary['retried'], summary['failed']))
+            self.assertEqual({'new': 0, 'cur': 1, 'failed': 0},
+                             summary['outbox'])
+
+    @mock.patch('weatheremail2.wunderground.Forecast.forecast_factory')
+    def test_scheduler_sends_each_time_zone_at_its_window(self, mock_factory):
+        """Test that the scheduler refreshes the forecasts ahead of each time
+        zone's window, sends each zone's subscribers once at its window,
+        resumes a window after a restart and skips missed windows"""
+        forecast = Forecast(self.app.config['API_KEY_WUNDERGROUND'])
+        forecast.temperature, forecast.conditions = 51.2, 'cloudy'
+        mock_factory.return_value = forecast
+
+        def utc(hour, minute):
+            return datetime(2018, 3, 26, hour, minute,
+                            tzinfo=timezone.utc).timestamp()
+
+        with self.app.app_context():
+            houston = City.query.filter_by(name='Houston').first()
+            db.session.add(Person(email='user0@domain.com', city_id=houston.id))
+            db.session.commit()
+            scheduler = Scheduler.from_config(self.app)
+            scheduler.started = utc(10, 0)
+            self.assertEqual({'America/New_York': ['MA'],
+                              'America/Chicago': ['TX']}, scheduler.zones())
+            # 07:50 in Boston, 06:50 in Houston
+            jobs = scheduler.due_jobs(utc(11, 50))
+            self.assertEqual([('send', '2018-03-26T07:00 America/New_York'),
+                              ('refresh', '2018-03-26T07:00 America/Chicago')],
+                             [(job.kind, job.run_id) for job in jobs])
+            with self.mail.record_messages() as outbox:
+                records = [scheduler.run_job(job) for job in jobs]
+            self.assertEqual([['someguy@whatevs.com']],
+                             [msg.recipients for msg in outbox])
+            self.assertEqual(1, records[0]['result']['sent'])
+            self.assertEqual([], scheduler.due_jobs(utc(11, 50)))
+            jobs = scheduler.due_jobs(utc(12, 0))
+            self.assertEqual([('send', '2018-03-26T07:00 America/Chicago')],
+                             [(job.kind, job.run_id) for job in jobs])
+            with self.mail.record_messages() as outbox:
+                scheduler.run_job(jobs[0])
+            self.assertEqual([['user0@domain.com']],
+                             [msg.recipients for msg in outbox])
+            stats = scheduler.stats()
+            self.assertEqual((3, 0), (stats['runs'], stats['failures']))
+            self.assertEqual(2, stats['timings']['scheduled_job_send']['count'])
+            self.assertEqual(
+                1, stats['timings']['scheduled_job_lateness_refresh']['count'])
+
+            restarted = Scheduler.from_config(self.app)
+            restarted.started = utc(12, 5)
+            jobs = restarted.due_jobs(utc(12, 10))
+            self.assertEqual([('send', '2018-03-26T07:00 America/Chicago')],
+                             [(job.kind, job.run_id) for job in jobs])
+            with self.mail.record_messages() as outbox:
+                for job in jobs:
+                    restarted.run_job(job)
+            self.assertEqual(0, len(outbox))
+            missed = Scheduler.from_config(self.app)
+            missed.started = utc(10, 0)
+            self.assertEqual([], missed.due_jobs(utc(13, 30)))
+            self.assertEqual(2, missed.skipped)
+
+    def test_scheduler_survives_failing_polls_and_jobs(self):
+        """Test that the scheduler logs and counts an error looking for due
+        jobs or raised by a job, and keeps polling"""
+        self.app.config.update(SCHEDULE_PER_TIMEZONE=False,
+                               SCHEDULE_POLL_INTERVAL=0)
+        with self.app.app_context():
+            scheduler = Scheduler.from_config(self.app)
+            job = ScheduledJob('send', 'UTC', None, 'run-1', time.time())
+            polls = [OperationalError('SELECT', {}, Exception('gone away')),
+                     [job]]
+
+            def due_jobs(now):
+                if not polls:
+                    scheduler.stop()
+                    return []
+                poll = polls.pop(0)
+                if isinstance(poll, Exception):
+                    raise poll
+                return poll
+
+            with mock.patch.object(scheduler, 'due_jobs', due_jobs), \
+                    mock.patch('weatheremail2.scheduler.run_weather_emails',
+                               side_effect=KeyError('city')):
+                stats = scheduler.run()
+            self.assertEqual((1, 2), (stats['runs'], stats['failures']))
+            self.assertEqual("'city'", stats['history'][-1]['error'])
+
+    def test_scheduler_config(self):
+        """Test that the scheduler can send everyone in one time zone, needs
+        zoneinfo or dateutil only for other zones than UTC and rejects
+        invalid send times and time zones"""
+        self.app.config.update(SCHEDULE_PER_TIMEZONE=False)
+        with self.app.app_context():
+            self.assertEqual({'UTC': None},
+                             Scheduler.from_config(self.app).zones())
+            with mock.patch('weatheremail2.scheduler.ZoneInfo', None), \
+                    mock.patch('weatheremail2.scheduler.dateutil_tz', None):
+                self.assertEqual({'UTC': None},
+                                 Scheduler.from_config(self.app).zones())
+                self.app.config.update(SCHEDULE_TIMEZONE='America/Chicago')
+                self.assertRaises(AppError, Scheduler.from_config, self.app)
+                self.app.config.update(SCHEDULE_TIMEZONE='UTC',
+                                       SCHEDULE_PER_TIMEZONE=True)
+                self.assertRaises(AppError, Scheduler.from_config, self.app)
+            self.app.config.update(SCHEDULE_SEND_TIMES=['7am'])
+            self.assertRaises(AppError, Scheduler.from_config, self.app)
+            self.app.config.update(SCHEDULE_SEND_TIMES=['07:00'],
+                                   SCHEDULE_TIMEZONE='Mars/Olympus_Mons')
+            self.assertRaises(AppError, Scheduler.from_config, self.app)
+
+    @unittest.skipIf(aiosmtplib is None, 'aiohttp and aiosmtplib not installed')
+    def test_async_engine_sends_same_emails(self):
+        """Test that the asyncio engine fetches each city's forecast once and
+        delivers the same emails as the threaded engine over SMTP"""
+        api = LocalWeatherAPI()
+        api.start()
+        server = LocalSMTPServer(max_per_connection=2)
+        server.start()
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.port,
+                               MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False)
+        self.mail.init_app(self.app)
+        try:
+            with self.app.app_context():
+                houston = City.query.filter_by(name='Houston').first()
+                for i in range(4):
+                    db.session.add(Person(email='user{i}@domain.com'.format(i=i),
+                                          city_id=houston.id))
+                db.session.commit()
+                with mock.patch.object(Forecast, 'API_URI', api.uri):
+                    with self.mail.record_messages() as outbox:
+                        summary = run_async_weather_emails(run_id='run-1')
+                for msg in outbox:
+                    username = get_username_from_email(msg.recipients[0])
+                    city, state = ('Boston', 'MA') if username == 'someguy' \
+                        else ('Houston', 'TX')
+                    self.assertEqual(render_weather_email(
+                        username, 'cloudy', city, state, 51.2), msg.html)
+                self.assertEqual(5, SendLedger.query.filter_by(
+                    run_id='run-1', status=SendLedger.DELIVERED).count())
+        finally:
+            server.stop()
+            api.stop()
+        self.assertEqual(5, summary['sent'])
+        self.assertEqual({'fetched': 2}, summary['forecasts']['outcomes'])
+        self.assertEqual(2, len(api.paths))
+        self.assertEqual(5, len(server.messages))
+        self.assertEqual(5, len(outbox))
+
+    @unittest.skipIf(aiosmtplib is None, 'aiohttp and aiosmtplib not installed')
+    def test_async_engine_uses_forecast_cache(self):
+        """Test that the asyncio engine reads forecasts from the forecast
+        cache, so a second run requests nothing, and does not retry 4xx
+        responses"""
+        api = LocalWeatherAPI()
+        api.start()
+        try:
+            with self.app.app_context(), \
+                    mock.patch.object(Forecast, 'API_URI', api.uri):
+                run_async_weather_emails()
+                self.assertEqual(1, len(api.paths))
+                summary = run_async_weather_emails()
+                self.assertEqual(1, len(api.paths))
+                self.assertEqual(1, summary['sent'])
+                self.assertEqual(1, forecast_cache.stats()['hits'])
+
+                austin = City(name='Austin', state='TX')
+                db.session.add(austin)
+                db.session.commit()
+                db.session.add(Person(email='user0@domain.com', city_id=austin.id))
+                db.session.commit()
+                api.failures, api.failure_status = 10, 404
+                summary = run_async_weather_emails()
+        finally:
+            api.stop()
+        self.assertEqual(2, len(api.paths))
+        self.assertEqual((1, 1), (summary['sent'], summary['skipped']))
+        self.assertIn('404', summary['forecasts']['cities']['Austin, TX']['error'])
+
     def test_custom_handler_404(self):
         """Test 404 handler"""
         path = '/non_existent_endpoint'
@@ -14,7 +14,11 @@ from flask_caching import Cache
 from flask_mail import Mail
 from flask_recaptcha import ReCaptcha
 
-from .models import db, Person, City
+from .models import db, enable_sqlite_wal, Person, City
+from .forecast_cache import ForecastCache
+from .metrics import metrics
+from .signups import signup_buffer
+from .webclient import http_client
 
 from instance.config import env_config
 
@@ -22,6 +26,7 @@ app = Flask(__name__, instance_relative_config=True)
 mail = Mail()
 cache = Cache()
 recaptcha = ReCaptcha()
+forecast_cache = ForecastCache()
 
 
 def create_app(config_envar=None,
@@ -47,14 +52,21 @@ def create_app(config_envar=None,
          cache: provides access to and configuration for Flask_Cache
          db: access and entry point for Flask_SqlAlchemy
          recaptcha: access to and configuration for Flask_Recaptcha
+         http_client: pooled HTTP session used to access the weather API
+         forecast_cache: persistent cache of forecast data shared between
+            processes
+         metrics: latency histograms of the mailing run stages
+         signup_buffer: batches signups into multi-row inserts when
+            SIGNUP_INGEST_MODE is 'buffered'
      """
     app.config.from_object(env_config[env])
     if config_envar:
         app.config.from_envvar(config_envar)
     mail.init_app(app)
-    cache.init_app(app, config={'CACHE_TYPE': 'simple'})
+    cache.init_app(app)
     db.app = app
     db.init_app(app)
+    enable_sqlite_wal(db.engine)
     db.create_all()
     formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -64,6 +76,10 @@ def create_app(config_envar=None,
     handler.setFormatter(formatter)
     app.logger.addHandler(handler)
     recaptcha.init_app(app)
+    http_client.init_app(app)
+    forecast_cache.init_app(app)
+    metrics.init_app(app)
+    signup_buffer.init_app(app)
     return app
 
 
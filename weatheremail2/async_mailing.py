@@ -0,0 +1,530 @@
+"""
+.. module:: async_mailing
+   :synopsis: Module containing the asyncio engine of the weather email
+        pipeline, which fetches forecasts and sends emails with separately
+        bounded concurrency.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from flask_mail import email_dispatched, sanitize_address, sanitize_addresses
+
+from weatheremail2 import app, forecast_cache, http_client, metrics
+from .app_error import AppError
+from .breaker import CircuitOpen
+from .emails import (WeatherEmailRenderer, build_group_weather_email,
+                     build_weather_email)
+from .forecasts import CityForecasts, load_city_forecasts
+from .ledger import SendLedgerWriter
+from .mailing import get_user_data, group_subscribers, record_run_metrics
+from .outbox import Outbox, OutboxWriter
+from .providers import WundergroundProvider
+from .utils import get_username_from_email
+from .webclient import RETRY_STATUS_CODES
+from .wunderground import Forecast
+
+try:
+    import aiohttp
+    import aiosmtplib
+except ImportError as import_exc:
+    aiohttp = aiosmtplib = None
+    _IMPORT_ERROR = import_exc
+
+SMTP_SERVICE_NOT_AVAILABLE = 421
+
+
+def run_async_weather_emails(shard_index=0, shard_count=1, run_id=None,
+                             resume=False):
+    """Sends the weather email of every subscriber in a shard with asyncio.
+
+    Notes:
+        Takes the same arguments and returns the same summary as
+            mailing.run_weather_emails(), and sends the same emails.
+        Requires the aiohttp and aiosmtplib packages.
+
+    Raises:
+       AppError, SQLAlchemyError: If the engine's packages are missing or
+        database data is unavailable.
+    """
+    if aiohttp is None or aiosmtplib is None:
+        raise AppError('The asyncio engine requires the aiohttp and '
+                       'aiosmtplib packages.', _IMPORT_ERROR)
+    pipeline = AsyncMailingPipeline(shard_index, shard_count, run_id, resume)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(pipeline.run())
+    finally:
+        loop.close()
+
+
+class QueueDepth(object):
+    """Samples the depth of a queue each time an item is put on it."""
+
+    def __init__(self):
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+
+    def stats(self):
+        return {'max': self.max,
+                'avg': self.total / self.samples if self.samples else 0.0}
+
+
+class AsyncMailingPipeline(object):
+    """Three stage asyncio pipeline: subscribers -> forecasts -> SMTP.
+
+    Notes:
+        Subscribers are read from the database onto a queue of
+            ASYNC_QUEUE_SIZE rows drained by ASYNC_FETCH_CONCURRENCY
+            forecast workers. Each city is fetched once through a shared
+            aiohttp session and the rendered messages go onto a second
+            bounded queue drained by ASYNC_SEND_CONCURRENCY senders, each
+            holding its own aiosmtplib connection.
+        A full queue suspends the stage feeding it, so a slow SMTP server
+            throttles forecast fetching and the database cursor in turn.
+        Blocking work stays off the event loop: the database cursor is read
+            by a thread, and send ledger writes, outbox writes and forecast
+            cache lookups run in thread pools.
+        Forecasts go through the forecast cache and its single-flight guard
+            like in the threaded engine, and only the cities it misses are
+            requested, with aiohttp. Timeouts, connection errors and
+            RETRY_STATUS_CODES responses are retried.
+        Cities are retried and fall back to their last known good forecast
+            as in the threaded engine (see forecasts.CityForecasts), and
+            subscribers of cities still without a forecast are skipped.
+            With FORECAST_SOURCE = 'snapshot' forecasts are all read from
+            the snapshot table before the pipeline starts.
+        With EMAIL_RECIPIENTS_PER_MESSAGE above 1 the queues carry groups of
+            subscribers of a city, each sent as one message, as in
+            mailing.run_weather_emails().
+        With EMAIL_DELIVERY = 'outbox' the senders spool the messages to
+            the outbox instead of sending them.
+
+    Attributes:
+        queued (int): number of recipients handed to the senders.
+        sent (int): number of recipients sent to successfully.
+        failed (int): number of recipients that could not be sent to.
+        messages (int): number of messages (SMTP transactions) sent.
+        skipped (int): number of subscribers without a forecast.
+        reconnects (int): number of SMTP reconnects.
+        depths (dict): QueueDepth of the 'fetch' and 'send' queues.
+        city_forecasts (CityForecasts): outcome of each city's forecast.
+    """
+    _STOP = object()
+
+    def __init__(self, shard_index=0, shard_count=1, run_id=None,
+                 resume=False):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.run_id = run_id
+        self.resume = resume
+        self.api_key = app.config['API_KEY_WUNDERGROUND']
+        self.sender = app.config['MAIL_USERNAME']
+        self.fetch_concurrency = app.config['ASYNC_FETCH_CONCURRENCY']
+        self.send_concurrency = app.config['ASYNC_SEND_CONCURRENCY']
+        self.queue_size = app.config['ASYNC_QUEUE_SIZE']
+        self.group_size = app.config['EMAIL_RECIPIENTS_PER_MESSAGE']
+        self.max_retries = app.config['WEATHER_API_MAX_RETRIES']
+        self.backoff_factor = app.config['WEATHER_API_BACKOFF_FACTOR']
+        self.mail_state = app.extensions['mail']
+        self.renderer = WeatherEmailRenderer()
+        self.ledger = SendLedgerWriter(run_id,
+                                       app.config['SEND_LEDGER_BATCH_SIZE'])
+        self.queued = self.sent = self.failed = self.skipped = 0
+        self.messages = 0
+        self.reconnects = 0
+        self.depths = {'fetch': QueueDepth(), 'send': QueueDepth()}
+        self.city_forecasts = CityForecasts.from_config(app)
+        self.outbox_writer = None
+        if app.config['EMAIL_DELIVERY'] == 'outbox':
+            self.outbox_writer = OutboxWriter(
+                Outbox.from_config(app), run_id,
+                self.ledger.record_spooled if run_id else None)
+        self._forecasts = {}
+
+    async def run(self):
+        """Runs the pipeline until every subscriber has been handled.
+
+        Returns:
+            dict summarizing the run
+        """
+        snapshot = metrics.snapshot()
+        if app.config['FORECAST_SOURCE'] != 'api':
+            self.city_forecasts = load_city_forecasts(self.shard_index,
+                                                      self.shard_count)
+        fetch_queue = asyncio.Queue(maxsize=self.queue_size)
+        send_queue = asyncio.Queue(maxsize=self.queue_size)
+        loop = asyncio.get_event_loop()
+        self._cache_executor = ThreadPoolExecutor(self.fetch_concurrency)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=app.config['WEATHER_API_CONNECT_TIMEOUT'],
+            sock_read=app.config['WEATHER_API_READ_TIMEOUT'])
+        connector = aiohttp.TCPConnector(limit=self.fetch_concurrency)
+        try:
+            async with aiohttp.ClientSession(connector=connector,
+                                             timeout=timeout) as session:
+                with self.ledger:
+                    fetchers = [asyncio.ensure_future(
+                        self._fetch_worker(session, fetch_queue, send_queue))
+                                for _ in range(self.fetch_concurrency)]
+                    senders = [asyncio.ensure_future(
+                        self._send_worker(send_queue))
+                               for _ in range(self.send_concurrency)]
+                    await loop.run_in_executor(None, self._produce, loop,
+                                               fetch_queue)
+                    for _ in fetchers:
+                        await fetch_queue.put(self._STOP)
+                    await asyncio.gather(*fetchers)
+                    for _ in senders:
+                        await send_queue.put(self._STOP)
+                    await asyncio.gather(*senders)
+        finally:
+            self._cache_executor.shutdown()
+        await loop.run_in_executor(None, forecast_cache.wait_for_refreshes,
+                                   app.config['FORECAST_REFRESH_TIMEOUT'])
+        shard = '{index}/{count}'.format(index=self.shard_index,
+                                         count=self.shard_count)
+        summary = {'shard': shard, 'run_id': self.run_id, 'engine': 'asyncio',
+                   'queued': self.queued, 'sent': self.sent,
+                   'failed': self.failed, 'skipped': self.skipped,
+                   'messages': self.messages,
+                   'renders': self.renderer.renders,
+                   'reconnects': self.reconnects,
+                   'forecasts': self.city_forecasts.summary(),
+                   'fetch_queue': self.depths['fetch'].stats(),
+                   'send_queue': self.depths['send'].stats()}
+        if self.outbox_writer is not None:
+            summary.update(self.outbox_writer.stats())
+        summary['timings'] = record_run_metrics(self.shard_index,
+                                                self.shard_count, snapshot,
+                                                self.run_id)
+        app.logger.info('Shard %s finished: %s', shard, summary)
+        return summary
+
+    def _produce(self, loop, fetch_queue):
+        """Puts every subscriber of the shard on the fetch queue, in groups
+        of the subscribers sharing a message.
+
+        Runs in a thread with an app context of its own, blocking while the
+        queue is full."""
+        with app.app_context():
+            for group in group_subscribers(get_user_data(
+                    shard_index=self.shard_index,
+                    shard_count=self.shard_count,
+                    skip_run_id=self.run_id if self.resume else None,
+                    order_by_city=self.group_size > 1), self.group_size):
+                self.depths['fetch'].sample(fetch_queue.qsize())
+                asyncio.run_coroutine_threadsafe(fetch_queue.put(group),
+                                                 loop).result()
+
+    async def _blocking(self, func, *args):
+        """Runs a blocking call, e.g. a send ledger or outbox write, in a
+        thread with an app context."""
+        def call():
+            with app.app_context():
+                return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, call)
+
+    async def _fetch_worker(self, session, fetch_queue, send_queue):
+        """Attaches forecasts to subscribers and renders their emails."""
+        while True:
+            group = await fetch_queue.get()
+            if group is self._STOP:
+                return
+            person_ids, emails, city, state = group
+            try:
+                msg = await self._compose(session, emails, city, state)
+            except Exception as compose_exc:
+                msg = None
+                app.logger.exception('Unable to compose the email to %s: %s',
+                                     emails, compose_exc)
+            if msg is None:
+                for person_id in person_ids:
+                    self.skipped += 1
+                    self.city_forecasts.skip((city, state))
+                if self.run_id:
+                    await self._record(self.ledger.record_skipped, person_ids)
+                continue
+            self.depths['send'].sample(send_queue.qsize())
+            await send_queue.put((msg, person_ids))
+            self.queued += len(person_ids)
+
+    async def _compose(self, session, emails, city, state):
+        """Returns the message to a group of subscribers of a city, or None
+        if the city has no forecast."""
+        forecast = await self._forecast(session, city, state)
+        if forecast is None:
+            return None
+        if self.group_size > 1:
+            return build_group_weather_email(
+                self.sender, emails, forecast.conditions, city, state,
+                forecast.temperature, self.renderer)
+        return build_weather_email(
+            self.sender, emails[0], get_username_from_email(emails[0]),
+            forecast.conditions, city, state, forecast.temperature,
+            self.renderer)
+
+    async def _record(self, record, person_ids, *args):
+        """Records the outcome of persons in the send ledger off the event
+        loop with a SendLedgerWriter method."""
+        try:
+            await self._blocking(record, person_ids, *args)
+        except Exception as record_exc:
+            app.logger.exception('Unable to record %s in the send ledger: %s',
+                                 person_ids, record_exc)
+
+    async def _forecast(self, session, city, state):
+        """Returns the forecast of a city, fetching it only once per run."""
+        key = (city, state)
+        future = self._forecasts.get(key)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self._forecasts[key] = future
+            try:
+                future.set_result(
+                    await self._fetch_forecast(session, city, state))
+            finally:
+                if not future.done():
+                    future.set_result(None)
+        return await future
+
+    async def _fetch_forecast(self, session, city, state):
+        """Gets a forecast through the forecast cache, or falls back.
+
+        Cities the cache misses are requested with aiohttp for Wunderground
+        and through CityForecasts in a worker thread for the other
+        providers. Forecasts read from snapshots are not fetched at all."""
+        if self.city_forecasts.offline:
+            return self.city_forecasts.get(city, state)
+        loop = asyncio.get_event_loop()
+        if not isinstance(forecast_cache.provider, WundergroundProvider):
+            return await loop.run_in_executor(
+                None, self.city_forecasts.get, city, state)
+        location = (city, state)
+        forecasts, errors = await loop.run_in_executor(
+            self._cache_executor, partial(
+                forecast_cache.get_forecasts, self.api_key, [location],
+                fetch_many=partial(self._fetch_many, loop, session)))
+        if location in forecasts:
+            self.city_forecasts.record(location, forecasts[location])
+            return forecasts[location]
+        return self.city_forecasts.fall_back(location, errors[location])
+
+    def _fetch_many(self, loop, session, api_key, locations, concurrency=1,
+                    on_batch=None):
+        """Forecast cache fetcher requesting locations on the event loop,
+        called from a cache thread; see WeatherProvider.fetch_many()."""
+        results = asyncio.run_coroutine_threadsafe(
+            self._request_all(session, locations), loop).result()
+        forecasts, errors = {}, {}
+        for location, result in zip(locations, results):
+            if isinstance(result, AppError):
+                errors[location] = result
+            elif isinstance(result, Exception):
+                errors[location] = AppError('An error occurred while '
+                                            'accessing weather forecast API '
+                                            'data.', result)
+            else:
+                forecasts[location] = result
+        if on_batch is not None and forecasts:
+            on_batch(forecasts)
+        return forecasts, errors
+
+    async def _request_all(self, session, locations):
+        """Requests locations at once, returning each forecast or error."""
+        return await asyncio.gather(
+            *[self._request(session, city, state) for city, state in
+              locations], return_exceptions=True)
+
+    async def _request(self, session, city, state):
+        """Requests a forecast, retrying transient failures with backoff.
+
+        Raises:
+            AppError: If the forecast could not be fetched.
+        """
+        breaker = forecast_cache.provider.breaker
+        forecast = Forecast(self.api_key)
+        try:
+            breaker.allow()
+            uri = forecast.request_uri(state, city)
+            for attempt in range(self.max_retries + 1):
+                if http_client.rate_limiter.enabled:
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, http_client.rate_limiter.acquire)
+                started = time.perf_counter()
+                try:
+                    async with session.get(uri) as response:
+                        response.raise_for_status()
+                        forecast.parse_response(await response.text())
+                    breaker.record_success()
+                    return forecast
+                except (aiohttp.ClientError, asyncio.TimeoutError) as req_exc:
+                    if attempt == self.max_retries or \
+                            not _is_retryable(req_exc):
+                        raise
+                    app.logger.warning('Retrying request for %s/%s: %s',
+                                       state, city, req_exc)
+                    await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                finally:
+                    app.logger.debug('Request for %s/%s took %.3fs', state,
+                                     city, time.perf_counter() - started)
+        except AppError as forecast_exc:
+            error = forecast_exc
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError,
+                TypeError, ValueError) as forecast_exc:
+            error = AppError('An error occurred while accessing weather '
+                             'forecast API data.', forecast_exc)
+        if isinstance(error, CircuitOpen):
+            raise error
+        if _is_transport_error(error.original_exception):
+            breaker.record_failure()
+        else:
+            breaker.release()
+        raise error
+
+    async def _send_worker(self, send_queue):
+        """Sends messages over one long lived SMTP connection, or spools
+        them to the outbox.
+
+        Any error handling a message is logged and the message counted as
+        failed, so a sender never dies and leaves the queue undrained."""
+        connection = _AsyncSMTPConnection(self.mail_state)
+        try:
+            while True:
+                item = await send_queue.get()
+                if item is self._STOP:
+                    return
+                msg, person_ids = item
+                refused = set()
+                try:
+                    if self.outbox_writer is not None:
+                        await self._blocking(self.outbox_writer.submit, msg,
+                                             person_ids)
+                        continue
+                    with metrics.smtp_send.time():
+                        refused = set(await connection.send(msg))
+                    self.sent += len(person_ids) - len(refused)
+                    self.failed += len(refused)
+                    self.messages += 1
+                    delivered = True
+                    if refused:
+                        app.logger.error('Recipients refused: %s',
+                                         sorted(refused))
+                except (aiosmtplib.SMTPException, OSError) as send_exc:
+                    self.failed += len(person_ids)
+                    delivered = False
+                    app.logger.error('Unable to send email to %s: %s',
+                                     sorted(msg.send_to), send_exc)
+                except Exception as send_exc:
+                    self.failed += len(person_ids)
+                    delivered = False
+                    app.logger.exception('Unexpected error sending email to '
+                                         '%s: %s', sorted(msg.send_to),
+                                         send_exc)
+                if self.run_id:
+                    await self._record(self.ledger.record_group_sent,
+                                       person_ids, delivered, refused)
+        finally:
+            await connection.close()
+            self.reconnects += connection.reconnects
+
+
+def _is_retryable(req_exc):
+    """Returns whether a failed forecast request is worth retrying: timeouts,
+    connection errors and RETRY_STATUS_CODES responses are, other errors
+    (e.g. 4xx responses) are not."""
+    if isinstance(req_exc, aiohttp.ClientResponseError):
+        return req_exc.status in RETRY_STATUS_CODES
+    return isinstance(req_exc, (asyncio.TimeoutError,
+                                aiohttp.ClientConnectionError))
+
+
+def _is_transport_error(req_exc):
+    """Returns whether a failed forecast request counts against the
+    circuit breaker: timeouts, connection errors and 5xx responses do,
+    refused quota, 4xx responses and unparsable responses do not."""
+    if isinstance(req_exc, aiohttp.ClientResponseError):
+        return req_exc.status >= 500
+    return isinstance(req_exc, (asyncio.TimeoutError,
+                                aiohttp.ClientConnectionError))
+
+
+class _AsyncSMTPConnection(object):
+    """aiosmtplib counterpart of dispatcher.SMTPConnection.
+
+    Notes:
+        Honors the same MAIL_* settings as Flask-Mail, including
+            MAIL_SUPPRESS_SEND (messages are only recorded through the
+            email_dispatched signal) and MAIL_MAX_EMAILS.
+    """
+
+    def __init__(self, mail_state):
+        self.mail_state = mail_state
+        self.reconnects = 0
+        self._smtp = None
+        self._num_emails = 0
+
+    async def send(self, msg):
+        """Sends a message, returning the recipients the server refused
+        while accepting the others."""
+        refused = {}
+        if msg.date is None:
+            msg.date = time.time()
+        if not self.mail_state.suppress:
+            if self._smtp is None:
+                await self._open()
+            try:
+                refused = await self._sendmail(msg)
+            except (aiosmtplib.SMTPServerDisconnected,
+                    aiosmtplib.SMTPResponseException) as smtp_exc:
+                if not (isinstance(smtp_exc,
+                                   aiosmtplib.SMTPServerDisconnected) or
+                        smtp_exc.code == SMTP_SERVICE_NOT_AVAILABLE):
+                    raise
+                self.reconnects += 1
+                await self.close()
+                await self._open()
+                refused = await self._sendmail(msg)
+        email_dispatched.send(msg, app=app)
+        self._num_emails += 1
+        if self._num_emails == self.mail_state.max_emails:
+            self._num_emails = 0
+            await self.close()
+        return refused
+
+    async def close(self):
+        if self._smtp is not None:
+            try:
+                await self._smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    async def _sendmail(self, msg):
+        refused, _ = await self._smtp.sendmail(
+            sanitize_address(msg.sender),
+            list(sanitize_addresses(msg.send_to)), msg.as_bytes())
+        return refused
+
+    async def _open(self):
+        smtp = aiosmtplib.SMTP(hostname=self.mail_state.server,
+                               port=self.mail_state.port,
+                               use_tls=self.mail_state.use_ssl)
+        await smtp.connect()
+        if self.mail_state.use_tls and \
+                not smtp.get_transport_info('sslcontext'):
+            await smtp.starttls()
+        if self.mail_state.username and self.mail_state.password:
+            await smtp.login(self.mail_state.username,
+                             self.mail_state.password)
+        self._smtp = smtp
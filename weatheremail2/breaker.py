@@ -0,0 +1,107 @@
+"""
+.. module:: breaker
+   :synopsis: Module containing the circuit breaker that stops calling the
+        weather provider after consecutive failures.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import time
+from threading import Lock
+
+from .app_error import AppError
+
+
+class CircuitOpen(AppError):
+    """Raised instead of calling a provider whose circuit is open."""
+
+
+class CircuitBreaker(object):
+    """Fails calls fast once threshold calls in a row have failed.
+
+    Notes:
+        The circuit is closed while calls succeed. After threshold
+            consecutive failures it opens and allow() raises CircuitOpen
+            for cooldown seconds. Then it is half open: one trial call is
+            let through, closing the circuit if it succeeds and opening it
+            for another cooldown if it fails. A call whose outcome says
+            nothing about the provider's health (e.g. a refused quota or an
+            unknown city) calls release() instead, so the next call becomes
+            the trial.
+        A threshold of 0 or None never opens the circuit.
+
+    Attributes:
+        threshold (int): consecutive failures opening the circuit.
+        cooldown (float): seconds the circuit stays open.
+        state (str): 'closed', 'open' or 'half_open'.
+        failures (int): consecutive failures so far.
+        opened (int): number of times the circuit opened.
+        rejected (int): number of calls failed fast.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    def allow(self):
+        """Returns if a call may go ahead.
+
+        Raises:
+            CircuitOpen: If the circuit is open, or half open with its trial
+                call in flight.
+        """
+        with self._lock:
+            if self.state == self.OPEN and \
+                    time.time() - self._opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.CLOSED or (self.state == self.HALF_OPEN and
+                                             not self._trial):
+                self._trial = self.state == self.HALF_OPEN
+                return
+            self.rejected += 1
+        raise CircuitOpen('The weather provider circuit is open.',
+                          RuntimeError('{failures} consecutive failures'.
+                                       format(failures=self.failures)))
+
+    def record_success(self):
+        """Closes the circuit."""
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial = False
+
+    def release(self):
+        """Ends a call that neither succeeded nor failed, letting another
+        trial call through if the circuit is half open."""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        """Counts a failure, opening the circuit at the threshold or when
+        the trial call of a half open circuit failed."""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.threshold and self.failures >= self.threshold and
+                    self.state == self.CLOSED):
+                self.state = self.OPEN
+                self._opened_at = time.time()
+                self._trial = False
+                self.opened += 1
+
+    def stats(self):
+        """Returns the state and counters as a dict."""
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures,
+                    'opened': self.opened, 'rejected': self.rejected}
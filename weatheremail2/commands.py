@@ -7,41 +7,117 @@
 
 """
 
+import signal
+import time
+from datetime import datetime
+
+import click
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm.exc import NoResultFound
 
-from weatheremail2 import app, cache
+from weatheremail2 import app
 from .app_error import AppError
-from .emails import send_weather_email
-from .models import db, City, Person
-from .utils import get_city_data, get_username_from_email
-from .wunderground import Forecast
+from .async_mailing import run_async_weather_emails
+from .loaders import load_cities
+from .mailing import run_sharded, run_weather_emails
+from .models import db
+from .outbox import Outbox, OutboxDeliverer
+from .scheduler import Scheduler
+from .snapshots import refresh_snapshots
+from .utils import get_city_data
 
 
 @app.cli.command()
-def load_data():
+@click.option('--file', 'loadfile', default='top_100_city_state_sorted.txt',
+              help='CSV of city,state rows; a file name in the data '
+                   'directory or a path.')
+@click.option('--batch-size', default=None, type=int,
+              help='Rows written per batch. Defaults to '
+                   'CITY_LOAD_BATCH_SIZE.')
+def load_data(loadfile, batch_size):
     """Convenience method to create schema and necessary city/state data for
     app.
 
+    Notes:
+        Cities are upserted by name in batches (COPY on PostgreSQL), so the
+            command can be rerun to refresh city data without dropping the
+            tables or losing subscribers.
+            $ flask load_data --file /path/to/census_places.csv
+
     Raises:
 	   SQLAlchemyError, AppError: If database error or file containing
 	    city data was unable to be parsed/loaded
 
     """
+    if batch_size is None:
+        batch_size = app.config['CITY_LOAD_BATCH_SIZE']
     try:
-        db.drop_all()
         db.create_all()
-        for row in get_city_data():
-            city = City(name=str(row[0]).strip(), state=str(row[1]).strip())
-            db.session.add(city)
-        db.session.commit()
+        loaded, elapsed = load_cities(get_city_data(loadfile), batch_size)
+        click.echo('Loaded {rows} cities in {secs:.2f}s ({rate:.0f} '
+                   'rows/s)'.format(rows=loaded, secs=elapsed,
+                                    rate=loaded / elapsed if elapsed else 0))
     except (SQLAlchemyError, AppError) as load_data_exc:
+        db.session.rollback()
         app.logger.error('An error occurred while loading initial performing '
                          'the load_data command: %s', load_data_exc)
 
 
 @app.cli.command()
-def send_weather_emails():
+@click.option('--max-age', default=None, type=int,
+              help='Seconds after which a snapshot is refreshed. Defaults '
+                   'to FORECAST_SNAPSHOT_TTL.')
+@click.option('--batch-size', default=None, type=int,
+              help='Cities fetched and saved per batch. Defaults to '
+                   'FORECAST_SNAPSHOT_BATCH_SIZE.')
+def refresh_forecasts(max_age, batch_size):
+    """Method to refresh the forecast snapshots of the subscribed cities
+        whose snapshot is missing or stale.
+
+    Notes:
+        This is executed at the command line, e.g. from cron ahead of the
+            mailing runs:
+            $ flask refresh_forecasts
+        Only snapshots older than FORECAST_SNAPSHOT_TTL seconds are
+            refreshed, the most subscribed cities first, in batches of
+            FORECAST_SNAPSHOT_BATCH_SIZE cities fetched with
+            FORECAST_PREFETCH_CONCURRENCY requests in flight.
+        Mailing runs with FORECAST_SOURCE = 'snapshot' then read the
+            forecasts from the snapshot table instead of the weather API.
+
+    Raises:
+       SQLAlchemyError: If database data is unavailable.
+    """
+    if max_age is None:
+        max_age = app.config['FORECAST_SNAPSHOT_TTL']
+    if batch_size is None:
+        batch_size = app.config['FORECAST_SNAPSHOT_BATCH_SIZE']
+    try:
+        db.create_all()
+        click.echo(refresh_snapshots(
+            app.config['API_KEY_WUNDERGROUND'], max_age, batch_size,
+            app.config['FORECAST_PREFETCH_CONCURRENCY']))
+    except SQLAlchemyError as refresh_exc:
+        db.session.rollback()
+        app.logger.error('An error occurred during the execution of the '
+                         'refresh_forecasts command: %s', refresh_exc)
+
+
+@app.cli.command()
+@click.option('--shard-index', default=0, type=int,
+              help='Shard of the subscribers to send, from 0.')
+@click.option('--shard-count', default=1, type=int,
+              help='Number of shards subscribers are split into.')
+@click.option('--processes', default=1, type=int,
+              help='Number of local processes to split the shard across.')
+@click.option('--run-id', default=None,
+              help='Id the run is recorded under in the send ledger. '
+                   'Defaults to the current UTC date.')
+@click.option('--resume', is_flag=True,
+              help='Skip subscribers the run already delivered to.')
+@click.option('--engine', type=click.Choice(['threaded', 'asyncio']),
+              default='threaded', help='Pipeline used to send the emails.')
+def send_weather_emails(shard_index, shard_count, processes, run_id, resume,
+                        engine):
     """Method to loop through the Person table and send
         emails containing the conditions and temperature
         of their selected city and state.
@@ -49,56 +125,134 @@ def send_weather_emails():
     Notes:
         This is executed at the command line:
             $ flask send_weather_emails
+        Emails are sent by a fixed pool of EMAIL_DISPATCH_WORKERS threads.
+            Once EMAIL_DISPATCH_QUEUE_SIZE emails are waiting to be sent the
+            loop blocks until a worker frees up a slot, and the command
+            does not return until every queued email has been handled.
+        With EMAIL_SEND_MODE = 'pooled' each worker reuses one SMTP
+            connection for all of its batches of EMAIL_BATCH_SIZE emails.
+        The forecasts of all subscribed cities are fetched up front,
+            FORECAST_PREFETCH_CONCURRENCY at a time, and the email loop
+            reads them from memory.
+        With FORECAST_SOURCE = 'snapshot' they are read from the forecast
+            snapshot table kept fresh by refresh_forecasts instead, without
+            calling the weather API.
+        Weather API retries made during the run are limited to
+            WEATHER_API_RETRY_BUDGET.
+        To split the run across machines, run the command on each one with
+            the same --shard-count and a different --shard-index:
+            $ flask send_weather_emails --shard-index 0 --shard-count 2
+        --processes N forks N processes each sending part of the shard.
+        Every email is recorded in the send ledger under --run-id (the
+            current UTC date by default). If a run dies part way, rerun it
+            with --resume to only email the subscribers it did not deliver
+            to:
+            $ flask send_weather_emails --run-id 2018-03-25 --resume
+        --engine asyncio runs the pipeline on asyncio (requires aiohttp and
+            aiosmtplib) with ASYNC_FETCH_CONCURRENCY forecast requests and
+            ASYNC_SEND_CONCURRENCY SMTP connections.
+        With EMAIL_DELIVERY = 'outbox' the emails are spooled to OUTBOX_DIR
+            and recorded as spooled instead of being sent, and
+            deliver_outbox sends them.
 
     Raises:
        AppError, SQLAlchemyError: If API data or database data is unavailable.
     """
+    if not 0 <= shard_index < shard_count:
+        raise click.BadParameter('must be between 0 and --shard-count - 1',
+                                 param_hint='--shard-index')
+    if processes < 1:
+        raise click.BadParameter('must be at least 1',
+                                 param_hint='--processes')
+    if run_id is None:
+        run_id = datetime.utcnow().strftime('%Y-%m-%d')
+    runner = run_async_weather_emails if engine == 'asyncio' \
+        else run_weather_emails
     try:
-        api_key = app.config['API_KEY_WUNDERGROUND']
-        sender = app.config['MAIL_USERNAME']
-        for email_address, city, state in get_user_data():
-            forecast = get_cached_forecast(api_key, state, city)
-            temp = forecast.temperature
-            cond = forecast.conditions
-            username = get_username_from_email(email_address)
-            send_weather_email(sender, email_address, username, cond, city,
-                               state, temp)
+        if processes > 1:
+            summaries = run_sharded(processes, shard_index, shard_count,
+                                    run_id, resume, runner)
+        else:
+            summaries = [runner(shard_index, shard_count, run_id, resume)]
+        for summary in summaries:
+            click.echo(summary)
     except (SQLAlchemyError, AppError) as weather_emails_exc:
         app.logger.error('An error occurred during the execution of the '
                          'send_weather_emails command: %s', weather_emails_exc)
 
 
-@cache.memoize(timeout=1200)
-def get_cached_forecast(api_key, state, city):
-    """Method using 'caching' that wraps the factory method that returns
-        the Forecast class containing the temp and conditions data.
+@app.cli.command()
+@click.option('--workers', default=None, type=int,
+              help='Number of SMTP workers. '
+                   'Defaults to EMAIL_DISPATCH_WORKERS.')
+@click.option('--once', is_flag=True,
+              help='Return once no email is due instead of polling.')
+@click.option('--retry-failed', is_flag=True,
+              help='Requeue the emails that failed every attempt first.')
+def deliver_outbox(workers, once, retry_failed):
+    """Method to send the emails spooled to the outbox by
+        send_weather_emails.
 
     Notes:
-        This is cached using the method arguments as cache keys so
-            cached entries are specific to a city/state/api_key.
-        This allows us to avoid duplicate API requests and reuse already
-            requested data.
+        This is executed at the command line, e.g. as a long running
+            service next to the mailing runs:
+            $ flask deliver_outbox
+        Any number of deliverers, on the same host or sharing OUTBOX_DIR,
+            can run at once; each email is claimed by only one of them.
+        Failed emails are retried up to OUTBOX_MAX_ATTEMPTS times, waiting
+            OUTBOX_RETRY_BACKOFF seconds after the first failure and twice
+            as long after each next one, then left in the outbox's failed
+            folder until a run with --retry-failed.
+
+    Raises:
+       AppError, SQLAlchemyError: If the outbox or database is unavailable.
     """
-    return Forecast.forecast_factory(api_key, state, city)
+    if workers is not None and workers < 1:
+        raise click.BadParameter('must be at least 1', param_hint='--workers')
+    try:
+        if retry_failed:
+            requeued = Outbox.from_config(app).requeue_failed()
+            app.logger.info('Requeued %s failed outbox emails', requeued)
+        click.echo(OutboxDeliverer.from_config(app, workers).run(once))
+    except (SQLAlchemyError, AppError) as deliver_exc:
+        app.logger.error('An error occurred during the execution of the '
+                         'deliver_outbox command: %s', deliver_exc)
 
 
-def get_user_data():
-    """Generator method returning email addresses and associated city and
-        state data.
+@app.cli.command()
+@click.option('--once', is_flag=True,
+              help='Run the jobs due now and return.')
+def scheduler(once):
+    """Method to run the forecast refreshes and weather email sends on the
+        SCHEDULE_* schedule, in place of cron.
 
-    Returns:
-       Generator of 3 element tuples
+    Notes:
+        This is executed at the command line as a long running service:
+            $ flask scheduler
+        Each time zone of the subscribed cities' states is sent at the
+            SCHEDULE_SEND_TIMES of its local time, up to SCHEDULE_JITTER
+            seconds late, and the forecasts of its cities are refreshed
+            SCHEDULE_REFRESH_LEAD seconds ahead. With SCHEDULE_PER_TIMEZONE
+            off everyone is sent at the send times of SCHEDULE_TIMEZONE.
+        Sends are recorded in the send ledger under a run id naming their
+            window, e.g. '2018-03-25T07:00 America/Chicago', and resumed if
+            the scheduler is restarted during the window.
+        Jobs run one at a time and SCHEDULE_LOCK_FILE keeps a second
+            scheduler from starting. SIGTERM or Ctrl-C stops the scheduler
+            once the running job is done and prints its stats.
 
     Raises:
-       AppError: If no results from database occurs
-
+       AppError, SQLAlchemyError: If the schedule is invalid or database
+        data is unavailable.
     """
     try:
-        for person, city in db.session.query(Person, City). \
-                filter(Person.city_id == City.id).all():
-            yield person.email, city.name, city.state
-    except NoResultFound as nrf:
-        raise AppError(
-            'No user data was returned from the database for which to send '
-            'weather emails: %s',
-            nrf)
+        runner = Scheduler.from_config(app)
+        signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+        try:
+            click.echo(runner.run(until=time.time() if once else None))
+        except KeyboardInterrupt:
+            runner.stop()
+            click.echo(runner.stats())
+    except (SQLAlchemyError, AppError) as scheduler_exc:
+        app.logger.error('An error occurred during the execution of the '
+                         'scheduler command: %s', scheduler_exc)
@@ -0,0 +1,358 @@
+"""
+.. module:: dispatcher
+   :synopsis: Module containing a bounded pool of worker threads used to
+        send emails in the background.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import queue
+import time
+from smtplib import (SMTPException, SMTPRecipientsRefused,
+                     SMTPResponseException, SMTPServerDisconnected)
+from threading import Lock, Thread
+
+from weatheremail2 import mail, metrics
+
+SEND_MODE_MESSAGE = 'message'
+SEND_MODE_POOLED = 'pooled'
+
+# SMTP reply code a server uses when it is closing the transmission
+# channel, e.g. once its message-per-connection limit has been reached
+SMTP_SERVICE_NOT_AVAILABLE = 421
+
+
+class SMTPConnection(object):
+    """Long lived SMTP connection opened through Flask-Mail's mail.connect().
+
+    Notes:
+        The connection (and TLS handshake/login) is opened lazily on the
+            first send and reused for every following message.
+        Flask-Mail itself reconnects every MAIL_MAX_EMAILS messages; if the
+            server drops us before that or answers with a 421 the
+            connection is reopened and the message is retried once.
+
+    Attributes:
+        reconnects (int): number of times the connection was reopened
+            after the server closed it.
+    """
+
+    def __init__(self):
+        self.reconnects = 0
+        self._connection = None
+
+    def send(self, msg):
+        """Sends a message over the connection, opening it if needed.
+
+        Args:
+            msg (flask_mail.Message): message to send.
+
+        Returns:
+            dict of the recipients the server refused while accepting others
+        """
+        if self._connection is None:
+            self._open()
+        try:
+            return send_message(self._connection, msg)
+        except (SMTPServerDisconnected, SMTPResponseException,
+                SMTPRecipientsRefused) as smtp_exc:
+            if not must_reconnect(smtp_exc):
+                raise
+            self.reconnects += 1
+            self.close()
+            self._open()
+            return send_message(self._connection, msg)
+
+    def close(self):
+        """Quits the SMTP session if one is open."""
+        if self._connection is not None:
+            try:
+                self._connection.__exit__(None, None, None)
+            except (SMTPException, OSError):
+                pass
+            self._connection = None
+
+    def _open(self):
+        connection = mail.connect()
+        connection.__enter__()
+        self._connection = connection
+
+
+def send_message(connection, msg):
+    """Sends a message over a Flask-Mail connection, returning the
+    recipients the server refused.
+
+    Notes:
+        Connection.send() drops what SMTP.sendmail() returns, which is the
+            only trace of recipients refused while others were accepted, so
+            the sendmail() of its SMTP host is wrapped for the call.
+
+    Args:
+        connection (flask_mail.Connection): open connection.
+        msg (flask_mail.Message): message to send.
+
+    Returns:
+        dict mapping refused recipients to their SMTP code and reply
+    """
+    host = connection.host
+    if host is None:
+        connection.send(msg)
+        return {}
+    refused = {}
+    sendmail = host.sendmail
+
+    def sendmail_keeping_refused(*args):
+        refused.update(sendmail(*args) or {})
+        return refused
+
+    host.sendmail = sendmail_keeping_refused
+    try:
+        connection.send(msg)
+    finally:
+        del host.sendmail
+    return refused
+
+
+def send_over_new_connection(msg):
+    """Sends a message like mail.send(), returning the recipients the
+    server refused."""
+    with mail.connect() as connection:
+        return send_message(connection, msg)
+
+
+def must_reconnect(smtp_exc):
+    """Returns True if an SMTP error means the server closed the connection.
+
+    Args:
+        smtp_exc (SMTPException): error raised while sending.
+    """
+    if isinstance(smtp_exc, SMTPServerDisconnected):
+        return True
+    if isinstance(smtp_exc, SMTPResponseException):
+        return smtp_exc.smtp_code == SMTP_SERVICE_NOT_AVAILABLE
+    if isinstance(smtp_exc, SMTPRecipientsRefused):
+        return all(code == SMTP_SERVICE_NOT_AVAILABLE
+                   for code, _ in smtp_exc.recipients.values())
+    return False
+
+
+class EmailDispatcher(object):
+    """Sends email messages from a fixed number of worker threads.
+
+    Notes:
+        Messages are handed to the workers through a bounded queue so a
+            producer looping over a large subscriber list blocks in
+            submit() once the queue is full instead of piling up threads
+            or messages in memory.
+        Each worker pushes a single app context for its whole lifetime
+            rather than one per message, and takes up to batch_size
+            messages off the queue at a time.
+        In 'pooled' mode each worker keeps its own SMTPConnection open for
+            its lifetime so the pool of connections is as large as the
+            pool of workers. In 'message' mode a new connection is opened
+            for every message, as mail.send() does.
+        Intended to be used as a context manager; leaving the 'with'
+            block waits until every submitted message has been handled.
+        If on_send is given it is called from the worker thread with the
+            tag of a message right before it is sent; an error it raises
+            fails the message without sending it.
+        If on_result is given it is called from the worker thread with the
+            tag a message was submitted with, whether it was sent and the
+            set of recipients the server refused while accepting the
+            others (empty unless a message has many recipients).
+        Any error sending a message, or raised by on_result, is logged and
+            the message counted as failed, so a worker never dies and
+            submit() and shutdown() can not block on a queue nobody drains.
+        sent and failed count recipients, so a message to many recipients
+            (see emails.GroupMessage) counts once per recipient there and
+            once in messages. Refused recipients of a sent message count
+            as failed.
+
+    Attributes:
+        app: Flask app the workers push an app context for.
+        workers (int): number of worker threads.
+        queue_size (int): max number of messages waiting to be sent.
+        mode (str): either 'message' or 'pooled'.
+        batch_size (int): max number of messages a worker sends per batch.
+        on_send (callable): called with the tag before each message.
+        on_result (callable): called with (tag, sent, refused) after each
+            message.
+        sent (int): number of recipients sent to successfully.
+        failed (int): number of recipients that could not be sent to.
+        messages (int): number of messages (SMTP transactions) sent.
+        batches (int): number of batches sent.
+        reconnects (int): number of times a pooled connection was reopened.
+    """
+    _STOP = object()
+
+    def __init__(self, app, workers=8, queue_size=1000,
+                 mode=SEND_MODE_MESSAGE, batch_size=1, on_result=None,
+                 on_send=None):
+        self.app = app
+        self.workers = workers
+        self.queue_size = queue_size
+        self.mode = mode
+        self.batch_size = batch_size
+        self.on_result = on_result
+        self.on_send = on_send
+        self.sent = 0
+        self.failed = 0
+        self.messages = 0
+        self.batches = 0
+        self.reconnects = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self._threads = []
+
+    @classmethod
+    def from_config(cls, app, on_result=None, workers=None, on_send=None):
+        """Factory method returning a dispatcher set up from the EMAIL_*
+        values of the app config, with workers overriding
+        EMAIL_DISPATCH_WORKERS if given."""
+        return cls(app,
+                   workers=workers or app.config['EMAIL_DISPATCH_WORKERS'],
+                   queue_size=app.config['EMAIL_DISPATCH_QUEUE_SIZE'],
+                   mode=app.config['EMAIL_SEND_MODE'],
+                   batch_size=app.config['EMAIL_BATCH_SIZE'],
+                   on_result=on_result, on_send=on_send)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def start(self):
+        """Starts the worker threads."""
+        for _ in range(self.workers):
+            thr = Thread(target=self._work, daemon=True)
+            thr.start()
+            self._threads.append(thr)
+
+    def submit(self, msg, tag=None):
+        """Queues a message for sending, blocking while the queue is full.
+
+        Args:
+            msg (flask_mail.Message): message to send.
+            tag: passed to on_result once the message has been handled.
+                Defaults to None.
+        """
+        self._queue.put((msg, tag))
+
+    def join(self):
+        """Waits until every message submitted so far has been handled."""
+        self._queue.join()
+
+    def shutdown(self):
+        """Waits for every queued message to be handled and stops the
+        workers."""
+        for _ in self._threads:
+            self._queue.put(self._STOP)
+        for thr in self._threads:
+            thr.join()
+        self._threads = []
+
+    def _work(self):
+        """Worker loop draining the queue in batches until told to stop."""
+        with self.app.app_context():
+            connection = None
+            if self.mode == SEND_MODE_POOLED:
+                connection = SMTPConnection()
+            try:
+                stop = False
+                while not stop:
+                    batch, stop = self._next_batch()
+                    try:
+                        if batch:
+                            self._deliver(batch, connection)
+                    finally:
+                        for _ in range(len(batch) + int(stop)):
+                            self._queue.task_done()
+            finally:
+                if connection is not None:
+                    connection.close()
+                    self._count(reconnects=connection.reconnects)
+
+    def _next_batch(self):
+        """Blocks for one message then takes whatever else is already
+        waiting, up to batch_size messages.
+
+        Returns:
+            tuple of the list of (message, tag) tuples and whether a stop
+                was requested
+        """
+        item = self._queue.get()
+        if item is self._STOP:
+            return [], True
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _deliver(self, batch, connection):
+        """Sends a batch of messages and records the outcome."""
+        send = send_over_new_connection if connection is None \
+            else connection.send
+        started = time.time()
+        sent = failed = messages = 0
+        for msg, tag in batch:
+            refused = set()
+            try:
+                if self.on_send is not None:
+                    self.on_send(tag)
+                with metrics.smtp_send.time():
+                    refused = set(send(msg) or ())
+                sent += len(msg.send_to) - len(refused)
+                failed += len(refused)
+                messages += 1
+                delivered = True
+                if refused:
+                    self.app.logger.error('Recipients refused: %s',
+                                          sorted(refused))
+            except (SMTPException, OSError) as send_exc:
+                failed += len(msg.send_to)
+                delivered = False
+                self.app.logger.error('Unable to send email to %s: %s',
+                                      sorted(msg.send_to), send_exc)
+            except Exception as send_exc:
+                failed += len(msg.send_to)
+                delivered = False
+                self.app.logger.exception('Unexpected error sending email to '
+                                          '%s: %s', sorted(msg.send_to),
+                                          send_exc)
+            if self.on_result is not None:
+                try:
+                    self.on_result(tag, delivered, refused)
+                except Exception as result_exc:
+                    self.app.logger.exception('Unable to record the result '
+                                              'of the email to %s: %s',
+                                              sorted(msg.send_to),
+                                              result_exc)
+        elapsed = time.time() - started
+        self._count(sent=sent, failed=failed, messages=messages, batches=1)
+        self.app.logger.info(
+            'Sent batch of %s emails to %s recipients (%s failed) in %.3fs: '
+            '%.1f recipients/s', len(batch), sent + failed, failed, elapsed,
+            sent / elapsed if elapsed else float(sent))
+
+    def stats(self):
+        """Returns the counters for the run summary."""
+        with self._lock:
+            return {'sent': self.sent, 'failed': self.failed,
+                    'messages': self.messages, 'batches': self.batches,
+                    'reconnects': self.reconnects}
+
+    def _count(self, sent=0, failed=0, messages=0, batches=0, reconnects=0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+            self.messages += messages
+            self.batches += batches
+            self.reconnects += reconnects
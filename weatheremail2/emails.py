@@ -5,11 +5,14 @@
 
 """
 
+import uuid
+from threading import Lock
+
 from flask import render_template
 from flask_mail import Message
+from markupsafe import escape
 
-from weatheremail2 import mail, app
-from .decorators import async_in_thread
+from weatheremail2 import mail, app, metrics
 
 FORECAST_CONDITIONS_MAP = {
     'sunny': "It's nice out! Enjoy a discount on us.",
@@ -33,22 +36,101 @@ FORECAST_CONDITIONS_MAP = {
     'cloudy': "Not so nice out? That's okay, enjoy a discount on us."
 }
 
+# greeting of emails shared by many recipients, which can not use their names
+GROUP_USERNAME = 'there'
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
+
+class GroupMessage(Message):
+    """Message sent to many recipients in one SMTP transaction.
+
+    Notes:
+        The recipients are passed as bcc so they are only on the envelope,
+            one RCPT TO each, and the To header reads
+            'undisclosed-recipients:;' instead of listing them.
+    """
+
+    def _message(self):
+        msg = Message._message(self)
+        msg.replace_header('To', UNDISCLOSED_RECIPIENTS)
+        return msg
+
+
+def build_email(subject, sender, recipients, html_body):
+    """Returns the Message of an html email."""
+    msg = Message(subject, sender=sender, recipients=recipients)
+    msg.html = html_body
+    return msg
 
-@async_in_thread
-def send_email(subject, sender, recipients, html_body):
+
+def send_email(subject, sender, recipients, html_body, dispatcher=None,
+               tag=None):
     """Method that peforms actual sending of email.
 
     Notes:
-        Annotated with @async_in_thread meaning that each email send
-            will run in its own thread until completion
+        If a dispatcher is passed the message is queued to be sent by one
+            of its worker threads, otherwise it is sent before returning.
+
+    Args:
+         dispatcher (EmailDispatcher): worker pool sending the message.
+            Defaults to None.
+         tag: handed back by the dispatcher once the message is sent.
+            Defaults to None.
     """
-    with app.app_context():
-        msg = Message(subject, sender=sender, recipients=recipients)
-        msg.html = html_body
+    dispatch_email(build_email(subject, sender, recipients, html_body),
+                   dispatcher, tag)
+
+
+def dispatch_email(msg, dispatcher=None, tag=None):
+    """Sends a message, or queues it on the dispatcher if one is given."""
+    if dispatcher is None:
         mail.send(msg)
+    else:
+        dispatcher.submit(msg, tag=tag)
+
+
+class WeatherEmailRenderer(object):
+    """Renders the weather email template once per city and forecast.
+
+    Notes:
+        Everyone subscribed to the same city gets the same email except for
+            their username, so the template is rendered once per
+            (city, state, conditions, temp) with a unique placeholder as the
+            username and split on that placeholder. Each recipient's body is
+            then the pieces joined with their escaped username, which is
+            exactly what Jinja would have rendered.
+        One renderer is meant to be used for one mailing run.
 
+    Attributes:
+        template (str): name of the email template.
+        renders (int): number of times the template was rendered.
+    """
 
-def send_weather_email(sender, email, username, conditions, city, state, temp):
+    def __init__(self, template='email/weather_update.html'):
+        self.template = template
+        self.renders = 0
+        self._placeholder = uuid.uuid4().hex
+        self._parts = {}
+        self._lock = Lock()
+
+    def render(self, username, conditions, city, state, temp):
+        """Returns the html body of the weather email of one recipient."""
+        key = (city, state, conditions, temp)
+        parts = self._parts.get(key)
+        if parts is None:
+            parts = render_template(self.template,
+                                    username=self._placeholder,
+                                    conditions=conditions, city=city,
+                                    state=state, temp=temp). \
+                split(self._placeholder)
+            with self._lock:
+                self._parts[key] = parts
+                self.renders += 1
+        return str(escape(username)).join(parts)
+
+
+def send_weather_email(sender, email, username, conditions, city, state, temp,
+                       dispatcher=None, tag=None, renderer=None):
     """Method that prepares for sending emails by setting core values and
         populating template with city/state/temp/conditions data.
 
@@ -60,6 +142,12 @@ def send_weather_email(sender, email, username, conditions, city, state, temp):
          city (str): name of city
          state (str): 2 char state abbrev.
          temp : temperature in F
+         dispatcher (EmailDispatcher): worker pool sending the email.
+            Defaults to None meaning the email is sent synchronously.
+         tag: handed back by the dispatcher once the email is sent, e.g.
+            the id of the recipient. Defaults to None.
+         renderer (WeatherEmailRenderer): renders the body from a per city
+            cache. Defaults to None meaning the template is rendered.
 
     Attributes:
         conditional_subject: the subject line of the emails that is
@@ -72,12 +160,63 @@ def send_weather_email(sender, email, username, conditions, city, state, temp):
     send_email(conditional_subject,
                sender=sender,
                recipients=[email],
-               html_body=render_template('email/weather_update.html',
-                                         username=username,
-                                         conditions=conditions,
-                                         city=city,
-                                         state=state,
-                                         temp=temp))
+               html_body=render_weather_email(username, conditions, city,
+                                              state, temp, renderer),
+               dispatcher=dispatcher, tag=tag)
+
+
+def build_weather_email(sender, email, username, conditions, city, state,
+                        temp, renderer=None):
+    """Returns the Message send_weather_email() would send, for pipelines
+    that deliver messages themselves."""
+    return build_email(FORECAST_CONDITIONS_MAP.get(conditions), sender,
+                       [email], render_weather_email(username, conditions,
+                                                     city, state, temp,
+                                                     renderer))
+
+
+def build_group_weather_email(sender, emails, conditions, city, state, temp,
+                              renderer=None):
+    """Returns one GroupMessage of the weather email for all the subscribers
+    of a city.
+
+    Notes:
+        The body can not be personalized, so the recipients are greeted
+            with GROUP_USERNAME instead of their username.
+
+    Args:
+         sender (str): email address of  account from which emails are sent
+         emails (list): email addresses of the recipients.
+         conditions (str): string describing weather
+         city (str): name of city
+         state (str): 2 char state abbrev.
+         temp : temperature in F
+         renderer (WeatherEmailRenderer): renders the body from a per city
+            cache. Defaults to None meaning the template is rendered.
+
+    Returns:
+        GroupMessage instance
+    """
+    msg = GroupMessage(FORECAST_CONDITIONS_MAP.get(conditions), sender=sender,
+                       bcc=list(emails))
+    msg.html = render_weather_email(GROUP_USERNAME, conditions, city, state,
+                                    temp, renderer)
+    return msg
+
+
+def render_weather_email(username, conditions, city, state, temp,
+                         renderer=None):
+    """Returns the html body of a weather email, through the renderer's
+    cache if one is given."""
+    with metrics.render.time():
+        if renderer is None:
+            return render_template('email/weather_update.html',
+                                   username=username,
+                                   conditions=conditions,
+                                   city=city,
+                                   state=state,
+                                   temp=temp)
+        return renderer.render(username, conditions, city, state, temp)
 
 
 def get_email_subject(conditions):
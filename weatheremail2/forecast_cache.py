@@ -0,0 +1,425 @@
+"""
+.. module:: forecast_cache
+   :synopsis: Module containing the persistent, cross process cache of
+        forecast data and its pluggable storage backends.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from threading import Lock, Thread
+
+from .app_error import AppError
+from .metrics import metrics
+from .providers import WundergroundProvider, create_provider
+from .singleflight import ThreadSingleFlight, create_single_flight
+from .wunderground import Forecast
+
+
+class MemoryBackend(object):
+    """Stores entries in a dict, so they only live as long as the process."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key, values, stored_at):
+        with self._lock:
+            self._entries[key] = (values, stored_at)
+
+
+class SQLiteBackend(object):
+    """Stores entries in a SQLite file shared by every process on the host.
+
+    Notes:
+        A connection is opened per operation since sqlite3 connections can
+            not be shared between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS forecast_cache ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                         'stored_at REAL NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value, stored_at FROM forecast_cache '
+                               'WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, values, stored_at):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO forecast_cache '
+                             '(key, value, stored_at) VALUES (?, ?, ?)',
+                             (key, json.dumps(values), stored_at))
+        finally:
+            conn.close()
+
+
+class RedisBackend(object):
+    """Stores entries in Redis, shared by every process and host using it.
+
+    Notes:
+        The redis package is only needed when this backend is configured
+            without passing in a client. Any object with Redis style
+            get(key) and set(key, value, ex=seconds) methods can stand in
+            for the client.
+    """
+
+    def __init__(self, url=None, client=None, expire=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError as ie:
+                raise AppError('The redis forecast cache backend requires '
+                               'the redis package.', ie)
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.expire = expire
+
+    def get(self, key):
+        raw = self.client.get('forecast:' + key)
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        entry = json.loads(raw)
+        return entry['values'], entry['stored_at']
+
+    def set(self, key, values, stored_at):
+        self.client.set('forecast:' + key,
+                        json.dumps({'values': values, 'stored_at': stored_at}),
+                        ex=self.expire)
+
+
+class ForecastCache(object):
+    """Caches forecasts in a backend selected by FORECAST_CACHE_BACKEND.
+
+    Notes:
+        Backends are 'memory' (per process), 'sqlite' (file at
+            FORECAST_CACHE_PATH) and 'redis' (server at
+            FORECAST_CACHE_REDIS_URL).
+        Entries younger than FORECAST_CACHE_TTL seconds are fresh. For a
+            further FORECAST_CACHE_STALE_TTL seconds they are stale: the
+            stale forecast is returned right away while a background thread
+            fetches a new one (stale-while-revalidate). Older entries are
+            refetched before returning. Mailing runs wait up to
+            FORECAST_REFRESH_TIMEOUT seconds for those refreshes before
+            returning, so a command does not exit in the middle of them.
+        Forecasts are fetched from the WEATHER_PROVIDER weather provider.
+            get_forecasts() fetches all the locations it misses in one
+            provider call, so providers taking many locations per request
+            need a handful of requests for all of them.
+        Fetches go through a single-flight guard (FORECAST_SINGLE_FLIGHT),
+            so when the entry of a popular city expires only one caller
+            fetches it and concurrent callers wait for its forecast. The
+            'file' guard also coalesces the processes of a host sharing
+            the sqlite backend, with lock files in FORECAST_LOCK_DIR.
+            Coalesced callers are counted in stats() and timed as the
+            'coalesced' result of the forecast_fetch histogram.
+        Entries are kept for FORECAST_LAST_KNOWN_GOOD_TTL seconds (if longer
+            than the stale window) so last_known_good() can stand in for a
+            forecast that can not be fetched.
+
+    Attributes:
+        backend: storage backend of the cache entries.
+        provider (WeatherProvider): provider forecasts are fetched from.
+        single_flight: guard coalescing concurrent fetches of a city.
+        ttl (int): seconds an entry is fresh for.
+        stale_ttl (int): seconds an expired entry may still be served for.
+        last_known_good_ttl (int): seconds an entry may stand in for a
+            forecast that failed to be fetched.
+        hits (int): number of fresh entries returned.
+        misses (int): number of forecasts fetched before returning,
+            including the ones fetched by a concurrent caller.
+        stale (int): number of stale entries returned.
+        refresh_errors (int): number of failed background refreshes.
+    """
+    BACKENDS = ('memory', 'sqlite', 'redis')
+
+    def __init__(self, app=None):
+        self.backend = MemoryBackend()
+        self.provider = WundergroundProvider({})
+        self.single_flight = ThreadSingleFlight()
+        self.ttl = 1200
+        self.stale_ttl = 3600
+        self.last_known_good_ttl = 86400
+        self.logger = logging.getLogger(__name__)
+        self._lock = Lock()
+        self._refreshing = {}
+        self.reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Initializes the backend from the FORECAST_CACHE_* settings of the
+        app.
+
+        Args:
+            app: Flask application instance
+
+        Raises:
+            AppError: If the configured backend or provider is unknown or
+                unavailable.
+        """
+        backend = app.config['FORECAST_CACHE_BACKEND']
+        self.provider = create_provider(app)
+        self.single_flight = create_single_flight(app)
+        self.ttl = app.config['FORECAST_CACHE_TTL']
+        self.stale_ttl = app.config['FORECAST_CACHE_STALE_TTL']
+        self.last_known_good_ttl = app.config['FORECAST_LAST_KNOWN_GOOD_TTL']
+        self.logger = app.logger
+        if backend == 'memory':
+            self.backend = MemoryBackend()
+        elif backend == 'sqlite':
+            self.backend = SQLiteBackend(app.config['FORECAST_CACHE_PATH'])
+        elif backend == 'redis':
+            self.backend = RedisBackend(app.config['FORECAST_CACHE_REDIS_URL'],
+                                        expire=self.ttl + max(
+                                            self.stale_ttl,
+                                            self.last_known_good_ttl))
+        else:
+            raise AppError('Unknown forecast cache backend.',
+                           ValueError(backend))
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zeroes the hit/miss/stale counters."""
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.stale = 0
+            self.refresh_errors = 0
+        self.single_flight.reset_stats()
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        with self._lock:
+            stats = {'hits': self.hits, 'misses': self.misses,
+                     'stale': self.stale,
+                     'refresh_errors': self.refresh_errors}
+        stats.update(self.single_flight.stats())
+        return stats
+
+    def get_forecast(self, api_key, state, city):
+        """Returns the cached forecast of a city, fetching it if need be.
+
+        Args:
+            api_key (str): Wunderground Weather API Key.
+            state (str): 2 char abbrev. for US state
+            city (str): Name of city.
+
+        Returns:
+            Forecast instance
+
+        Raises:
+            AppError: If the forecast had to be fetched and that failed.
+        """
+        forecasts, errors = self.get_forecasts(api_key, [(city, state)])
+        if (city, state) in errors:
+            raise errors[(city, state)]
+        return forecasts[(city, state)]
+
+    def get_forecasts(self, api_key, locations, concurrency=1,
+                      fetch_many=None):
+        """Returns the cached forecasts of many locations, fetching the ones
+        missing with a single provider call.
+
+        Args:
+            api_key (str): weather API key.
+            locations (list): 2 element (city, state) tuples.
+            concurrency (int): max number of provider requests in flight.
+                Defaults to 1.
+            fetch_many: function fetching the missing locations in place of
+                the provider's fetch_many(), taking the same arguments, e.g.
+                to request them with the asyncio engine's HTTP client.
+                Defaults to None.
+
+        Returns:
+            tuple of the dict mapping (city, state) tuples to Forecast
+            instances and the dict mapping the locations that could not be
+            fetched to their AppError
+        """
+        forecasts = {}
+        missing = []
+        for city, state in dict.fromkeys(locations):
+            started = time.perf_counter()
+            key = '{state}/{city}'.format(state=state, city=city)
+            entry = self.backend.get(key)
+            age = time.time() - entry[1] if entry is not None else None
+            if age is not None and age < self.ttl + self.stale_ttl:
+                result = 'hit' if age < self.ttl else 'stale'
+                self._count('hits' if result == 'hit' else 'stale')
+                if result == 'stale':
+                    self._revalidate(key, api_key, state, city)
+                forecasts[(city, state)] = self._to_forecast(api_key,
+                                                             entry[0])
+                metrics.forecast_fetch.observe(time.perf_counter() - started,
+                                               result)
+            else:
+                missing.append((city, state))
+        if not missing:
+            return forecasts, {}
+        started = time.perf_counter()
+        coalesced = set()
+        for _ in missing:
+            self._count('misses')
+        try:
+            fetched, errors, coalesced = self._fetch_many(
+                api_key, missing, concurrency, fetch_many)
+        finally:
+            elapsed = time.perf_counter() - started
+            for location in missing:
+                metrics.forecast_fetch.observe(
+                    elapsed, 'coalesced' if location in coalesced else 'miss')
+        forecasts.update(fetched)
+        return forecasts, errors
+
+    def last_known_good(self, api_key, state, city):
+        """Returns the cached forecast of a city however stale, as long as
+        it is younger than last_known_good_ttl.
+
+        Args:
+            api_key (str): weather API key.
+            state (str): 2 char abbrev. for US state
+            city (str): Name of city.
+
+        Returns:
+            tuple of the Forecast and its age in seconds, or None
+        """
+        entry = self.backend.get('{state}/{city}'.format(state=state,
+                                                         city=city))
+        if entry is None:
+            return None
+        age = time.time() - entry[1]
+        if age >= max(self.last_known_good_ttl, self.ttl + self.stale_ttl):
+            return None
+        return self._to_forecast(api_key, entry[0]), age
+
+    def wait_for_refreshes(self, timeout=None):
+        """Blocks until all background refreshes have finished, or for at
+        most timeout seconds.
+
+        Notes:
+            Refreshes run in daemon threads, so a command line process
+                should wait for them before exiting, or they are cut off
+                and the stale entries stay stale for the next run.
+
+        Args:
+            timeout (float): max seconds to wait, None to wait for all.
+                Defaults to None.
+
+        Returns:
+            int number of refreshes still running
+        """
+        with self._lock:
+            threads = list(self._refreshing.values())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thr in threads:
+            thr.join(None if deadline is None
+                     else max(0, deadline - time.monotonic()))
+        running = sum(thr.is_alive() for thr in threads)
+        if running:
+            self.logger.warning('%s forecast refreshes still running after '
+                                '%ss', running, timeout)
+        return running
+
+    def _fetch_many(self, api_key, locations, concurrency=1,
+                    fetch_many=None):
+        """Fetches locations from the provider through the single-flight
+        guard, returning their forecasts, their errors and the locations
+        fetched (or failed) by another caller."""
+        by_key = {'{state}/{city}'.format(state=state, city=city):
+                  (city, state) for city, state in locations}
+
+        def store(fetched):
+            for (city, state), forecast in fetched.items():
+                self._store('{state}/{city}'.format(state=state, city=city),
+                            forecast)
+
+        if fetch_many is None:
+            fetch_many = self.provider.fetch_many
+
+        def fetch(keys):
+            # errors are passed on as values so waiting callers get them too
+            fetched, errors = fetch_many(
+                api_key, [by_key[key] for key in keys], concurrency,
+                on_batch=store)
+            return {key: fetched.get(by_key[key]) or errors[by_key[key]]
+                    for key in keys}
+
+        values, coalesced = self.single_flight.do_many(
+            list(by_key), fetch, lambda keys: self._fresh(api_key, keys))
+        forecasts, errors = {}, {}
+        for key, value in values.items():
+            if isinstance(value, AppError):
+                errors[by_key[key]] = value
+            else:
+                forecasts[by_key[key]] = value
+        return forecasts, errors, {by_key[key] for key in coalesced}
+
+    def _fresh(self, api_key, keys):
+        """Returns the forecasts of the keys with fresh entries."""
+        forecasts = {}
+        for key in keys:
+            entry = self.backend.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                forecasts[key] = self._to_forecast(api_key, entry[0])
+        return forecasts
+
+    def _store(self, key, forecast):
+        self.backend.set(key, {'temperature': forecast.temperature,
+                               'conditions': forecast.conditions},
+                         time.time())
+
+    def _revalidate(self, key, api_key, state, city):
+        """Starts a background refresh of a key unless one is running."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            thr = Thread(target=self._refresh,
+                         args=(key, api_key, state, city), daemon=True)
+            self._refreshing[key] = thr
+        thr.start()
+
+    def _refresh(self, key, api_key, state, city):
+        try:
+            _, errors, _ = self._fetch_many(api_key, [(city, state)])
+            if errors:
+                self._count('refresh_errors')
+                self.logger.error('Unable to refresh stale forecast for %s: '
+                                  '%s', key, errors[(city, state)])
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @staticmethod
+    def _to_forecast(api_key, values):
+        forecast = Forecast(api_key)
+        forecast.temperature = values['temperature']
+        forecast.conditions = values['conditions']
+        return forecast
@@ -0,0 +1,333 @@
+"""
+.. module:: forecasts
+   :synopsis: Module containing methods for retrieving the forecasts of the
+        cities subscribers signed up for.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import time
+from datetime import datetime
+
+from sqlalchemy import func
+
+from weatheremail2 import app, forecast_cache
+from .app_error import AppError
+from .breaker import CircuitOpen
+from .models import db, City, Person
+from .ratelimit import is_quota_error
+from .snapshots import get_city_snapshots
+from .wunderground import Forecast
+
+
+def get_cached_forecast(api_key, state, city):
+    """Method using 'caching' that wraps the factory method that returns
+        the Forecast class containing the temp and conditions data.
+
+    Notes:
+        This is cached in forecast_cache, keyed by city/state, so entries
+            are shared by every process using the same cache backend.
+        This allows us to avoid duplicate API requests and reuse already
+            requested data, even if it is slightly stale.
+    """
+    return forecast_cache.get_forecast(api_key, state, city)
+
+
+def get_subscribed_cities(shard_index=0, shard_count=1, states=None):
+    """Returns the distinct cities at least one Person signed up for, the
+    ones with the most subscribers first.
+
+    Args:
+        shard_index (int): only consider subscribers of this shard.
+            Defaults to 0.
+        shard_count (int): number of shards subscribers are split into.
+            Defaults to 1.
+        states (list): only consider the cities of these states.
+            Defaults to None meaning every state.
+
+    Returns:
+       list of 2 element (city, state) tuples
+    """
+    query = db.session.query(City.name, City.state). \
+        join(Person, Person.city_id == City.id)
+    if shard_count > 1:
+        query = query.filter(Person.in_shard(shard_index, shard_count))
+    if states is not None:
+        query = query.filter(City.state.in_(states))
+    return query.group_by(City.id, City.name, City.state). \
+        order_by(func.count(Person.id).desc(), City.id).all()
+
+
+def load_city_forecasts(shard_index=0, shard_count=1, states=None):
+    """Returns the forecasts of the cities subscribed to in a shard, from
+    the source selected by FORECAST_SOURCE.
+
+    Notes:
+        'api' prefetches them from the weather provider through the forecast
+            cache. 'snapshot' reads them from the forecast snapshot table
+            kept fresh by refresh_forecasts, in one query and without any
+            network call.
+
+    Args:
+        shard_index (int): only consider subscribers of this shard.
+            Defaults to 0.
+        shard_count (int): number of shards subscribers are split into.
+            Defaults to 1.
+        states (list): only consider the cities of these states.
+            Defaults to None meaning every state.
+
+    Returns:
+        CityForecasts instance
+
+    Raises:
+        AppError: If the forecast source is unknown.
+    """
+    source = app.config['FORECAST_SOURCE']
+    forecasts = CityForecasts.from_config(app)
+    if source == 'api':
+        forecasts.prefetch(get_subscribed_cities(shard_index, shard_count,
+                                                 states))
+    elif source == 'snapshot':
+        forecasts.use_snapshots(get_city_snapshots(shard_index, shard_count,
+                                                   states),
+                                app.config['FORECAST_SNAPSHOT_TTL'])
+    else:
+        raise AppError('Unknown forecast source.', ValueError(source))
+    return forecasts
+
+
+def prefetch_forecasts(api_key, locations, concurrency=10):
+    """Fetches the forecast of every location up front.
+
+    Notes:
+        Locations missing from the forecast cache are fetched once, in
+            batches of as many locations as the weather provider takes per
+            request and at most 'concurrency' requests at a time, instead of
+            one blocking request the first time each city comes up in the
+            subscriber loop.
+        See CityForecasts for the order locations are fetched in and what
+            happens to the ones that fail, which are left out.
+
+    Args:
+        api_key (str): weather API key.
+        locations (list): 2 element (city, state) tuples.
+        concurrency (int): max number of requests in flight.
+            Defaults to 10.
+
+    Returns:
+        dict mapping (city, state) tuples to Forecast instances
+    """
+    city_forecasts = CityForecasts(api_key, concurrency=concurrency)
+    city_forecasts.prefetch(locations)
+    return city_forecasts.forecasts
+
+
+class CityForecasts(object):
+    """Forecasts of the cities of a mailing run, fetched so a city that
+    fails only costs its own subscribers.
+
+    Notes:
+        Locations are fetched in the order given, a round of 'concurrency'
+            requests at a time, so with get_subscribed_cities() the cities
+            with the most subscribers get the weather API quota first. Once
+            the rate limiter refuses a request the remaining locations are
+            not requested.
+        Failed cities are fetched again up to 'retries' times, waiting
+            backoff seconds before the first retry and twice as long before
+            each next one. Cities out of quota or behind an open circuit
+            breaker are not retried.
+        A city that still fails gets its last known good forecast from the
+            forecast cache if 'fallback' is set, and otherwise no forecast,
+            its subscribers being skipped.
+        After use_snapshots() forecasts come from the snapshot table only
+            and cities without a snapshot are not fetched.
+
+    Attributes:
+        forecasts (dict): Forecast of each (city, state) tuple with one.
+        outcomes (dict): how the forecast of each city was got, 'fetched',
+            'retried', 'snapshot', 'last_known_good' or 'failed'.
+        errors (dict): last error of each city that failed at least once.
+        skipped (dict): number of subscribers skipped per city.
+    """
+    FETCHED = 'fetched'
+    RETRIED = 'retried'
+    SNAPSHOT = 'snapshot'
+    LAST_KNOWN_GOOD = 'last_known_good'
+    FAILED = 'failed'
+
+    def __init__(self, api_key, concurrency=10, retries=0, backoff=1.0,
+                 fallback=False):
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.fallback = fallback
+        self.forecasts = {}
+        self.outcomes = {}
+        self.errors = {}
+        self.skipped = {}
+        self.offline = False
+        self._ages = {}
+
+    @classmethod
+    def from_config(cls, app):
+        """Factory method returning CityForecasts set up from the FORECAST_*
+        values of the app config."""
+        return cls(app.config['API_KEY_WUNDERGROUND'],
+                   concurrency=app.config['FORECAST_PREFETCH_CONCURRENCY'],
+                   retries=app.config['FORECAST_CITY_RETRIES'],
+                   backoff=app.config['FORECAST_CITY_BACKOFF'],
+                   fallback=app.config['FORECAST_FALLBACK'] ==
+                   'last_known_good')
+
+    def prefetch(self, locations):
+        """Fetches the forecast of every location, retrying and falling back
+        as set up.
+
+        Args:
+            locations (list): 2 element (city, state) tuples.
+        """
+        pending = [location for location in dict.fromkeys(locations)
+                   if location not in self.outcomes]
+        failed = self._fetch_rounds(pending)
+        for attempt in range(self.retries):
+            failed = [location for location in failed
+                      if not _is_final(self.errors[location])]
+            if not failed:
+                break
+            time.sleep(self.backoff * (2 ** attempt))
+            failed = self._fetch_rounds(failed, self.RETRIED)
+        for location in pending:
+            if location not in self.outcomes:
+                self.fall_back(location, self.errors[location])
+        if self.errors:
+            app.logger.warning('No fresh forecast for %s of %s cities: %s',
+                               len(self.errors), len(pending),
+                               self.summary())
+
+    def use_snapshots(self, snapshots, max_age):
+        """Takes the forecasts of cities from their snapshots.
+
+        Notes:
+            Snapshots older than max_age seconds are used as last known
+                good forecasts if 'fallback' is set and they are younger
+                than the forecast cache's last_known_good_ttl. Cities
+                without a usable snapshot fall back as if their fetch had
+                failed.
+
+        Args:
+            snapshots (list): 5 element (city, state, temperature,
+                conditions, fetched_at) tuples, e.g. from
+                snapshots.get_city_snapshots().
+            max_age (int): seconds a snapshot is fresh for.
+        """
+        self.offline = True
+        now = datetime.utcnow()
+        for city, state, temperature, conditions, fetched_at in snapshots:
+            location = (city, state)
+            if fetched_at is None:
+                self.fall_back(location, _no_snapshot(location))
+                continue
+            forecast = Forecast(self.api_key)
+            forecast.temperature = temperature
+            forecast.conditions = conditions
+            age = (now - fetched_at).total_seconds()
+            if age <= max_age:
+                self.forecasts[location] = forecast
+                self.outcomes[location] = self.SNAPSHOT
+                continue
+            known = (forecast, age) if self.fallback and \
+                age < forecast_cache.last_known_good_ttl else None
+            self.fall_back(location, AppError(
+                'The forecast snapshot is stale.', ValueError(
+                    '{age:.0f}s old'.format(age=age))), known)
+
+    def get(self, city, state):
+        """Returns the forecast of a city, fetching it if it was not
+        prefetched, or None if it is unavailable."""
+        if (city, state) not in self.outcomes:
+            if self.offline:
+                self.fall_back((city, state), _no_snapshot((city, state)))
+            else:
+                self.prefetch([(city, state)])
+        return self.forecasts.get((city, state))
+
+    def record(self, location, forecast):
+        """Records a forecast fetched by the caller."""
+        self.forecasts[location] = forecast
+        self.outcomes[location] = self.RETRIED \
+            if location in self.errors else self.FETCHED
+
+    def fall_back(self, location, error, known=None):
+        """Records a city whose forecast could not be fetched, returning its
+        last known good forecast, or None if there is none or fallback is
+        off.
+
+        The last known good forecast is looked up in the forecast cache
+        unless the caller passes one in as a (Forecast, age) tuple."""
+        self.errors[location] = error
+        city, state = location
+        if known is None and self.fallback:
+            known = forecast_cache.last_known_good(self.api_key, state, city)
+        if known is None:
+            self.outcomes[location] = self.FAILED
+            app.logger.error('Skipping subscribers of %s, %s: %s', city,
+                             state, error)
+            return None
+        self.forecasts[location], self._ages[location] = known
+        self.outcomes[location] = self.LAST_KNOWN_GOOD
+        app.logger.warning('Using the %.0fs old forecast of %s, %s: %s',
+                           self._ages[location], city, state, error)
+        return self.forecasts[location]
+
+    def skip(self, location):
+        """Counts a subscriber skipped for want of a forecast."""
+        self.skipped[location] = self.skipped.get(location, 0) + 1
+
+    def summary(self):
+        """Returns the number of cities per outcome and the details of each
+        city that was not fetched at the first attempt."""
+        counts = {}
+        for outcome in self.outcomes.values():
+            counts[outcome] = counts.get(outcome, 0) + 1
+        cities = {}
+        for location, error in self.errors.items():
+            city = cities['{city}, {state}'.format(
+                city=location[0], state=location[1])] = {
+                'outcome': self.outcomes.get(location), 'error': str(error),
+                'skipped': self.skipped.get(location, 0)}
+            if location in self._ages:
+                city['age'] = round(self._ages[location])
+        return {'outcomes': counts, 'cities': cities}
+
+    def _fetch_rounds(self, locations, outcome=FETCHED):
+        """Fetches locations a round at a time, returning the failed ones."""
+        round_size = self.concurrency * forecast_cache.provider.batch_size
+        failed = []
+        for start in range(0, len(locations), round_size):
+            batch = locations[start:start + round_size]
+            forecasts, errors = forecast_cache.get_forecasts(
+                self.api_key, batch, self.concurrency)
+            for location, forecast in forecasts.items():
+                self.forecasts[location] = forecast
+                self.outcomes[location] = outcome
+            self.errors.update(errors)
+            failed.extend(errors)
+            quota_errors = [error for error in errors.values()
+                            if is_quota_error(error)]
+            if quota_errors:
+                for location in locations[start + round_size:]:
+                    self.errors[location] = quota_errors[0]
+                    failed.append(location)
+                break
+        return failed
+
+
+def _is_final(error):
+    """Returns whether retrying a failed city is pointless for now."""
+    return is_quota_error(error) or isinstance(error, CircuitOpen)
+
+
+def _no_snapshot(location):
+    return AppError('No forecast snapshot.', KeyError('{city}, {state}'.format(
+        city=location[0], state=location[1])))
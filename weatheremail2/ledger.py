@@ -0,0 +1,143 @@
+"""
+.. module:: ledger
+   :synopsis: Module containing the buffered writer of the send ledger that
+        records what each run of send_weather_emails delivered.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+from threading import Lock
+
+from sqlalchemy.exc import DataError, IntegrityError, SQLAlchemyError
+
+from weatheremail2 import app
+from .models import db, Person, SendLedger
+
+
+class SendLedgerWriter(object):
+    """Buffers send ledger rows and bulk inserts them in batches.
+
+    Notes:
+        record() is safe to call from the dispatcher's worker threads.
+            Rows are inserted with a single executemany per batch_size rows
+            and whatever is left is inserted when the 'with' block exits.
+        A batch the database rejects for a constraint (e.g. a person
+            deleted since) is split until the offending rows are found,
+            which are logged and dropped. A batch failing for another
+            reason is kept and retried with the next one rather than raised
+            into the dispatcher's worker, and the final flush logs what it
+            could not insert instead of raising, so the run's summary is
+            not lost.
+
+    Attributes:
+        run_id (str): id of the run rows are recorded for.
+        batch_size (int): number of rows inserted at a time.
+        counts (dict): number of rows recorded per status.
+        rejected (int): number of rows the database rejected.
+    """
+
+    def __init__(self, run_id, batch_size=1000):
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self.counts = {SendLedger.DELIVERED: 0, SendLedger.FAILED: 0,
+                       SendLedger.SKIPPED: 0, SendLedger.SPOOLED: 0}
+        self.rejected = 0
+        self._rows = []
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.flush()
+        except SQLAlchemyError as flush_exc:
+            with self._lock:
+                lost, self._rows = len(self._rows), []
+            app.logger.error('Unable to record %s send ledger rows of run %s: '
+                             '%s', lost, self.run_id, flush_exc)
+
+    def record(self, person_id, status):
+        """Adds a row to the buffer, inserting the batch once it is full.
+
+        Args:
+            person_id (int): id of the Person handled.
+            status (str): one of SendLedger.DELIVERED, FAILED, SKIPPED or
+                SPOOLED.
+        """
+        with self._lock:
+            self.counts[status] += 1
+            self._rows.append({'run_id': self.run_id, 'person_id': person_id,
+                               'status': status})
+            full = len(self._rows) >= self.batch_size
+        if full:
+            try:
+                self.flush()
+            except SQLAlchemyError as flush_exc:
+                app.logger.warning('Deferring send ledger rows of run %s: %s',
+                                   self.run_id, flush_exc)
+
+    def record_sent(self, person_id, delivered, refused=()):
+        """Dispatcher on_result callback recording a sent or failed email."""
+        self.record(person_id, SendLedger.DELIVERED if delivered and
+                    not refused else SendLedger.FAILED)
+
+    def record_group_sent(self, person_ids, delivered, refused=()):
+        """Dispatcher on_result callback recording a message sent to many
+        persons at once, as failed for the persons whose address the server
+        refused."""
+        refused_ids = set()
+        if delivered and refused:
+            refused_ids = {person_id for person_id, in db.session.query(
+                Person.id).filter(Person.id.in_(person_ids),
+                                  Person.email.in_(list(refused)))}
+        for person_id in person_ids:
+            self.record_sent(person_id, delivered and
+                             person_id not in refused_ids)
+
+    def record_skipped(self, person_ids):
+        """Records persons whose email could not be composed."""
+        for person_id in person_ids:
+            self.record(person_id, SendLedger.SKIPPED)
+
+    def record_spooled(self, person_ids):
+        """OutboxWriter on_result callback recording spooled emails."""
+        for person_id in person_ids:
+            self.record(person_id, SendLedger.SPOOLED)
+
+    def flush(self):
+        """Inserts the buffered rows, dropping the ones the database rejects.
+
+        Raises:
+            SQLAlchemyError: If the database failed for another reason. The
+                rows not inserted are kept for the next flush.
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+        retry, error = self._insert(rows)
+        if retry:
+            with self._lock:
+                self._rows = retry + self._rows
+            raise error
+
+    def _insert(self, rows):
+        """Inserts rows, splitting a rejected batch to drop the offending
+        rows, and returns the rows left to retry with the error."""
+        try:
+            db.engine.execute(SendLedger.__table__.insert(), rows)
+            return [], None
+        except (IntegrityError, DataError) as insert_exc:
+            if len(rows) == 1:
+                with self._lock:
+                    self.rejected += 1
+                app.logger.error('Dropping send ledger row %s rejected by the '
+                                 'database: %s', rows[0], insert_exc)
+                return [], None
+        except SQLAlchemyError as insert_exc:
+            return rows, insert_exc
+        middle = len(rows) // 2
+        first_retry, first_error = self._insert(rows[:middle])
+        retry, error = self._insert(rows[middle:])
+        return first_retry + retry, error or first_error
@@ -0,0 +1,110 @@
+"""
+.. module:: loaders
+   :synopsis: Module containing methods for bulk loading city/state data into
+        the database without disturbing existing subscribers.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import csv
+import io
+import time
+from itertools import islice
+
+from weatheremail2 import cache
+from .models import db, City
+
+CITIES_GENERATION_KEY = 'cities_generation'
+
+
+def load_cities(rows, batch_size=5000):
+    """Upserts city/state rows into the city table in batches.
+
+    Notes:
+        Rows are consumed batch_size at a time so files of any size load in
+            constant memory.
+        On PostgreSQL each batch is streamed with COPY into a temporary
+            table and merged with INSERT ... ON CONFLICT (name) DO UPDATE.
+            Other databases get one multi-row INSERT per batch for new
+            cities and an UPDATE for cities whose state changed.
+        Existing cities keep their id so persons referencing them are left
+            untouched. Cities are unique by name, so a later row with the
+            same name replaces the state of an earlier one.
+        Once loaded, the cities generation in the cache is bumped so the
+            cached city drop-down of every web server sharing the cache
+            backend is replaced.
+
+    Args:
+        rows: iterable of [city, state] lists, e.g. from get_city_data().
+        batch_size (int): number of rows written at a time.
+            Defaults to 5000.
+
+    Returns:
+        tuple of the number of rows loaded and the seconds it took
+
+    Raises:
+        SQLAlchemyError: If the database rejects a batch.
+    """
+    started = time.time()
+    upsert = _copy_batch if db.engine.dialect.name == 'postgresql' \
+        else _insert_batch
+    loaded = 0
+    cleaned = ((str(row[0]).strip(), str(row[1]).strip())
+               for row in rows if len(row) >= 2 and str(row[0]).strip())
+    while True:
+        # dict keeps the last state given for a name within the batch
+        batch = dict(islice(cleaned, batch_size))
+        if not batch:
+            break
+        upsert(batch)
+        loaded += len(batch)
+    bump_cities_generation()
+    return loaded, time.time() - started
+
+
+def cities_generation():
+    """Returns the token of the current city data, changed by every load."""
+    return cache.get(CITIES_GENERATION_KEY) or '0'
+
+
+def bump_cities_generation():
+    """Starts a new generation of city data, so the cache entries keyed on
+    the previous one are no longer used."""
+    cache.set(CITIES_GENERATION_KEY, '{0:.6f}'.format(time.time()),
+              timeout=0)
+
+
+def _copy_batch(batch):
+    """Loads a batch through COPY and merges it into city on PostgreSQL."""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(batch.items())
+    buf.seek(0)
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('CREATE TEMP TABLE city_load (name varchar(120), '
+                       'state varchar(2)) ON COMMIT DROP')
+        cursor.copy_expert('COPY city_load (name, state) FROM STDIN '
+                           'WITH (FORMAT csv)', buf)
+        cursor.execute('INSERT INTO city (name, state) '
+                       'SELECT name, state FROM city_load '
+                       'ON CONFLICT (name) DO UPDATE SET state = '
+                       'EXCLUDED.state WHERE city.state <> EXCLUDED.state')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _insert_batch(batch):
+    """Upserts a batch with a multi-row INSERT on other databases."""
+    existing = dict(db.session.query(City.name, City.state).
+                    filter(City.name.in_(list(batch))).all())
+    new_rows = [{'name': name, 'state': state}
+                for name, state in batch.items() if name not in existing]
+    if new_rows:
+        db.session.execute(City.__table__.insert().values(new_rows))
+    for name, state in batch.items():
+        if name in existing and existing[name] != state:
+            db.session.query(City).filter(City.name == name). \
+                update({'state': state}, synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,338 @@
+"""
+.. module:: mailing
+   :synopsis: Module containing the weather email pipeline run by the
+        send_weather_emails command, optionally split into shards run by
+        several processes or machines.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import time
+from multiprocessing import Pool
+
+from sqlalchemy import and_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.exc import NoResultFound
+
+from weatheremail2 import app, forecast_cache, http_client, metrics
+from .app_error import AppError
+from .dispatcher import EmailDispatcher
+from .emails import (WeatherEmailRenderer, build_group_weather_email,
+                     dispatch_email, send_weather_email)
+from .forecasts import load_city_forecasts
+from .ledger import SendLedgerWriter
+from .outbox import Outbox, OutboxWriter
+from .models import db, City, Person, SendLedger
+from .utils import get_username_from_email
+
+
+def run_weather_emails(shard_index=0, shard_count=1, run_id=None,
+                       resume=False, states=None):
+    """Sends the weather email of every subscriber in a shard.
+
+    Notes:
+        Subscribers are partitioned by Person.id modulo shard_count, so
+            running every shard_index from 0 to shard_count - 1 (in any
+            number of processes or on any number of machines) emails each
+            subscriber exactly once.
+        Progress is logged every SEND_PROGRESS_INTERVAL subscribers.
+        The summary times each stage (database fetches, forecasts, renders
+            and SMTP sends) and the stage histograms are saved for the
+            /metrics route.
+        The email template is rendered once per city and forecast rather
+            than once per subscriber.
+        A city whose forecast can not be fetched only costs its own
+            subscribers: it is retried FORECAST_CITY_RETRIES times, then
+            served its last known good forecast (FORECAST_FALLBACK) or
+            skipped, and its outcome is reported under 'forecasts' in the
+            summary.
+        With FORECAST_SOURCE = 'snapshot' forecasts are read from the
+            forecast snapshot table instead of the weather API, so the run
+            makes no API calls.
+        With EMAIL_RECIPIENTS_PER_MESSAGE above 1 subscribers are streamed
+            ordered by city and each city's subscribers get one message per
+            EMAIL_RECIPIENTS_PER_MESSAGE of them, sent in one SMTP
+            transaction with a RCPT TO per recipient. Those messages greet
+            the recipients generically instead of by username.
+        With EMAIL_DELIVERY = 'outbox' the rendered messages are spooled to
+            the outbox in OUTBOX_DIR instead of being sent, and recorded as
+            spooled in the send ledger, for deliver_outbox to deliver.
+        If a run_id is given, whether each subscriber's email was
+            delivered, failed or skipped (no forecast for their city) is
+            written to the send ledger in batches of SEND_LEDGER_BATCH_SIZE.
+            Resuming a run skips the subscribers it already delivered to.
+
+    Args:
+        shard_index (int): shard to send, from 0 to shard_count - 1.
+            Defaults to 0.
+        shard_count (int): number of shards subscribers are split into.
+            Defaults to 1.
+        run_id (str): id the run is recorded under in the send ledger.
+            Defaults to None meaning nothing is recorded.
+        resume (bool): skip subscribers the run already delivered to.
+            Defaults to False.
+        states (list): only send the subscribers of cities in these states,
+            e.g. the states of one time zone.
+            Defaults to None meaning every state.
+
+    Returns:
+        dict summarizing the run of the shard
+
+    Raises:
+       AppError, SQLAlchemyError: If the forecast source is unknown or
+        database data is unavailable.
+    """
+    shard = '{index}/{count}'.format(index=shard_index, count=shard_count)
+    sender = app.config['MAIL_USERNAME']
+    progress_interval = app.config['SEND_PROGRESS_INTERVAL']
+    http_client.reset_budget()
+    snapshot = metrics.snapshot()
+    forecasts = load_city_forecasts(shard_index, shard_count, states)
+    app.logger.info('Shard %s loaded %s forecasts: %s, cache %s, '
+                    'breaker %s', shard, len(forecasts.forecasts),
+                    http_client.stats(), forecast_cache.stats(),
+                    forecast_cache.provider.breaker.stats())
+    group_size = app.config['EMAIL_RECIPIENTS_PER_MESSAGE']
+    queued = skipped = 0
+    next_progress = progress_interval
+    renderer = WeatherEmailRenderer()
+    ledger = SendLedgerWriter(run_id, app.config['SEND_LEDGER_BATCH_SIZE'])
+    delivery = app.config['EMAIL_DELIVERY']
+    if delivery == 'outbox':
+        sink = OutboxWriter(Outbox.from_config(app), run_id,
+                            ledger.record_spooled if run_id else None)
+    elif delivery == 'direct':
+        on_result = None
+        if run_id:
+            on_result = ledger.record_group_sent if group_size > 1 \
+                else ledger.record_sent
+        sink = EmailDispatcher.from_config(app, on_result)
+    else:
+        raise AppError('Unknown email delivery.', ValueError(delivery))
+    with ledger, sink:
+        for person_ids, emails, city, state in group_subscribers(
+                get_user_data(shard_index=shard_index,
+                              shard_count=shard_count,
+                              skip_run_id=run_id if resume else None,
+                              order_by_city=group_size > 1,
+                              states=states), group_size):
+            forecast = forecasts.get(city, state)
+            if forecast is None:
+                for person_id in person_ids:
+                    forecasts.skip((city, state))
+                    skipped += 1
+                    if run_id:
+                        ledger.record(person_id, SendLedger.SKIPPED)
+                continue
+            temp = forecast.temperature
+            cond = forecast.conditions
+            if group_size > 1:
+                dispatch_email(build_group_weather_email(
+                    sender, emails, cond, city, state, temp, renderer),
+                    sink, tag=person_ids)
+            else:
+                username = get_username_from_email(emails[0])
+                send_weather_email(sender, emails[0], username, cond,
+                                   city, state, temp, dispatcher=sink,
+                                   tag=person_ids[0], renderer=renderer)
+            queued += len(person_ids)
+            if queued >= next_progress:
+                next_progress += progress_interval
+                app.logger.info('Shard %s queued %s emails: %s', shard,
+                                queued, sink.stats())
+    summary = {'shard': shard, 'run_id': run_id, 'queued': queued,
+               'skipped': skipped, 'renders': renderer.renders,
+               'forecasts': forecasts.summary()}
+    summary.update(sink.stats())
+    forecast_cache.wait_for_refreshes(app.config['FORECAST_REFRESH_TIMEOUT'])
+    summary['timings'] = record_run_metrics(shard_index, shard_count,
+                                            snapshot, run_id)
+    app.logger.info('Shard %s finished: %s', shard, summary)
+    return summary
+
+
+def record_run_metrics(shard_index, shard_count, snapshot, run_id=None):
+    """Saves the stage histograms of a shard's run for the /metrics route
+    and returns their summary.
+
+    Args:
+        shard_index (int): shard that was sent.
+        shard_count (int): number of shards subscribers are split into.
+        snapshot (dict): metrics.snapshot() taken when the run started.
+        run_id (str): id the run is recorded under in the send ledger.
+
+    Returns:
+        dict of the count, total, average, p50 and p99 seconds of each stage
+    """
+    run = metrics.since(snapshot)
+    try:
+        metrics.write_run(shard_index, shard_count, run, run_id)
+    except OSError as write_exc:
+        app.logger.error('Unable to save the metrics of shard %s/%s: %s',
+                         shard_index, shard_count, write_exc)
+    return metrics.summarize(run)
+
+
+def run_sharded(processes, shard_index=0, shard_count=1, run_id=None,
+                resume=False, runner=run_weather_emails):
+    """Splits a shard into sub shards sent by a pool of local processes.
+
+    Notes:
+        Sub shard p of the pool covers Person.id modulo
+            (shard_count * processes) equal to shard_index + p * shard_count,
+            which together are exactly the ids of the original shard.
+        Children are forked from this process so each one disposes of the
+            inherited database connections before using its own.
+
+    Args:
+        processes (int): number of worker processes.
+        shard_index (int): shard this machine is responsible for.
+            Defaults to 0.
+        shard_count (int): number of shards across all machines.
+            Defaults to 1.
+        run_id (str): id the run is recorded under in the send ledger.
+            Defaults to None.
+        resume (bool): skip subscribers the run already delivered to.
+            Defaults to False.
+        runner: function sending a shard, i.e. run_weather_emails() or the
+            asyncio engine's run_async_weather_emails().
+            Defaults to run_weather_emails.
+
+    Returns:
+        list of the summaries of each sub shard
+    """
+    total = shard_count * processes
+    sub_shards = [(runner, shard_index + p * shard_count, total, run_id,
+                   resume) for p in range(processes)]
+    with Pool(processes) as pool:
+        return pool.starmap(_run_shard_process, sub_shards)
+
+
+def _run_shard_process(runner, shard_index, shard_count, run_id, resume):
+    """Entry point of a child process started by run_sharded()."""
+    db.engine.dispose()
+    with app.app_context():
+        try:
+            return runner(shard_index, shard_count, run_id, resume)
+        except (SQLAlchemyError, AppError) as shard_exc:
+            app.logger.error('An error occurred while sending shard %s/%s: '
+                             '%s', shard_index, shard_count, shard_exc)
+            return {'shard': '{index}/{count}'.format(index=shard_index,
+                                                      count=shard_count),
+                    'error': str(shard_exc)}
+
+
+def group_subscribers(rows, size):
+    """Groups consecutive subscribers of the same city.
+
+    Args:
+        rows: iterable of (person_id, email, city, state) tuples, e.g. from
+            get_user_data().
+        size (int): max number of subscribers per group.
+
+    Returns:
+        Generator of (person_ids, emails, city, state) tuples
+    """
+    group = None
+    for person_id, email, city, state in rows:
+        if group is None or group[2:] != (city, state) or \
+                len(group[0]) == size:
+            if group is not None:
+                yield group
+            group = ([], [], city, state)
+        group[0].append(person_id)
+        group[1].append(email)
+    if group is not None:
+        yield group
+
+
+def get_user_data(fetch_size=None, shard_index=0, shard_count=1,
+                  skip_run_id=None, order_by_city=False, states=None):
+    """Generator method returning person ids, email addresses and associated
+        city and state data.
+
+    Notes:
+        Only the id, email, name and state columns are selected and rows are
+            streamed through a server side cursor fetch_size rows at a time
+            (yield_per turns on stream_results), so memory stays flat and
+            the first row is available without loading the whole table.
+        Persons a run already delivered or spooled to are excluded with an
+            anti-join (outer join to the send ledger keeping unmatched
+            rows).
+        The time spent fetching each fetch_size rows is recorded in the
+            db_fetch histogram.
+
+    Args:
+        fetch_size (int): rows fetched from the cursor at a time.
+            Defaults to SUBSCRIBER_FETCH_SIZE.
+        shard_index (int): only return subscribers of this shard.
+            Defaults to 0.
+        shard_count (int): number of shards subscribers are split into.
+            Defaults to 1.
+        skip_run_id (str): exclude persons this run delivered or spooled
+            to.
+            Defaults to None.
+        order_by_city (bool): return the subscribers of a city one after
+            the other, ordered by Person.city_id.
+            Defaults to False.
+        states (list): only return subscribers of cities in these states.
+            Defaults to None meaning every state.
+
+    Returns:
+       Generator of 4 element tuples
+
+    Raises:
+       AppError: If no results from database occurs
+
+    """
+    if fetch_size is None:
+        fetch_size = app.config['SUBSCRIBER_FETCH_SIZE']
+    query = db.session.query(Person.id, Person.email, City.name,
+                             City.state). \
+        join(City, Person.city_id == City.id)
+    if shard_count > 1:
+        query = query.filter(Person.in_shard(shard_index, shard_count))
+    if states is not None:
+        query = query.filter(City.state.in_(states))
+    if skip_run_id is not None:
+        query = query.outerjoin(SendLedger, and_(
+            SendLedger.person_id == Person.id,
+            SendLedger.run_id == skip_run_id,
+            SendLedger.status.in_([SendLedger.DELIVERED,
+                                   SendLedger.SPOOLED]))). \
+            filter(SendLedger.id.is_(None))
+    if order_by_city:
+        query = query.order_by(Person.city_id, Person.id)
+    rows = query.yield_per(fetch_size)
+    if metrics.enabled:
+        rows = _timed_fetches(rows, fetch_size)
+    try:
+        for person_id, email, city, state in rows:
+            yield person_id, email, city, state
+    except NoResultFound as nrf:
+        raise AppError(
+            'No user data was returned from the database for which to send '
+            'weather emails: %s',
+            nrf)
+
+
+def _timed_fetches(rows, fetch_size):
+    """Yields rows, observing the seconds spent fetching every fetch_size of
+    them while leaving out the time the caller spends on each row."""
+    rows = iter(rows)
+    fetched = 0
+    elapsed = 0.0
+    while True:
+        started = time.perf_counter()
+        row = next(rows, None)
+        elapsed += time.perf_counter() - started
+        if row is None:
+            break
+        fetched += 1
+        if fetched == fetch_size:
+            metrics.db_fetch.observe(elapsed)
+            fetched = 0
+            elapsed = 0.0
+        yield row
+    if fetched:
+        metrics.db_fetch.observe(elapsed)
@@ -0,0 +1,404 @@
+"""
+.. module:: metrics
+   :synopsis: Module containing the latency histograms of the mailing
+        pipeline stages and their Prometheus text exposition.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import glob
+import json
+import os
+import time
+from threading import Lock
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0,
+               3600.0)
+
+
+class _NullTimer(object):
+    """Timer handed out by disabled histograms, which does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    """Observes the seconds spent in its 'with' block."""
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started,
+                               *self.label_values)
+        return False
+
+
+class Histogram(object):
+    """Counts observed durations (or sizes) in cumulative buckets, per label
+    values.
+
+    Attributes:
+        name (str): metric name, ending in its unit, e.g. _seconds.
+        help (str): description shown in the exposition.
+        label_names (tuple): names of the labels of each series.
+        buckets (tuple): upper bounds of the buckets, in the unit observed.
+        enabled (bool): whether observations are recorded.
+    """
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.enabled = True
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, seconds, *label_values):
+        """Records a duration in the series of the given label values."""
+        if not self.enabled:
+            return
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {
+                    'buckets': [0] * len(self.buckets), 'count': 0,
+                    'sum': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['count'] += 1
+            series['sum'] += seconds
+
+    def time(self, *label_values):
+        """Returns a context manager observing the duration of its block."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, label_values)
+
+    def state(self):
+        """Returns a copy of every series keyed by label values."""
+        with self._lock:
+            return {labels: {'buckets': list(series['buckets']),
+                             'count': series['count'], 'sum': series['sum']}
+                    for labels, series in self._series.items()}
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+
+class Metrics(object):
+    """Registry of the histograms timing each stage of the mailing run.
+
+    Notes:
+        Recording is turned off with METRICS_ENABLED = False, leaving one
+            attribute check per timed operation.
+        A mailing run usually happens in a command line process rather than
+            the web server, so when METRICS_RUN_DIR is set each shard writes
+            the histograms of its latest run there and the /metrics route
+            exports them next to those of the serving process.
+
+    Attributes:
+        db_fetch: seconds to fetch each SUBSCRIBER_FETCH_SIZE subscriber rows.
+        forecast_fetch: seconds to get a forecast, labeled by whether the
+            forecast cache had it ('hit'), had it stale ('stale'), it was
+            requested from the weather API ('miss') or the caller waited for
+            another caller's request ('coalesced').
+        render: seconds to render the body of one email.
+        smtp_send: seconds to hand one email to the SMTP server.
+        signup_flush: seconds to insert a batch of buffered signups.
+        signup_flush_rows: number of signups in each inserted batch.
+        scheduled_job: seconds a job of the scheduler took, labeled by job
+            ('refresh' or 'send').
+        scheduled_job_lateness: seconds a job of the scheduler started
+            after it was due, labeled by job.
+        enabled (bool): whether observations are recorded.
+        run_dir (str): directory per shard run histograms are written to.
+    """
+
+    def __init__(self, app=None):
+        self.db_fetch = Histogram(
+            'weatheremail2_db_fetch_seconds',
+            'Seconds to fetch a batch of subscriber rows.')
+        self.forecast_fetch = Histogram(
+            'weatheremail2_forecast_fetch_seconds',
+            'Seconds to get the forecast of a city.', ('result',))
+        self.render = Histogram(
+            'weatheremail2_render_seconds',
+            'Seconds to render the body of a weather email.')
+        self.smtp_send = Histogram(
+            'weatheremail2_smtp_send_seconds',
+            'Seconds to send a weather email over SMTP.')
+        self.signup_flush = Histogram(
+            'weatheremail2_signup_flush_seconds',
+            'Seconds to insert a batch of buffered signups.')
+        self.signup_flush_rows = Histogram(
+            'weatheremail2_signup_flush_rows',
+            'Number of buffered signups inserted per batch.',
+            buckets=ROW_BUCKETS)
+        self.scheduled_job = Histogram(
+            'weatheremail2_scheduled_job_seconds',
+            'Seconds a scheduled job took.', ('job',), buckets=JOB_BUCKETS)
+        self.scheduled_job_lateness = Histogram(
+            'weatheremail2_scheduled_job_lateness_seconds',
+            'Seconds a scheduled job started after it was due.', ('job',),
+            buckets=JOB_BUCKETS)
+        self.histograms = (self.db_fetch, self.forecast_fetch, self.render,
+                           self.smtp_send, self.signup_flush,
+                           self.signup_flush_rows, self.scheduled_job,
+                           self.scheduled_job_lateness)
+        self.enabled = True
+        self.run_dir = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Initializes the registry from the METRICS_* settings of the app.
+
+        Args:
+            app: Flask application instance
+        """
+        self.enabled = app.config['METRICS_ENABLED']
+        self.run_dir = app.config['METRICS_RUN_DIR']
+        for histogram in self.histograms:
+            histogram.enabled = self.enabled
+            histogram.reset()
+
+    def snapshot(self):
+        """Returns the state of every histogram keyed by metric name."""
+        return {histogram.name: histogram.state()
+                for histogram in self.histograms}
+
+    def since(self, snapshot):
+        """Returns the observations made since a snapshot was taken."""
+        delta = {}
+        for name, series in self.snapshot().items():
+            before = snapshot.get(name, {})
+            delta[name] = {}
+            for labels, values in series.items():
+                old = before.get(labels)
+                if old is None:
+                    delta[name][labels] = values
+                elif values['count'] > old['count']:
+                    delta[name][labels] = {
+                        'buckets': [new - prev for new, prev in
+                                    zip(values['buckets'], old['buckets'])],
+                        'count': values['count'] - old['count'],
+                        'sum': values['sum'] - old['sum']}
+        return delta
+
+    def summarize(self, state):
+        """Returns count, total, average and approximate p50/p99 seconds of
+        each series of a snapshot, e.g. for the summary of a run."""
+        summary = {}
+        for histogram in self.histograms:
+            for labels, series in state.get(histogram.name, {}).items():
+                if not series['count']:
+                    continue
+                key = '_'.join((_short_name(histogram.name),) + labels)
+                summary[key] = {
+                    'count': series['count'],
+                    'total': round(series['sum'], 6),
+                    'avg': round(series['sum'] / series['count'], 6),
+                    'p50': _quantile(histogram.buckets, series, 0.5),
+                    'p99': _quantile(histogram.buckets, series, 0.99)}
+        return summary
+
+    def write_run(self, shard_index, shard_count, state, run_id=None):
+        """Saves the histograms of a shard's run to METRICS_RUN_DIR, if set,
+        and removes the runs saved with another shard_count.
+
+        Raises:
+            OSError: If the file can not be written.
+        """
+        if not (self.enabled and self.run_dir):
+            return
+        os.makedirs(self.run_dir, exist_ok=True)
+        name = 'shard_{index}_of_{count}.json'.format(index=shard_index,
+                                                      count=shard_count)
+        encoded = {name: [{'labels': list(labels), 'buckets': series['buckets'],
+                           'count': series['count'], 'sum': series['sum']}
+                          for labels, series in state_series.items()]
+                   for name, state_series in state.items()}
+        with open(os.path.join(self.run_dir, name), 'w') as run_file:
+            json.dump({'run_id': run_id, 'shard_index': shard_index,
+                       'shard_count': shard_count, 'histograms': encoded},
+                      run_file)
+        suffix = '_of_{count}.json'.format(count=shard_count)
+        for path in glob.glob(os.path.join(self.run_dir, 'shard_*.json')):
+            if not path.endswith(suffix):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+
+    def load_runs(self):
+        """Returns the histograms saved by the latest run of each shard of
+        the latest shard layout.
+
+        Returns:
+            list of dicts with the 'run_id', 'shard_index', 'shard_count',
+            'shard' ('index/count') and 'state' of each run
+        """
+        runs = []
+        if not (self.enabled and self.run_dir):
+            return runs
+        paths = glob.glob(os.path.join(self.run_dir, 'shard_*.json'))
+        for path in sorted(paths, key=_modified, reverse=True):
+            try:
+                with open(path) as run_file:
+                    saved = json.load(run_file)
+                shard_index = int(saved['shard_index'])
+                shard_count = saved['shard_count']
+                state = {}
+                for name, series_list in saved['histograms'].items():
+                    for series in series_list:
+                        _add_series(state.setdefault(name, {}),
+                                    tuple(series['labels']), series)
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            if runs and shard_count != runs[0]['shard_count']:
+                continue
+            runs.append({'run_id': saved.get('run_id'),
+                         'shard_index': shard_index,
+                         'shard_count': shard_count,
+                         'shard': '{index}/{count}'.format(
+                             index=shard_index,
+                             count=shard_count),
+                         'state': state})
+        return sorted(runs, key=lambda run: run['shard_index'])
+
+    def render_prometheus(self):
+        """Returns every histogram of this process in the Prometheus text
+        format, followed by the latest run of each shard saved to
+        METRICS_RUN_DIR.
+
+        Notes:
+            The saved runs are exported as histograms of their own, named
+                weatheremail2_last_run_* and labeled with the shard and
+                run_id, rather than added into the histograms of this
+                process, so those counters never go down when a run is
+                replaced by a smaller one.
+        """
+        lines = []
+        state = self.snapshot()
+        for histogram in self.histograms:
+            lines.extend(_exposition(histogram, histogram.name,
+                                     histogram.help, [
+                                         ([], state.get(histogram.name, {}))]))
+        runs = self.load_runs()
+        if runs:
+            for histogram in self.histograms:
+                lines.extend(_exposition(
+                    histogram, 'weatheremail2_last_run_' +
+                    histogram.name[len('weatheremail2_'):],
+                    histogram.help + ' Latest run of each shard.',
+                    [([('shard', run['shard']), ('run_id', run['run_id'] or '')],
+                      run['state'].get(histogram.name, {}))
+                     for run in runs]))
+        return '\n'.join(lines) + '\n'
+
+
+def _exposition(histogram, name, help_text, groups):
+    """Returns the exposition lines of a histogram family.
+
+    Args:
+        histogram (Histogram): histogram the series were observed by.
+        name (str): name of the metric family.
+        help_text (str): description of the metric family.
+        groups (list): tuples of the extra (name, value) labels and the
+            series (by label values) they apply to.
+
+    Returns:
+        list of str
+    """
+    lines = ['# HELP {name} {help}'.format(name=name, help=help_text),
+             '# TYPE {name} histogram'.format(name=name)]
+    for extra, state in groups:
+        for labels, series in sorted(state.items()):
+            pairs = [_label(key, value) for key, value in
+                     extra + list(zip(histogram.label_names, labels))]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, series['buckets']):
+                cumulative += count
+                lines.append('{name}_bucket{{{labels}}} {value}'.format(
+                    name=name, labels=','.join(pairs + ['le="{0}"'.format(
+                        bound)]), value=cumulative))
+            lines.append('{name}_bucket{{{labels}}} {value}'.format(
+                name=name, labels=','.join(pairs + ['le="+Inf"']),
+                value=series['count']))
+            suffix = '{{{0}}}'.format(','.join(pairs)) if pairs else ''
+            lines.append('{name}_sum{suffix} {value}'.format(
+                name=name, suffix=suffix, value=series['sum']))
+            lines.append('{name}_count{suffix} {value}'.format(
+                name=name, suffix=suffix, value=series['count']))
+    return lines
+
+
+def _label(key, value):
+    """Returns a label pair with the value escaped for the text format."""
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"'). \
+        replace('\n', '\\n')
+    return '{key}="{value}"'.format(key=key, value=value)
+
+
+def _modified(path):
+    """Returns the modification time of a file, 0 if it is gone."""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _add_series(target, labels, series):
+    """Adds the observations of a series into a state dict."""
+    existing = target.get(labels)
+    if existing is None:
+        target[labels] = {'buckets': list(series['buckets']),
+                          'count': series['count'], 'sum': series['sum']}
+        return
+    existing['buckets'] = [a + b for a, b in zip(existing['buckets'],
+                                                 series['buckets'])]
+    existing['count'] += series['count']
+    existing['sum'] += series['sum']
+
+
+def _short_name(name):
+    """Returns a metric name without the app prefix and _seconds unit."""
+    name = name[len('weatheremail2_'):]
+    return name[:-len('_seconds')] if name.endswith('_seconds') else name
+
+
+def _quantile(buckets, series, quantile):
+    """Returns the upper bound of the bucket holding a quantile, or None if
+    it lies beyond the largest bucket."""
+    rank = quantile * series['count']
+    cumulative = 0
+    for bound, count in zip(buckets, series['buckets']):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return None
+
+
+metrics = Metrics()
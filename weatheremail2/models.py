@@ -6,11 +6,28 @@
 
 """
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.sql import func
 
 db = SQLAlchemy()
 
 
+def enable_sqlite_wal(engine):
+    """Puts the connections of a SQLite engine in WAL mode, so the send
+    ledger can be written while subscribers are still being streamed from
+    the same file, which the default rollback journal refuses with
+    'database is locked'. Other engines are left alone."""
+    if engine.dialect.name == 'sqlite' and \
+            not event.contains(engine, 'connect', _set_wal):
+        event.listen(engine, 'connect', _set_wal)
+
+
+def _set_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
 class Person(db.Model):
     """Person model.
 
@@ -33,6 +50,12 @@ class Person(db.Model):
     def __repr__(self):
         return '{email}'.format(email=self.email)
 
+    @classmethod
+    def in_shard(cls, shard_index, shard_count):
+        """Returns a filter criterion matching the persons of a shard when
+        persons are split into shard_count shards by id."""
+        return cls.id % shard_count == shard_index
+
 
 class City(db.Model):
     """City model.
@@ -46,3 +69,63 @@ class City(db.Model):
 
     def __repr__(self):
         return '{name}, {state}'.format(name=self.name, state=self.state)
+
+
+class ForecastSnapshot(db.Model):
+    """Forecast snapshot model.
+
+    Notes:
+        One row per city holding the last forecast fetched for it by
+            refresh_forecasts, so mailing runs can read forecasts with a
+            join instead of calling the weather API.
+        fetched_at is indexed so the rows older than the snapshot TTL can
+            be found without scanning the table.
+
+    Attributes are defined below.
+    """
+    __tablename__ = 'forecast_snapshot'
+    city_id = db.Column(db.Integer, db.ForeignKey('city.id'),
+                        primary_key=True)
+    temperature = db.Column(db.Float, nullable=False)
+    conditions = db.Column(db.String(64), nullable=False)
+    fetched_at = db.Column(db.DateTime, index=True, nullable=False)
+
+    def __repr__(self):
+        return '{city_id}: {conditions} {temperature} at {fetched_at}'.format(
+            city_id=self.city_id, conditions=self.conditions,
+            temperature=self.temperature, fetched_at=self.fetched_at)
+
+
+class SendLedger(db.Model):
+    """Send ledger model.
+
+    Notes:
+        One row is written for each subscriber a run of
+            send_weather_emails handles, so a run that dies part way can be
+            resumed by skipping the persons already recorded as delivered.
+            Emails spooled to the outbox are recorded as spooled, and as
+            delivered or failed once deliver_outbox has handled them.
+        The composite index serves that anti-join on
+            (run_id, status, person_id).
+
+    Attributes are defined below.
+    """
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    SPOOLED = 'spooled'
+
+    __tablename__ = 'send_ledger'
+    __table_args__ = (db.Index('ix_send_ledger_run_status_person', 'run_id',
+                               'status', 'person_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.String(64), nullable=False)
+    person_id = db.Column(db.Integer, db.ForeignKey('person.id'),
+                          nullable=False)
+    status = db.Column(db.String(10), nullable=False)
+    time_created = db.Column(db.DateTime(timezone=True),
+                             server_default=func.now())
+
+    def __repr__(self):
+        return '{run_id}: {person_id} {status}'.format(
+            run_id=self.run_id, person_id=self.person_id, status=self.status)
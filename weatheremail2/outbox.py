@@ -0,0 +1,461 @@
+"""
+.. module:: outbox
+   :synopsis: Module containing the on-disk outbox rendered emails are
+        spooled to by send_weather_emails and delivered from by
+        deliver_outbox.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import json
+import os
+import time
+import uuid
+from threading import Lock
+
+from flask_mail import sanitize_address, sanitize_addresses
+from sqlalchemy.exc import SQLAlchemyError
+
+from .app_error import AppError
+from .dispatcher import EmailDispatcher
+from .ledger import SendLedgerWriter
+
+
+class OutboxEntry(object):
+    """Message claimed from the outbox.
+
+    Notes:
+        Quacks like a flask_mail.Message as far as Flask-Mail's
+            Connection.send() and the dispatcher are concerned, so a
+            spooled message is sent exactly as it was rendered.
+
+    Attributes:
+        name (str): file name of the entry.
+        sender (str): envelope sender.
+        send_to (list): envelope recipients.
+        tags (list): ids of the persons the message is for.
+        run_id (str): run the message was composed by, or None.
+        attempts (int): number of failed delivery attempts so far.
+        recovered (bool): whether the claim was found recovered before the
+            message was sent.
+    """
+
+    def __init__(self, name, envelope, data):
+        self.name = name
+        self.sender = envelope['sender']
+        self.send_to = envelope['recipients']
+        self.recipients = self.send_to
+        self.tags = envelope['tags']
+        self.run_id = envelope['run_id']
+        self.attempts = envelope['attempts']
+        self.recovered = False
+        self.date = time.time()
+        self.mail_options = []
+        self.rcpt_options = []
+        self._data = data
+
+    def send(self, connection):
+        connection.send(self)
+
+    def as_bytes(self):
+        return self._data
+
+    def has_bad_headers(self):
+        return False
+
+    def envelope(self):
+        return {'sender': self.sender, 'recipients': self.send_to,
+                'tags': self.tags, 'run_id': self.run_id,
+                'attempts': self.attempts}
+
+
+class Outbox(object):
+    """Maildir-style spool of rendered messages.
+
+    Notes:
+        A message is written to tmp/, fsynced and renamed into new/, so a
+            message in new/ is always complete. Each file holds a line of
+            JSON with the envelope (sender, recipients, the ids of the
+            persons it is for, the run id and the failed attempts) followed
+            by the MIME message.
+        File names start with the time the message is due, so listing new/
+            in order yields the messages that can be delivered first.
+        A deliverer claims a message by renaming it into cur/, which only
+            one of any number of deliverer threads or processes succeeds
+            at. Delivered messages are deleted, messages to retry are
+            renamed back into new/ under a later due time and messages
+            that failed every attempt are moved to failed/.
+        Claims older than claim_timeout seconds, left by a deliverer that
+            died, are returned to new/ by recover(). A deliverer touches a
+            claim right before sending it so a claim waiting in its queue
+            is not taken for a stale one.
+
+    Attributes:
+        directory (str): root directory of the outbox.
+        fsync (bool): whether messages are fsynced before being spooled.
+        claim_timeout (float): seconds after which a claim is stale.
+    """
+    TMP = 'tmp'
+    NEW = 'new'
+    CUR = 'cur'
+    FAILED = 'failed'
+
+    def __init__(self, directory, fsync=True, claim_timeout=600):
+        self.directory = directory
+        self.fsync = fsync
+        self.claim_timeout = claim_timeout
+        for folder in (self.TMP, self.NEW, self.CUR, self.FAILED):
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    @classmethod
+    def from_config(cls, app):
+        """Factory method returning the Outbox set up from the OUTBOX_*
+        values of the app config.
+
+        Raises:
+            AppError: If OUTBOX_DIR is not set.
+        """
+        directory = app.config['OUTBOX_DIR']
+        if not directory:
+            raise AppError('The outbox requires OUTBOX_DIR.',
+                           ValueError('OUTBOX_DIR'))
+        return cls(directory, app.config['OUTBOX_FSYNC'],
+                   app.config['OUTBOX_CLAIM_TIMEOUT'])
+
+    def put(self, msg, tags, run_id=None):
+        """Spools a message.
+
+        Args:
+            msg (flask_mail.Message): message to deliver.
+            tags (list): ids of the persons the message is for.
+            run_id (str): run the message is recorded under.
+                Defaults to None.
+
+        Returns:
+            str file name of the entry
+        """
+        if msg.date is None:
+            msg.date = time.time()
+        envelope = {'sender': sanitize_address(msg.sender),
+                    'recipients': list(sanitize_addresses(msg.send_to)),
+                    'tags': tags, 'run_id': run_id, 'attempts': 0}
+        return self._write(self._name(time.time()), envelope, msg.as_bytes())
+
+    def claim(self, limit=None):
+        """Claims the messages that are due, oldest first.
+
+        Args:
+            limit (int): max number of messages to claim.
+                Defaults to None meaning all of them.
+
+        Returns:
+            list of OutboxEntry instances
+        """
+        now = time.time()
+        claimed = []
+        for name in sorted(os.listdir(self._path(self.NEW))):
+            if limit is not None and len(claimed) >= limit:
+                break
+            if self._due(name) > now:
+                break
+            try:
+                os.rename(self._path(self.NEW, name),
+                          self._path(self.CUR, name))
+            except FileNotFoundError:
+                # claimed by another deliverer
+                continue
+            os.utime(self._path(self.CUR, name))
+            claimed.append(self._read(name))
+        return claimed
+
+    def touch(self, entry):
+        """Renews the claim on a message.
+
+        Raises:
+            FileNotFoundError: If the claim was recovered in the meantime.
+        """
+        os.utime(self._path(self.CUR, entry.name))
+
+    def complete(self, entry):
+        """Deletes a delivered message."""
+        os.remove(self._path(self.CUR, entry.name))
+
+    def retry(self, entry, delay):
+        """Puts a message whose delivery failed back, due in delay seconds."""
+        entry.attempts += 1
+        self._write(self._name(time.time() + delay), entry.envelope(),
+                    entry.as_bytes())
+        os.remove(self._path(self.CUR, entry.name))
+
+    def fail(self, entry):
+        """Moves a message that can not be delivered to failed/."""
+        entry.attempts += 1
+        self._write(entry.name, entry.envelope(), entry.as_bytes(),
+                    self.FAILED)
+        os.remove(self._path(self.CUR, entry.name))
+
+    def recover(self):
+        """Returns stale claims to new/, returning how many there were."""
+        recovered = 0
+        cutoff = time.time() - self.claim_timeout
+        for name in os.listdir(self._path(self.CUR)):
+            try:
+                if os.stat(self._path(self.CUR, name)).st_mtime < cutoff:
+                    os.rename(self._path(self.CUR, name),
+                              self._path(self.NEW, name))
+                    recovered += 1
+            except FileNotFoundError:
+                continue
+        return recovered
+
+    def requeue_failed(self):
+        """Moves the failed messages back to new/, due now, with their
+        attempts reset, returning how many there were."""
+        requeued = 0
+        for name in os.listdir(self._path(self.FAILED)):
+            entry = self._read(name, self.FAILED)
+            entry.attempts = 0
+            self._write(self._name(time.time()), entry.envelope(),
+                        entry.as_bytes())
+            os.remove(self._path(self.FAILED, name))
+            requeued += 1
+        return requeued
+
+    def stats(self):
+        """Returns the number of messages in each folder."""
+        return {folder: len(os.listdir(self._path(folder)))
+                for folder in (self.NEW, self.CUR, self.FAILED)}
+
+    def _write(self, name, envelope, data, folder=NEW):
+        tmp_path = self._path(self.TMP, name)
+        with open(tmp_path, 'wb') as spool_file:
+            spool_file.write(json.dumps(envelope).encode('utf-8') + b'\n')
+            spool_file.write(data)
+            if self.fsync:
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+        os.rename(tmp_path, self._path(folder, name))
+        return name
+
+    def _read(self, name, folder=CUR):
+        with open(self._path(folder, name), 'rb') as spool_file:
+            envelope = json.loads(spool_file.readline().decode('utf-8'))
+            return OutboxEntry(name, envelope, spool_file.read())
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    @staticmethod
+    def _name(due):
+        return '{due:017.6f}.{unique}'.format(due=due,
+                                              unique=uuid.uuid4().hex)
+
+    @staticmethod
+    def _due(name):
+        return float(name[:17])
+
+
+class OutboxWriter(object):
+    """Spools the messages of a mailing run to the outbox in place of an
+    EmailDispatcher.
+
+    Notes:
+        Takes messages through the same submit(msg, tag) as the dispatcher
+            and calls on_result with the list of person ids of each message
+            once it is spooled.
+
+    Attributes:
+        outbox (Outbox): outbox written to.
+        run_id (str): run the messages are recorded under.
+        on_result (callable): called with the person ids of each message.
+        spooled (int): number of recipients spooled.
+        messages (int): number of messages spooled.
+    """
+
+    def __init__(self, outbox, run_id=None, on_result=None):
+        self.outbox = outbox
+        self.run_id = run_id
+        self.on_result = on_result
+        self.spooled = 0
+        self.messages = 0
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def submit(self, msg, tag=None):
+        """Spools a message.
+
+        Args:
+            msg (flask_mail.Message): message to spool.
+            tag: id, or list of ids, of the persons the message is for.
+                Defaults to None.
+        """
+        tags = tag if isinstance(tag, list) else [tag]
+        self.outbox.put(msg, tags, self.run_id)
+        with self._lock:
+            self.spooled += len(msg.send_to)
+            self.messages += 1
+        if self.on_result is not None:
+            self.on_result(tags)
+
+    def stats(self):
+        """Returns the spooled counts for the run summary."""
+        return {'spooled': self.spooled, 'messages': self.messages}
+
+
+class OutboxDeliverer(object):
+    """Delivers the outbox with a pool of SMTP workers, retrying failures.
+
+    Notes:
+        Due messages are claimed up to the dispatcher's queue size at a time
+            and sent by an EmailDispatcher set up from the EMAIL_* settings,
+            so EMAIL_DISPATCH_WORKERS workers each keep a pooled SMTP
+            connection.
+        A failed message is retried up to max_attempts times, backoff
+            seconds after its first failure and twice as long after each
+            next one, and then moved to the outbox's failed/ folder.
+        The outcome of each person's email is written to the send ledger
+            of the run that composed it.
+        A message whose claim can not be settled, e.g. because another
+            deliverer's recover() took it back, is left to recover().
+        Stale claims are recovered when the deliverer starts and whenever
+            it finds the outbox empty, and a claim is touched right before
+            its message is sent.
+        Send ledger rows are flushed whenever the outbox is empty; rows a
+            flush fails to write are kept for the next one.
+
+    Attributes:
+        outbox (Outbox): outbox delivered.
+        max_attempts (int): delivery attempts of a message.
+        backoff (float): seconds before the first retry.
+        poll_interval (float): seconds between looks at an empty outbox.
+        delivered (int): number of messages delivered.
+        retried (int): number of failed attempts scheduled for a retry.
+        failed (int): number of messages given up on.
+    """
+
+    def __init__(self, app, outbox, workers=None, max_attempts=5, backoff=60,
+                 poll_interval=5):
+        self.app = app
+        self.outbox = outbox
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.delivered = self.retried = self.failed = 0
+        self._ledgers = {}
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, app, workers=None):
+        """Factory method returning a deliverer set up from the OUTBOX_*
+        values of the app config."""
+        return cls(app, Outbox.from_config(app), workers,
+                   app.config['OUTBOX_MAX_ATTEMPTS'],
+                   app.config['OUTBOX_RETRY_BACKOFF'],
+                   app.config['OUTBOX_POLL_INTERVAL'])
+
+    def run(self, once=False):
+        """Delivers messages as they become due.
+
+        Args:
+            once (bool): return once no message is due instead of polling
+                for more.
+                Defaults to False.
+
+        Returns:
+            dict summarizing the deliveries
+        """
+        started = time.perf_counter()
+        self._recover()
+        dispatcher = EmailDispatcher.from_config(self.app, self._on_result,
+                                                 self.workers, self._on_send)
+        with dispatcher:
+            while True:
+                entries = self.outbox.claim(dispatcher.queue_size)
+                if not entries:
+                    dispatcher.join()
+                    self._flush_ledgers()
+                    self._recover()
+                    entries = self.outbox.claim(dispatcher.queue_size)
+                    if not entries:
+                        if once:
+                            break
+                        time.sleep(self.poll_interval)
+                        continue
+                for entry in entries:
+                    dispatcher.submit(entry, tag=entry)
+        self._flush_ledgers()
+        elapsed = time.perf_counter() - started
+        summary = {'delivered': self.delivered, 'retried': self.retried,
+                   'failed': self.failed, 'reconnects': dispatcher.reconnects,
+                   'seconds': round(elapsed, 3),
+                   'per_second': round(self.delivered / elapsed, 1)
+                   if elapsed else None,
+                   'outbox': self.outbox.stats()}
+        self.app.logger.info('Outbox delivery finished: %s', summary)
+        return summary
+
+    def _recover(self):
+        recovered = self.outbox.recover()
+        if recovered:
+            self.app.logger.warning('Recovered %s stale outbox claims',
+                                    recovered)
+
+    def _on_send(self, entry):
+        """Dispatcher callback renewing a claim before its message is sent."""
+        try:
+            self.outbox.touch(entry)
+        except FileNotFoundError:
+            entry.recovered = True
+            raise
+
+    def _on_result(self, entry, delivered, refused=()):
+        """Dispatcher callback settling a message after an attempt."""
+        if entry.recovered:
+            # not sent, and back in new/ for whoever claims it next
+            return
+        try:
+            if delivered:
+                counter = 'delivered'
+                self.outbox.complete(entry)
+            elif entry.attempts + 1 < self.max_attempts:
+                counter = 'retried'
+                self.outbox.retry(entry, self.backoff * (2 ** entry.attempts))
+            else:
+                counter = 'failed'
+                self.outbox.fail(entry)
+        except OSError as settle_exc:
+            self.app.logger.error('Unable to settle outbox message %s, '
+                                  'leaving it to recover(): %s', entry.name,
+                                  settle_exc)
+            if not delivered:
+                return
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        if entry.run_id and counter != 'retried':
+            self._ledger(entry.run_id).record_group_sent(entry.tags,
+                                                         delivered, refused)
+
+    def _ledger(self, run_id):
+        with self._lock:
+            ledger = self._ledgers.get(run_id)
+            if ledger is None:
+                ledger = self._ledgers[run_id] = SendLedgerWriter(
+                    run_id, self.app.config['SEND_LEDGER_BATCH_SIZE'])
+            return ledger
+
+    def _flush_ledgers(self):
+        with self._lock:
+            ledgers = list(self._ledgers.values())
+        for ledger in ledgers:
+            try:
+                ledger.flush()
+            except SQLAlchemyError as flush_exc:
+                self.app.logger.error('Unable to flush the send ledger of run '
+                                      '%s, retrying later: %s', ledger.run_id,
+                                      flush_exc)
@@ -0,0 +1,118 @@
+"""
+.. module:: page_cache
+   :synopsis: Module containing the cache of rendered pages, which are
+        served with late CSRF token injection and conditional GET
+        validators, and the fingerprinting of static assets.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import hashlib
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+from flask import Response, request, session, url_for
+from flask_wtf.csrf import generate_csrf
+
+from weatheremail2 import app, cache
+
+IMMUTABLE_MAX_AGE = 31536000
+
+CachedPage = namedtuple('CachedPage', ['parts', 'digest', 'last_modified'])
+
+
+def cached_page_response(key, render, timeout=600):
+    """Returns a response serving a page from the cache, rendering it once.
+
+    Notes:
+        The page is cached split around the CSRF token it was rendered
+            with, so each request gets its own token joined back in without
+            rendering the template again.
+        The ETag covers the page and the session's CSRF token, and changes
+            every half WTF_CSRF_TIME_LIMIT so a revalidated copy never
+            carries an expired token. Requests with a matching
+            If-None-Match (or If-Modified-Since) get a 304 with no body.
+        Only use this for pages with nothing else per request in them,
+            e.g. no flashed messages.
+
+    Args:
+        key (str): cache key of the page, deleted to invalidate it.
+        render: function rendering the page.
+        timeout (int): seconds the page is cached for.
+            Defaults to 600.
+
+    Returns:
+        flask.Response
+    """
+    token = _csrf_token()
+    page = cache.get(key)
+    if page is None:
+        body = render()
+        parts = tuple(body.split(token)) if token else (body,)
+        page = CachedPage(parts,
+                          hashlib.sha1('\0'.join(parts).encode('utf-8')).
+                          hexdigest(),
+                          datetime.utcnow().replace(microsecond=0))
+        cache.set(key, page, timeout=timeout)
+    response = Response(token.join(page.parts))
+    response.set_etag(hashlib.sha1('{page}/{session}/{epoch}'.format(
+        page=page.digest, session=session.get(_csrf_field(), ''),
+        epoch=_token_epoch()).encode('utf-8')).hexdigest())
+    response.last_modified = page.last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+def _csrf_token():
+    if not app.config.get('WTF_CSRF_ENABLED', True):
+        return ''
+    return generate_csrf()
+
+
+def _csrf_field():
+    return app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+
+
+def _token_epoch():
+    time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if not time_limit:
+        return 0
+    return int(time.time() // max(1, time_limit // 2))
+
+
+@app.template_global()
+def static_url(filename):
+    """Returns the URL of a static file fingerprinted with a hash of its
+    content, so it can be cached by browsers for good.
+
+    Args:
+        filename (str): path of the file within the static folder.
+    """
+    path = os.path.join(app.static_folder, filename)
+    try:
+        fingerprint = _fingerprint(path, os.path.getmtime(path))
+    except OSError:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=fingerprint)
+
+
+@lru_cache(maxsize=256)
+def _fingerprint(path, mtime):
+    """Returns the content hash of a file, computed once per modification."""
+    with open(path, 'rb') as static_file:
+        return hashlib.md5(static_file.read()).hexdigest()[:12]
+
+
+@app.after_request
+def cache_fingerprinted_static(response):
+    """Lets browsers and proxies keep fingerprinted static files for a year,
+    since a changed file gets a new URL."""
+    if request.endpoint == 'static' and request.args.get('v') and \
+            response.status_code == 200:
+        response.headers['Cache-Control'] = \
+            'public, max-age={age}, immutable'.format(age=IMMUTABLE_MAX_AGE)
+    return response
@@ -0,0 +1,250 @@
+"""
+.. module:: providers
+   :synopsis: Module containing the weather providers forecasts are fetched
+        from, which fetch many locations per call, and their registry.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import quote
+
+from requests.exceptions import RequestException
+
+from .app_error import AppError
+from .breaker import CircuitBreaker, CircuitOpen
+from .webclient import http_client, is_transport_error
+from .wunderground import Forecast
+
+PROVIDERS = {}
+
+
+def register_provider(cls):
+    """Class decorator registering a WeatherProvider under its name, so it
+    can be selected with WEATHER_PROVIDER."""
+    PROVIDERS[cls.name] = cls
+    return cls
+
+
+def create_provider(app):
+    """Returns the weather provider selected by the WEATHER_PROVIDER setting
+    of the app.
+
+    Args:
+        app: Flask application instance
+
+    Returns:
+        WeatherProvider instance
+
+    Raises:
+        AppError: If the provider is unknown or misconfigured.
+    """
+    name = app.config['WEATHER_PROVIDER']
+    try:
+        cls = PROVIDERS[name]
+    except KeyError as ke_exc:
+        raise AppError('Unknown weather provider.', ke_exc)
+    return cls(app.config)
+
+
+class WeatherProvider(object):
+    """Base class of the weather providers.
+
+    Notes:
+        fetch_many() splits the locations into batches of batch_size and
+            fetches up to 'concurrency' batches at a time with
+            fetch_batch(), which subclasses implement. A provider whose API
+            takes one location per request has a batch_size of 1.
+        A failed batch only fails its own locations, and a location missing
+            from a batch's response only fails itself.
+        Batches go through a circuit breaker: after
+            FORECAST_BREAKER_THRESHOLD failed batches in a row the provider
+            is not called for FORECAST_BREAKER_COOLDOWN seconds and its
+            locations fail with CircuitOpen. Only failures to reach the
+            provider (connection errors, timeouts and 5xx responses) count:
+            running out of quota, an unknown city or an unparsable response
+            does not, so bad locations can not lock out the good ones.
+
+    Attributes:
+        name (str): name the provider is registered under.
+        batch_size (int): max number of locations per request.
+        requests (int): number of batches requested.
+        breaker (CircuitBreaker): breaker guarding the provider.
+    """
+    name = None
+    batch_size = 1
+
+    def __init__(self, config):
+        self._lock = Lock()
+        self.requests = 0
+        self.breaker = CircuitBreaker(
+            config.get('FORECAST_BREAKER_THRESHOLD', 5),
+            config.get('FORECAST_BREAKER_COOLDOWN', 60))
+
+    def fetch_many(self, api_key, locations, concurrency=1, on_batch=None):
+        """Fetches the forecasts of many locations.
+
+        Args:
+            api_key (str): weather API key.
+            locations (list): 2 element (city, state) tuples.
+            concurrency (int): max number of requests in flight.
+                Defaults to 1.
+            on_batch: function called with the dict of forecasts of each
+                batch as soon as it is fetched, so they are not lost if a
+                later batch fails.
+                Defaults to None.
+
+        Returns:
+            tuple of the dict mapping (city, state) tuples to Forecast
+            instances and the dict mapping the locations that could not be
+            retrieved to their AppError
+        """
+        locations = list(dict.fromkeys(locations))
+        batches = [locations[start:start + self.batch_size]
+                   for start in range(0, len(locations), self.batch_size)]
+        if concurrency > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(
+                    max_workers=min(concurrency, len(batches))) as executor:
+                results = list(executor.map(
+                    lambda batch: self._fetch(api_key, batch, on_batch),
+                    batches))
+        else:
+            results = [self._fetch(api_key, batch, on_batch)
+                       for batch in batches]
+        forecasts, errors = {}, {}
+        for batch_forecasts, batch_errors in results:
+            forecasts.update(batch_forecasts)
+            errors.update(batch_errors)
+        return forecasts, errors
+
+    def fetch_batch(self, api_key, locations):
+        """Fetches the forecasts of at most batch_size locations.
+
+        Args:
+            api_key (str): weather API key.
+            locations (list): 2 element (city, state) tuples.
+
+        Returns:
+            dict mapping (city, state) tuples to Forecast instances
+
+        Raises:
+            AppError: If the forecasts could not be retrieved.
+        """
+        raise NotImplementedError
+
+    def _fetch(self, api_key, batch, on_batch=None):
+        """Fetches a batch, returning its forecasts and errors."""
+        try:
+            self.breaker.allow()
+        except CircuitOpen as open_exc:
+            return {}, {location: open_exc for location in batch}
+        try:
+            with self._lock:
+                self.requests += 1
+            forecasts = self.fetch_batch(api_key, batch)
+        except AppError as batch_exc:
+            if is_transport_error(batch_exc):
+                self.breaker.record_failure()
+            else:
+                self.breaker.release()
+            return {}, {location: batch_exc for location in batch}
+        self.breaker.record_success()
+        forecasts = {location: forecasts[location] for location in batch
+                     if location in forecasts}
+        if on_batch is not None and forecasts:
+            on_batch(forecasts)
+        return forecasts, {
+            location: AppError('The weather provider returned no forecast.',
+                               KeyError('{city}, {state}'.format(
+                                   city=location[0], state=location[1])))
+            for location in batch if location not in forecasts}
+
+
+@register_provider
+class WundergroundProvider(WeatherProvider):
+    """Fetches each location with its own Wunderground API request."""
+    name = 'wunderground'
+
+    def fetch_batch(self, api_key, locations):
+        return {(city, state): Forecast.forecast_factory(api_key, state, city)
+                for city, state in locations}
+
+
+@register_provider
+class JSONBatchProvider(WeatherProvider):
+    """Fetches many locations per request from a JSON API.
+
+    Notes:
+        WEATHER_PROVIDER_URI is formatted with the api_key and the
+            url-encoded locations, joined as 'state/city;state/city', e.g.
+            'https://weather.example.com/current?key={api_key}&q={locations}'.
+        The response has a forecast object per location:
+            {"forecasts": [{"city": "Boston", "state": "MA",
+                            "temperature": 51.2, "conditions": "cloudy"}]}
+        Up to WEATHER_PROVIDER_BATCH_SIZE locations are sent per request.
+    """
+    name = 'json'
+
+    def __init__(self, config):
+        WeatherProvider.__init__(self, config)
+        self.uri = config['WEATHER_PROVIDER_URI']
+        if not self.uri:
+            raise AppError('The json weather provider requires '
+                           'WEATHER_PROVIDER_URI.',
+                           ValueError('WEATHER_PROVIDER_URI'))
+        self.batch_size = config['WEATHER_PROVIDER_BATCH_SIZE']
+
+    def fetch_batch(self, api_key, locations):
+        query = ';'.join('{state}/{city}'.format(state=state, city=city)
+                         for city, state in locations)
+        try:
+            uri = Forecast.build_api_uri(self.uri, {
+                'api_key': quote(api_key, safe=''),
+                'locations': quote(query, safe='')})
+            response = http_client.get(uri, label='{count} locations'.format(
+                count=len(locations)))
+            forecasts = {}
+            for item in json.loads(response.text)['forecasts']:
+                forecast = Forecast(api_key)
+                forecast.temperature = item['temperature']
+                forecast.conditions = item['conditions']
+                forecasts[(item['city'], item['state'])] = forecast
+            return forecasts
+        except (RequestException, AppError, KeyError, TypeError,
+                ValueError) as batch_exc:
+            raise AppError(
+                'An error occurred while accessing weather forecast API data.',
+                batch_exc)
+
+
+@register_provider
+class FakeProvider(WeatherProvider):
+    """Makes up a steady forecast for every location without any network
+    access, for tests and local development.
+
+    Attributes:
+        batches (list): the locations of each batch fetched.
+    """
+    name = 'fake'
+    CONDITIONS = ('clear', 'cloudy', 'partlycloudy', 'rain', 'snow', 'fog')
+
+    def __init__(self, config):
+        WeatherProvider.__init__(self, config)
+        self.batch_size = config['WEATHER_PROVIDER_BATCH_SIZE']
+        self.batches = []
+
+    def fetch_batch(self, api_key, locations):
+        with self._lock:
+            self.batches.append(list(locations))
+        forecasts = {}
+        for city, state in locations:
+            seed = zlib.crc32('{state}/{city}'.format(
+                state=state, city=city).encode('utf-8'))
+            forecast = Forecast(api_key)
+            forecast.temperature = float(seed % 1000) / 10
+            forecast.conditions = self.CONDITIONS[seed % len(self.CONDITIONS)]
+            forecasts[(city, state)] = forecast
+        return forecasts
@@ -0,0 +1,177 @@
+"""
+.. module:: ratelimit
+   :synopsis: Module containing the token bucket limiting weather API calls
+        to the provider's per minute and per day quotas, shared by threads
+        and optionally by processes.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import RLock
+
+from .app_error import AppError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class QuotaExceeded(AppError):
+    """Raised when a call would exceed the weather API quota."""
+
+
+def is_quota_error(exc):
+    """Returns whether an exception, or one it wraps, is a QuotaExceeded."""
+    while exc is not None:
+        if isinstance(exc, QuotaExceeded):
+            return True
+        exc = getattr(exc, 'original_exception', None)
+    return False
+
+
+class TokenBucket(object):
+    """Token bucket allowing per_minute calls a minute, in bursts of up to
+    burst calls, and at most per_day calls per UTC day.
+
+    Notes:
+        acquire() takes a token, sleeping until one is available. A caller
+            that would have to wait longer than max_wait seconds, or that
+            finds the day's quota used up, gets a QuotaExceeded instead.
+        The bucket is shared by the threads of a process. With a state_path
+            the tokens and the day's count are kept in that file, locked
+            with flock while they are updated, so every process on the host
+            draws from the same bucket.
+        A limit of None is not enforced.
+
+    Attributes:
+        per_minute (float): calls allowed per minute.
+        per_day (int): calls allowed per UTC day.
+        burst (float): max tokens the bucket holds.
+        max_wait (float): max seconds acquire() waits for a token.
+        state_path (str): file the bucket is kept in, or None.
+        acquired (int): number of tokens taken by this process.
+        waits (int): number of calls that had to wait for a token.
+        wait_time (float): seconds spent waiting for tokens.
+        rejected (int): number of calls refused.
+    """
+
+    def __init__(self, per_minute=None, per_day=None, burst=None,
+                 max_wait=60, state_path=None):
+        if state_path and fcntl is None:
+            raise AppError('Sharing the rate limit between processes '
+                           'requires fcntl.', ImportError('fcntl'))
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.burst = burst or per_minute or 1
+        self.max_wait = max_wait
+        self.state_path = state_path
+        self._lock = RLock()
+        self._state = None
+        self.reset_stats()
+
+    @property
+    def enabled(self):
+        return bool(self.per_minute or self.per_day)
+
+    def reset_stats(self):
+        """Zeroes the counters."""
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.rejected = 0
+
+    def stats(self):
+        """Returns the counters and the calls made today as a dict."""
+        with self._locked_state() as state:
+            used_today = state['used_today']
+        return {'acquired': self.acquired, 'waits': self.waits,
+                'wait_time': round(self.wait_time, 6),
+                'rejected': self.rejected, 'used_today': used_today}
+
+    def acquire(self):
+        """Takes a token, waiting for one if need be.
+
+        Raises:
+            QuotaExceeded: If the day's quota is used up or no token is
+                available within max_wait seconds.
+        """
+        if not self.enabled:
+            return
+        waited = 0.0
+        while True:
+            wait = self._take()
+            if not wait:
+                break
+            if waited + wait > self.max_wait:
+                self._reject('no call allowed within {wait}s'.format(
+                    wait=self.max_wait))
+            time.sleep(wait)
+            waited += wait
+        with self._lock:
+            self.acquired += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += waited
+
+    def _take(self):
+        """Takes a token if one is available, returning 0, or returns the
+        seconds until one will be."""
+        with self._locked_state() as state:
+            now = time.time()
+            if self.per_day and state['used_today'] >= self.per_day:
+                self._reject('daily quota of {quota} calls used up'.format(
+                    quota=self.per_day))
+            if self.per_minute:
+                state['tokens'] = min(self.burst, state['tokens'] + (
+                    now - state['updated']) * self.per_minute / 60.0)
+                state['updated'] = now
+                if state['tokens'] < 1:
+                    return (1 - state['tokens']) * 60.0 / self.per_minute
+                state['tokens'] -= 1
+            state['used_today'] += 1
+            return 0
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected += 1
+        raise QuotaExceeded('The weather API quota was reached.',
+                            RuntimeError(reason))
+
+    @contextmanager
+    def _locked_state(self):
+        """Yields the bucket's state for update, from and back to the state
+        file if there is one."""
+        with self._lock:
+            if not self.state_path:
+                self._state = self._current(self._state)
+                yield self._state
+                return
+            with open(self.state_path, 'a+') as state_file:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read())
+                except ValueError:
+                    state = None
+                state = self._current(state)
+                yield state
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+                os.fsync(state_file.fileno())
+
+    def _current(self, state):
+        """Returns the state, started afresh if missing or from another day."""
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        if state is None or state.get('day') != today:
+            state = {'day': today, 'used_today': 0,
+                     'tokens': state['tokens'] if state else self.burst,
+                     'updated': state['updated'] if state else time.time()}
+        return state
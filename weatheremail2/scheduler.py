@@ -0,0 +1,398 @@
+"""
+.. module:: scheduler
+   :synopsis: Module containing the in-process scheduler run by the
+        scheduler command, which refreshes the forecasts and sends the
+        weather emails of each time zone at its local send times.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from threading import Event
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from weatheremail2 import app, metrics
+from .app_error import AppError
+from .forecasts import load_city_forecasts
+from .mailing import run_weather_emails
+from .models import db, City
+from .snapshots import refresh_snapshots
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+try:
+    from dateutil import tz as dateutil_tz
+except ImportError:
+    dateutil_tz = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Time zone of each state, the one most of a state's population lives in
+# for the states split between two.
+STATE_TIMEZONES = {
+    'AK': 'America/Anchorage', 'AL': 'America/Chicago',
+    'AR': 'America/Chicago', 'AZ': 'America/Phoenix',
+    'CA': 'America/Los_Angeles', 'CO': 'America/Denver',
+    'CT': 'America/New_York', 'DC': 'America/New_York',
+    'DE': 'America/New_York', 'FL': 'America/New_York',
+    'GA': 'America/New_York', 'HI': 'Pacific/Honolulu',
+    'IA': 'America/Chicago', 'ID': 'America/Boise',
+    'IL': 'America/Chicago', 'IN': 'America/Indiana/Indianapolis',
+    'KS': 'America/Chicago', 'KY': 'America/New_York',
+    'LA': 'America/Chicago', 'MA': 'America/New_York',
+    'MD': 'America/New_York', 'ME': 'America/New_York',
+    'MI': 'America/Detroit', 'MN': 'America/Chicago',
+    'MO': 'America/Chicago', 'MS': 'America/Chicago',
+    'MT': 'America/Denver', 'NC': 'America/New_York',
+    'ND': 'America/Chicago', 'NE': 'America/Chicago',
+    'NH': 'America/New_York', 'NJ': 'America/New_York',
+    'NM': 'America/Denver', 'NV': 'America/Los_Angeles',
+    'NY': 'America/New_York', 'OH': 'America/New_York',
+    'OK': 'America/Chicago', 'OR': 'America/Los_Angeles',
+    'PA': 'America/New_York', 'RI': 'America/New_York',
+    'SC': 'America/New_York', 'SD': 'America/Chicago',
+    'TN': 'America/Chicago', 'TX': 'America/Chicago',
+    'UT': 'America/Denver', 'VA': 'America/New_York',
+    'VT': 'America/New_York', 'WA': 'America/Los_Angeles',
+    'WI': 'America/Chicago', 'WV': 'America/New_York',
+    'WY': 'America/Denver'}
+
+REFRESH = 'refresh'
+SEND = 'send'
+
+
+class ScheduledJob(object):
+    """Refresh or send of a send window that is due.
+
+    Attributes:
+        kind (str): 'refresh' or 'send'.
+        zone (str): time zone of the window.
+        states (list): states the job covers, or None for every state.
+        run_id (str): id of the window, e.g. '2018-03-25T07:00 America/
+            Chicago', which its send is recorded under in the send ledger.
+        due (float): UTC timestamp the job was due at.
+    """
+
+    def __init__(self, kind, zone, states, run_id, due):
+        self.kind = kind
+        self.zone = zone
+        self.states = states
+        self.run_id = run_id
+        self.due = due
+
+
+class Scheduler(object):
+    """Runs the forecast refresh and the send of every send window as they
+    come due, in a process that keeps the app warm between runs.
+
+    Notes:
+        A send window is one of the local send_times in a time zone. With
+            per_timezone each time zone the cities' states are in (see
+            STATE_TIMEZONES, states missing from it go with 'timezone') has
+            windows of its own that only send its subscribers, otherwise
+            every subscriber is sent at the send times of 'timezone'.
+        refresh_lead seconds before a window the forecasts of its cities are
+            refreshed: the forecast snapshots with FORECAST_SOURCE =
+            'snapshot', the forecast cache otherwise.
+        Sends start a random 0 to 'jitter' seconds after their window, so
+            windows of several zones or schedulers do not hit the weather
+            API and SMTP server at the same second. A send is recorded in
+            the send ledger under the window's run id and run with resume,
+            so a scheduler restarted during a window only emails the
+            subscribers the window has not reached yet. Sends missed by
+            more than misfire_grace seconds are skipped.
+        Jobs run one at a time, so runs never overlap: a job that comes due
+            while another runs starts late by the lateness recorded in its
+            stats. While the scheduler runs it holds a lock on lock_file,
+            which keeps a second scheduler from starting on the host.
+        Any error raised by a job, or while looking for due jobs, is logged
+            and counted in failures, and the scheduler keeps polling.
+        The database pool, weather API session and forecast cache are kept
+            between runs instead of being set up by every run.
+
+    Attributes:
+        send_times (list): datetime.time local send times.
+        timezone (str): time zone of the send times when per_timezone is
+            off, and of the states missing from STATE_TIMEZONES.
+        per_timezone (bool): whether each time zone has its own windows.
+        jitter (float): max seconds a send starts after its window.
+        refresh_lead (float): seconds before a window its forecasts are
+            refreshed.
+        misfire_grace (float): seconds after its window a send is skipped.
+        poll_interval (float): seconds between looks for due jobs.
+        lock_file (str): file locked while the scheduler runs, or None.
+        history (deque): records of the latest jobs, newest last.
+        runs (int): number of jobs run.
+        failures (int): number of jobs and polls that raised an error.
+        skipped (int): number of sends missed by more than misfire_grace.
+    """
+
+    def __init__(self, send_times, timezone='UTC', per_timezone=True,
+                 jitter=0, refresh_lead=900, misfire_grace=3600,
+                 poll_interval=30, lock_file=None, history=100):
+        self.send_times = [_parse_time(send_time) for send_time in send_times]
+        self.timezone = timezone
+        self.per_timezone = per_timezone
+        self.jitter = jitter
+        self.refresh_lead = refresh_lead
+        self.misfire_grace = misfire_grace
+        self.poll_interval = poll_interval
+        self.lock_file = lock_file
+        self.history = deque(maxlen=history)
+        self.runs = self.failures = self.skipped = 0
+        self.started = time.time()
+        self._zone(timezone)
+        if per_timezone and ZoneInfo is None and dateutil_tz is None:
+            raise AppError('Time zones per state require Python 3.9 or '
+                           'python-dateutil.', ImportError('zoneinfo'))
+        self._done = {}
+        self._jitters = {}
+        self._stop = Event()
+        self._snapshot = metrics.snapshot()
+
+    @classmethod
+    def from_config(cls, app):
+        """Factory method returning the Scheduler set up from the SCHEDULE_*
+        values of the app config.
+
+        Raises:
+            AppError: If a send time or time zone is invalid, or time zones
+                other than UTC can not be loaded.
+        """
+        return cls(app.config['SCHEDULE_SEND_TIMES'],
+                   timezone=app.config['SCHEDULE_TIMEZONE'],
+                   per_timezone=app.config['SCHEDULE_PER_TIMEZONE'],
+                   jitter=app.config['SCHEDULE_JITTER'],
+                   refresh_lead=app.config['SCHEDULE_REFRESH_LEAD'],
+                   misfire_grace=app.config['SCHEDULE_MISFIRE_GRACE'],
+                   poll_interval=app.config['SCHEDULE_POLL_INTERVAL'],
+                   lock_file=app.config['SCHEDULE_LOCK_FILE'],
+                   history=app.config['SCHEDULE_HISTORY'])
+
+    def zones(self):
+        """Returns the states of each time zone with windows of its own.
+
+        Returns:
+            dict mapping time zone names to sorted lists of states, or to
+            None for every state when per_timezone is off
+        """
+        if not self.per_timezone:
+            return {self.timezone: None}
+        zones = {}
+        for state, in db.session.query(City.state).distinct():
+            zone = STATE_TIMEZONES.get(state, self.timezone)
+            zones.setdefault(zone, []).append(state)
+        return {zone: sorted(states) for zone, states in zones.items()}
+
+    def due_jobs(self, now):
+        """Returns the jobs due at a UTC timestamp that did not run yet,
+        oldest first.
+
+        Notes:
+            Each job is returned once. Sends missed by more than
+                misfire_grace seconds while the scheduler ran are counted as
+                skipped; windows over before it started are ignored.
+
+        Args:
+            now (float): UTC timestamp.
+
+        Returns:
+            list of ScheduledJob instances
+        """
+        jobs = []
+        for zone, states in self.zones().items():
+            tzinfo = self._zone(zone)
+            today = datetime.fromtimestamp(now, tzinfo).date()
+            for days in (-1, 0, 1):
+                day = today + timedelta(days=days)
+                for send_time in self.send_times:
+                    window = datetime.combine(day, send_time).replace(
+                        tzinfo=tzinfo)
+                    jobs.extend(self._due(zone, states, window, now))
+        for key, start in list(self._done.items()):
+            if start < now - 2 * 86400:
+                del self._done[key]
+                self._jitters.pop(key[1], None)
+        return sorted(jobs, key=lambda job: job.due)
+
+    def run_job(self, job):
+        """Runs a job, recording how late it started and how long it took.
+
+        Args:
+            job (ScheduledJob): job to run.
+
+        Returns:
+            dict recording the run, with the summary of the refresh or send
+            under 'result' or the error under 'error'
+        """
+        started = time.time()
+        record = {'job': job.kind, 'run_id': job.run_id,
+                  'states': job.states,
+                  'lateness': round(max(started - job.due, 0), 3)}
+        app.logger.info('Starting scheduled %s of %s, %.1fs late', job.kind,
+                        job.run_id, record['lateness'])
+        try:
+            if job.kind == SEND:
+                record['result'] = run_weather_emails(
+                    run_id=job.run_id, resume=True, states=job.states)
+            else:
+                record['result'] = self._refresh(job.states)
+        except (SQLAlchemyError, AppError) as job_exc:
+            db.session.rollback()
+            self.failures += 1
+            record['error'] = str(job_exc)
+            app.logger.error('Scheduled %s of %s failed: %s', job.kind,
+                             job.run_id, job_exc)
+        except Exception as job_exc:
+            db.session.rollback()
+            self.failures += 1
+            record['error'] = str(job_exc)
+            app.logger.exception('Unexpected error in scheduled %s of %s: %s',
+                                 job.kind, job.run_id, job_exc)
+        finally:
+            db.session.remove()
+        record['seconds'] = round(time.time() - started, 3)
+        self.runs += 1
+        self.history.append(record)
+        metrics.scheduled_job.observe(record['seconds'], job.kind)
+        metrics.scheduled_job_lateness.observe(record['lateness'], job.kind)
+        app.logger.info('Scheduled %s of %s finished in %.3fs', job.kind,
+                        job.run_id, record['seconds'])
+        return record
+
+    def run(self, until=None):
+        """Runs the jobs as they come due until stopped.
+
+        Args:
+            until (float): UTC timestamp to return at.
+                Defaults to None meaning run until stop() is called.
+
+        Returns:
+            dict of the scheduler's stats
+
+        Raises:
+            AppError: If another scheduler holds the lock file.
+        """
+        lock = self._lock()
+        try:
+            app.logger.info('Scheduler started, send times %s, zones %s',
+                            [send_time.strftime('%H:%M')
+                             for send_time in self.send_times],
+                            self.zones())
+            db.session.remove()
+            while not self._stop.is_set():
+                try:
+                    for job in self.due_jobs(time.time()):
+                        if self._stop.is_set():
+                            break
+                        self.run_job(job)
+                except Exception as poll_exc:
+                    self.failures += 1
+                    app.logger.exception('Unable to look for due jobs: %s',
+                                         poll_exc)
+                    db.session.remove()
+                if until is not None and time.time() >= until:
+                    break
+                self._stop.wait(self.poll_interval)
+        finally:
+            if lock is not None:
+                lock.close()
+        stats = self.stats()
+        app.logger.info('Scheduler stopped: %s', stats)
+        return stats
+
+    def stop(self):
+        """Makes run() return once the job running, if any, is done."""
+        self._stop.set()
+
+    def stats(self):
+        """Returns the number of jobs run, failed and skipped, the latest
+        job records and the timings of the jobs and of their stages."""
+        return {'runs': self.runs, 'failures': self.failures,
+                'skipped': self.skipped, 'history': list(self.history)[-10:],
+                'timings': metrics.summarize(metrics.since(self._snapshot))}
+
+    def _due(self, zone, states, window, now):
+        """Returns the jobs of a window that are due and did not run."""
+        start = window.timestamp()
+        run_id = '{window:%Y-%m-%dT%H:%M} {zone}'.format(window=window,
+                                                        zone=zone)
+        jitter = self._jitters.get(run_id)
+        if jitter is None:
+            jitter = self._jitters[run_id] = random.uniform(0, self.jitter)
+        jobs = []
+        for kind, due, expires in (
+                (REFRESH, start - self.refresh_lead, start),
+                (SEND, start + jitter, start + self.misfire_grace)):
+            if (kind, run_id) in self._done or due > now:
+                continue
+            self._done[(kind, run_id)] = start
+            if now > expires:
+                if kind == SEND and expires > self.started:
+                    self.skipped += 1
+                    app.logger.warning('Skipping the send of %s, missed by '
+                                       '%.0fs', run_id, now - start)
+                continue
+            jobs.append(ScheduledJob(kind, zone, states, run_id, due))
+        return jobs
+
+    def _refresh(self, states):
+        """Refreshes the forecasts of the cities of some states."""
+        if app.config['FORECAST_SOURCE'] == 'snapshot':
+            # young enough to still be fresh when the send starts
+            max_age = max(app.config['FORECAST_SNAPSHOT_TTL'] -
+                          self.refresh_lead - self.jitter, 0)
+            return refresh_snapshots(
+                app.config['API_KEY_WUNDERGROUND'], max_age,
+                app.config['FORECAST_SNAPSHOT_BATCH_SIZE'],
+                app.config['FORECAST_PREFETCH_CONCURRENCY'], states)
+        return load_city_forecasts(states=states).summary()
+
+    def _lock(self):
+        """Locks lock_file, returning the open file holding the lock."""
+        if not self.lock_file or fcntl is None:
+            return None
+        lock = open(self.lock_file, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as lock_exc:
+            lock.close()
+            raise AppError('Another scheduler is running.', lock_exc)
+        return lock
+
+    @staticmethod
+    def _zone(name):
+        """Returns the tzinfo of a time zone name, from zoneinfo or, before
+        Python 3.9, python-dateutil."""
+        if name == 'UTC':
+            return timezone.utc
+        if ZoneInfo is not None:
+            try:
+                return ZoneInfo(name)
+            except (KeyError, ValueError) as zone_exc:
+                raise AppError('Unknown time zone.', zone_exc)
+        if dateutil_tz is None:
+            raise AppError('Time zones other than UTC require Python 3.9 or '
+                           'python-dateutil.', ValueError(name))
+        zone = dateutil_tz.gettz(name)
+        if zone is None:
+            raise AppError('Unknown time zone.', ValueError(name))
+        return zone
+
+
+def _parse_time(send_time):
+    """Returns the datetime.time of an 'HH:MM' send time."""
+    try:
+        return datetime.strptime(send_time, '%H:%M').time()
+    except (TypeError, ValueError) as time_exc:
+        raise AppError('Send times must be given as HH:MM.', time_exc)
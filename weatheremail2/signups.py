@@ -0,0 +1,445 @@
+"""
+.. module:: signups
+   :synopsis: Module containing the write path of new subscribers.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import atexit
+import glob
+import json
+import os
+import time
+from threading import Condition, Lock, Thread
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DataError, IntegrityError, SQLAlchemyError
+
+from .app_error import AppError
+from .metrics import metrics
+from .models import db, Person
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def insert_person(email, city_id):
+    """Subscribes an email address to a city in a single statement.
+
+    Notes:
+        Duplicates are detected by the unique constraint on Person.email
+            rather than a query beforehand, so two concurrent signups with
+            the same email can not both get past the check.
+        On PostgreSQL this is one INSERT ... ON CONFLICT (email) DO NOTHING
+            RETURNING id. Other databases get a plain INSERT, and an
+            IntegrityError is taken as a duplicate only if a person with
+            the email exists once it is rolled back, rather than by
+            parsing the driver's error message.
+        The city is expected to be validated by the caller, e.g. against
+            the cached city drop-down.
+
+    Args:
+        email (str): email address of the new subscriber.
+        city_id (int): id of the City subscribed to.
+
+    Returns:
+        int id of the new Person or None if the email is already subscribed
+
+    Raises:
+        SQLAlchemyError: If the database rejects the insert for another
+            reason.
+    """
+    table = Person.__table__
+    if db.engine.dialect.name == 'postgresql':
+        statement = pg_insert(table).values(email=email, city_id=city_id). \
+            on_conflict_do_nothing(index_elements=[table.c.email]). \
+            returning(table.c.id)
+        person_id = db.session.execute(statement).scalar()
+        db.session.commit()
+        return person_id
+    try:
+        result = db.session.execute(table.insert().values(email=email,
+                                                          city_id=city_id))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if Person.query.filter_by(email=email).first() is None:
+            raise
+        return None
+    return result.inserted_primary_key[0]
+
+
+def insert_persons(rows):
+    """Inserts many subscribers in one multi-row INSERT, skipping emails
+    that are already subscribed.
+
+    Args:
+        rows (list): dicts with the email and city_id of each subscriber,
+            without duplicate emails.
+
+    Returns:
+        int number of persons inserted
+
+    Raises:
+        SQLAlchemyError: If the database rejects the insert.
+    """
+    table = Person.__table__
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = pg_insert(table).values(rows). \
+            on_conflict_do_nothing(index_elements=[table.c.email])
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE').values(rows)
+    else:
+        existing = {email for email, in db.session.query(Person.email).filter(
+            Person.email.in_([row['email'] for row in rows]))}
+        rows = [row for row in rows if row['email'] not in existing]
+        if not rows:
+            return 0
+        statement = table.insert().values(rows)
+    with db.engine.begin() as conn:
+        return conn.execute(statement).rowcount
+
+
+def subscribe(email, city_id):
+    """Subscribes an email address to a city, directly or through the
+    signup buffer depending on SIGNUP_INGEST_MODE.
+
+    Args:
+        email (str): email address of the new subscriber.
+        city_id (int): id of the City subscribed to.
+
+    Notes:
+        A buffered signup is only checked against the signups waiting in
+            the buffer, not against the database, so buffering costs no
+            database round trip. An email that is already subscribed is
+            skipped, and counted as a duplicate, when its batch is inserted.
+
+    Returns:
+        bool False if the email is known to be subscribed already
+
+    Raises:
+        OSError: If a buffered signup could not be journaled.
+    """
+    if signup_buffer.enabled:
+        return signup_buffer.add(email, city_id)
+    return insert_person(email, city_id) is not None
+
+
+class SignupBuffer(object):
+    """Buffers signups and inserts them in batches from a background thread.
+
+    Notes:
+        Enabled with SIGNUP_INGEST_MODE = 'buffered'. add() returns as soon
+            as a signup is buffered, and the flusher thread inserts the
+            buffer every SIGNUP_FLUSH_INTERVAL_MS milliseconds, or sooner
+            once SIGNUP_FLUSH_ROWS signups are waiting, so signups share
+            one commit instead of paying for one each.
+        With SIGNUP_JOURNAL_DIR set, add() first appends the signup to a
+            journal file of this process and fsyncs it, so a signup is
+            durable before the user is told it succeeded. A journal is
+            deleted once its signups are inserted, and journals left by
+            dead processes (no longer flock'ed) are replayed by init_app().
+            Without a journal, buffered signups are lost if the process
+            dies before a flush.
+        An email already waiting in the buffer is reported as a duplicate.
+            The database is not queried, so an email that is already
+            subscribed is only skipped when the batch is inserted.
+        A batch rejected by a constraint (e.g. a city that was deleted) is
+            split until the offending signups are found. Those are logged,
+            appended to rejected.jsonl in the journal directory if any and
+            dropped, so they are not retried forever.
+        Every flush is logged and recorded in the signup_flush and
+            signup_flush_rows histograms, and stats() sums them up.
+
+    Attributes:
+        enabled (bool): whether signups are buffered.
+        flush_interval (float): seconds between flushes.
+        flush_rows (int): number of buffered signups triggering a flush.
+        journal_dir (str): directory of the journal files, or None.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.flush_interval = 0.2
+        self.flush_rows = 500
+        self.journal_dir = None
+        self._rows = []
+        self._emails = set()
+        self._journal = None
+        self._segments = []
+        self._segment_seq = 0
+        self._thread = None
+        self._wakeup = Condition()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self.reset_stats()
+        atexit.register(self.close)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Initializes the buffer from the SIGNUP_* settings of the app and
+        replays the journals of dead processes.
+
+        Args:
+            app: Flask application instance
+
+        Raises:
+            AppError: If the mode is unknown or journaling is unavailable.
+        """
+        mode = app.config['SIGNUP_INGEST_MODE']
+        if mode not in ('direct', 'buffered'):
+            raise AppError('Unknown signup ingest mode.', ValueError(mode))
+        self.close()
+        self.app = app
+        self.enabled = mode == 'buffered'
+        self.flush_interval = app.config['SIGNUP_FLUSH_INTERVAL_MS'] / 1000.0
+        self.flush_rows = app.config['SIGNUP_FLUSH_ROWS']
+        self.journal_dir = app.config['SIGNUP_JOURNAL_DIR'] \
+            if self.enabled else None
+        self.reset_stats()
+        if self.journal_dir:
+            if fcntl is None:
+                raise AppError('Journaling signups requires fcntl.',
+                               ImportError('fcntl'))
+            os.makedirs(self.journal_dir, exist_ok=True)
+            with app.app_context():
+                self.replay_journals()
+
+    def reset_stats(self):
+        """Zeroes the flush counters."""
+        with self._lock:
+            self.flushes = 0
+            self.flushed = 0
+            self.duplicates = 0
+            self.rejected = 0
+            self.max_batch = 0
+            self.total_latency = 0.0
+            self.max_latency = 0.0
+
+    def stats(self):
+        """Returns the flush counters, average batch size and latency."""
+        with self._lock:
+            return {'pending': len(self._rows), 'flushes': self.flushes,
+                    'flushed': self.flushed, 'duplicates': self.duplicates,
+                    'rejected': self.rejected,
+                    'avg_batch': (self.flushed + self.duplicates +
+                                  self.rejected) /
+                                 self.flushes if self.flushes else 0.0,
+                    'max_batch': self.max_batch,
+                    'avg_latency': self.total_latency / self.flushes
+                                   if self.flushes else 0.0,
+                    'max_latency': self.max_latency}
+
+    def add(self, email, city_id):
+        """Buffers a signup, journaling it first if a journal is configured.
+
+        Args:
+            email (str): email address of the new subscriber.
+            city_id (int): id of the City subscribed to.
+
+        Returns:
+            bool False if the email is already waiting in the buffer
+
+        Raises:
+            OSError: If the signup could not be journaled.
+        """
+        row = {'email': email, 'city_id': city_id}
+        with self._lock:
+            if email in self._emails:
+                return False
+            if self.journal_dir:
+                self._append_journal(row)
+            self._rows.append(row)
+            self._emails.add(email)
+            full = len(self._rows) >= self.flush_rows
+        self._start()
+        if full:
+            with self._wakeup:
+                self._wakeup.notify()
+        return True
+
+    def flush(self):
+        """Inserts the buffered signups in one multi-row INSERT.
+
+        Raises:
+            SQLAlchemyError: If the database rejects the batch, which is
+                kept for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                segments = self._rotate_journal()
+            if not rows:
+                self._delete_segments(segments)
+                return
+            started = time.perf_counter()
+            try:
+                with self.app.app_context():
+                    inserted, rejected = self._insert(rows)
+            except SQLAlchemyError:
+                with self._lock:
+                    self._rows = rows + self._rows
+                    self._segments = segments + self._segments
+                raise
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._emails.difference_update(row['email'] for row in rows)
+            self._delete_segments(segments)
+            self._record_flush(len(rows), inserted, rejected, elapsed)
+
+    def close(self):
+        """Stops the flusher thread after a last flush.
+
+        Notes:
+            Signups the last flush fails to insert are logged and left in
+                their journal, if any, for the next start to replay.
+        """
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            with self._wakeup:
+                self._wakeup.notify()
+            thread.join()
+        if self.app is not None and (self._rows or self._segments or
+                                     self._journal):
+            try:
+                self.flush()
+            except SQLAlchemyError as flush_exc:
+                self.app.logger.error('Unable to insert %s buffered signups '
+                                      'on close: %s', len(self._rows),
+                                      flush_exc)
+
+    def replay_journals(self):
+        """Inserts the signups of journals no live process holds a lock on.
+
+        Returns:
+            int number of journaled signups replayed
+        """
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.journal_dir,
+                                                  '*.journal'))):
+            with open(path, 'a+') as journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                journal.seek(0)
+                rows = {}
+                for line in journal:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        # torn write of a signup that was never confirmed
+                        continue
+                    rows.setdefault(row['email'], row)
+                if rows:
+                    inserted, _ = self._insert(list(rows.values()))
+                    self.app.logger.info(
+                        'Replayed %s journaled signups from %s (%s inserted)',
+                        len(rows), path, inserted)
+                    replayed += len(rows)
+                os.remove(path)
+        return replayed
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        thread = self._thread
+        while self._thread is thread:
+            with self._wakeup:
+                self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except SQLAlchemyError as flush_exc:
+                self.app.logger.error('Unable to insert buffered signups, '
+                                      'retrying: %s', flush_exc)
+            except Exception as flush_exc:
+                self.app.logger.exception('Unexpected error flushing buffered '
+                                          'signups: %s', flush_exc)
+
+    def _insert(self, rows):
+        """Inserts a batch of signups, dropping those the database rejects.
+
+        Returns:
+            tuple of the number of persons inserted and signups rejected
+
+        Raises:
+            SQLAlchemyError: If the database fails for another reason.
+        """
+        try:
+            return insert_persons(rows), 0
+        except (IntegrityError, DataError) as insert_exc:
+            if len(rows) == 1:
+                self._reject(rows[0], insert_exc)
+                return 0, 1
+        middle = len(rows) // 2
+        first_inserted, first_rejected = self._insert(rows[:middle])
+        inserted, rejected = self._insert(rows[middle:])
+        return first_inserted + inserted, first_rejected + rejected
+
+    def _reject(self, row, reason):
+        self.app.logger.error('Dropping signup %s rejected by the database: '
+                              '%s', row, reason)
+        if self.journal_dir:
+            try:
+                with open(os.path.join(self.journal_dir, 'rejected.jsonl'),
+                          'a') as rejected:
+                    rejected.write(json.dumps(row) + '\n')
+            except OSError as write_exc:
+                self.app.logger.error('Unable to save rejected signup %s: %s',
+                                      row, write_exc)
+
+    def _append_journal(self, row):
+        if self._journal is None:
+            self._segment_seq += 1
+            path = os.path.join(self.journal_dir, '{pid}-{seq}.journal'.format(
+                pid=os.getpid(), seq=self._segment_seq))
+            self._journal = open(path, 'a')
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._journal.write(json.dumps(row) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _rotate_journal(self):
+        """Returns the journals holding the rows being flushed, so new
+        signups go to a new one."""
+        segments, self._segments = self._segments, []
+        if self._journal is not None:
+            segments.append(self._journal)
+            self._journal = None
+        return segments
+
+    def _delete_segments(self, segments):
+        for journal in segments:
+            try:
+                os.remove(journal.name)
+            except OSError as remove_exc:
+                self.app.logger.error('Unable to delete the flushed journal '
+                                      '%s: %s', journal.name, remove_exc)
+            journal.close()
+
+    def _record_flush(self, rows, inserted, rejected, elapsed):
+        with self._lock:
+            self.flushes += 1
+            self.flushed += inserted
+            self.duplicates += rows - inserted - rejected
+            self.rejected += rejected
+            self.max_batch = max(self.max_batch, rows)
+            self.total_latency += elapsed
+            self.max_latency = max(self.max_latency, elapsed)
+        metrics.signup_flush.observe(elapsed)
+        metrics.signup_flush_rows.observe(rows)
+        self.app.logger.info('Inserted %s of %s buffered signups in %.3fs',
+                             inserted, rows, elapsed)
+
+
+signup_buffer = SignupBuffer()
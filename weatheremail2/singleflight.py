@@ -0,0 +1,210 @@
+"""
+.. module:: singleflight
+   :synopsis: Module containing the single-flight guards that let one caller
+        fetch a key while concurrent callers of the same key wait for its
+        result, within a process or across processes.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import hashlib
+import os
+import time
+from contextlib import ExitStack
+from threading import Event, Lock
+
+from .app_error import AppError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class _Call(object):
+    """Fetch of a key in flight, which waiting callers share."""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class ThreadSingleFlight(object):
+    """Coalesces concurrent fetches of the same keys by threads of a process.
+
+    Notes:
+        The first caller of a key fetches it. Callers of a key already being
+            fetched wait for that fetch and get its value, or its exception
+            raised again, instead of fetching the key themselves.
+
+    Attributes:
+        coalesced (int): number of keys a caller waited for instead of
+            fetching them.
+        wait_time (float): seconds callers spent waiting, summed.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self.reset_stats()
+
+    def do(self, key, fetch, recheck=None):
+        """Returns the value of a single key, fetching it unless it is
+        already being fetched.
+
+        Args:
+            key (str): key to fetch.
+            fetch: function without arguments returning the value of key.
+            recheck: see do_many().
+                Defaults to None.
+
+        Returns:
+            tuple of the value and True if it was fetched by someone else
+        """
+        values, coalesced = self.do_many([key], lambda keys: {key: fetch()},
+                                         recheck)
+        return values[key], key in coalesced
+
+    def do_many(self, keys, fetch, recheck=None):
+        """Returns the values of many keys, fetching the ones not being
+        fetched already in one call and waiting for the others.
+
+        Args:
+            keys (list): keys to fetch.
+            fetch: function taking a list of keys and returning a dict of
+                their values.
+            recheck: function taking a list of keys and returning a dict of
+                the values some other process stored while this caller
+                waited for its lock. Only used by the process wide guards.
+                Defaults to None.
+
+        Returns:
+            tuple of the dict of values and the set of keys fetched by
+            someone else
+
+        Raises:
+            Exception: Whatever fetch() raised, in every caller waiting for
+                the failed keys.
+        """
+        owned, waiting = {}, {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                call = self._calls.get(key)
+                if call is None:
+                    owned[key] = self._calls[key] = _Call()
+                else:
+                    waiting[key] = call
+        values, coalesced = {}, set()
+        if owned:
+            try:
+                fetched, rechecked = self._fetch(list(owned), fetch, recheck)
+                coalesced.update(rechecked)
+                for key, call in owned.items():
+                    call.value = fetched.get(key)
+                values.update(fetched)
+            except Exception as fetch_exc:
+                for call in owned.values():
+                    call.error = fetch_exc
+                raise
+            finally:
+                with self._lock:
+                    for key, call in owned.items():
+                        self._calls.pop(key, None)
+                        call.done.set()
+        started = time.perf_counter()
+        for key, call in waiting.items():
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            values[key] = call.value
+            coalesced.add(key)
+        with self._lock:
+            self.coalesced += len(coalesced)
+            if waiting:
+                self.wait_time += time.perf_counter() - started
+        return values, coalesced
+
+    def reset_stats(self):
+        """Zeroes the coalesced count and wait time."""
+        with self._lock:
+            self.coalesced = 0
+            self.wait_time = 0.0
+
+    def stats(self):
+        """Returns the coalesced count and wait time as a dict."""
+        with self._lock:
+            return {'coalesced': self.coalesced,
+                    'wait_time': round(self.wait_time, 6)}
+
+    def _fetch(self, keys, fetch, recheck):
+        """Fetches the keys this caller owns, returning their values and the
+        keys some other process fetched meanwhile."""
+        return fetch(keys), set()
+
+
+class FileSingleFlight(ThreadSingleFlight):
+    """Coalesces concurrent fetches of the same keys across processes.
+
+    Notes:
+        Threads of a process are coalesced as in ThreadSingleFlight. The
+            caller fetching keys then takes an exclusive flock on the lock
+            files of their stripes in lock_dir, shared by every process on
+            the host, and asks recheck() whether another process stored the
+            keys while it waited for the locks before fetching them.
+        Keys are hashed into a fixed number of stripes, so a batch of any
+            size holds at most that many file descriptors, at the cost of
+            unrelated keys of a stripe waiting for each other.
+        Lock files are kept, since deleting one while another process waits
+            on it would let a third process lock a new file of the same
+            stripe.
+
+    Attributes:
+        lock_dir (str): directory of the lock files.
+        stripes (int): number of lock files keys are spread over.
+    """
+
+    def __init__(self, lock_dir, stripes=64):
+        if fcntl is None:
+            raise AppError('The file single-flight backend requires fcntl.',
+                           ImportError('fcntl'))
+        ThreadSingleFlight.__init__(self)
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def _fetch(self, keys, fetch, recheck):
+        with ExitStack() as locks:
+            # locked in a fixed order so two processes can not deadlock
+            for stripe in sorted({self._stripe(key) for key in keys}):
+                lock_file = locks.enter_context(open(os.path.join(
+                    self.lock_dir, '{0}.lock'.format(stripe)), 'a'))
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            values = recheck(keys) if recheck is not None else {}
+            missing = [key for key in keys if key not in values]
+            if missing:
+                values.update(fetch(missing))
+            return values, set(values) - set(missing)
+
+    def _stripe(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return int(digest, 16) % self.stripes
+
+
+def create_single_flight(app):
+    """Returns the single-flight guard selected by the FORECAST_SINGLE_FLIGHT
+    setting of the app, 'thread' or 'file'.
+
+    Args:
+        app: Flask application instance
+
+    Raises:
+        AppError: If the backend is unknown or unavailable.
+    """
+    backend = app.config['FORECAST_SINGLE_FLIGHT']
+    if backend == 'thread':
+        return ThreadSingleFlight()
+    if backend == 'file':
+        return FileSingleFlight(app.config['FORECAST_LOCK_DIR'],
+                                app.config['FORECAST_LOCK_STRIPES'])
+    raise AppError('Unknown single-flight backend.', ValueError(backend))
@@ -0,0 +1,168 @@
+"""
+.. module:: snapshots
+   :synopsis: Module containing methods for refreshing the forecast snapshot
+        table and reading forecasts from it.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from weatheremail2 import app, forecast_cache
+from .models import db, City, ForecastSnapshot, Person
+from .ratelimit import is_quota_error
+
+
+def get_stale_cities(fetched_before, states=None):
+    """Returns the subscribed cities without a forecast snapshot fetched
+    since fetched_before, the ones with the most subscribers first.
+
+    Args:
+        fetched_before (datetime): UTC time snapshots older than are stale.
+        states (list): only consider the cities of these states.
+            Defaults to None meaning every state.
+
+    Returns:
+        list of 3 element (city_id, city, state) tuples
+    """
+    query = db.session.query(City.id, City.name, City.state). \
+        join(Person, Person.city_id == City.id). \
+        outerjoin(ForecastSnapshot, ForecastSnapshot.city_id == City.id). \
+        filter(or_(ForecastSnapshot.fetched_at.is_(None),
+                   ForecastSnapshot.fetched_at < fetched_before))
+    if states is not None:
+        query = query.filter(City.state.in_(states))
+    return query.group_by(City.id, City.name, City.state). \
+        order_by(func.count(Person.id).desc(), City.id).all()
+
+
+def get_city_snapshots(shard_index=0, shard_count=1, states=None):
+    """Returns the forecast snapshot of every city at least one Person of a
+    shard signed up for, in one query.
+
+    Args:
+        shard_index (int): only consider subscribers of this shard.
+            Defaults to 0.
+        shard_count (int): number of shards subscribers are split into.
+            Defaults to 1.
+        states (list): only consider the cities of these states.
+            Defaults to None meaning every state.
+
+    Returns:
+        list of 5 element (city, state, temperature, conditions, fetched_at)
+        tuples, the last three None for cities without a snapshot
+    """
+    query = db.session.query(City.name, City.state,
+                             ForecastSnapshot.temperature,
+                             ForecastSnapshot.conditions,
+                             ForecastSnapshot.fetched_at). \
+        join(Person, Person.city_id == City.id). \
+        outerjoin(ForecastSnapshot, ForecastSnapshot.city_id == City.id)
+    if shard_count > 1:
+        query = query.filter(Person.in_shard(shard_index, shard_count))
+    if states is not None:
+        query = query.filter(City.state.in_(states))
+    return query.group_by(City.id, City.name, City.state,
+                          ForecastSnapshot.temperature,
+                          ForecastSnapshot.conditions,
+                          ForecastSnapshot.fetched_at).all()
+
+
+def save_snapshots(rows):
+    """Inserts or replaces the forecast snapshots of cities in one statement.
+
+    Args:
+        rows (list): dicts with the city_id, temperature, conditions and
+            fetched_at of each snapshot, one per city.
+
+    Raises:
+        SQLAlchemyError: If the database rejects the rows.
+    """
+    table = ForecastSnapshot.__table__
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = pg_insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.city_id],
+            set_={column: statement.excluded[column] for column in
+                  ('temperature', 'conditions', 'fetched_at')})
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR REPLACE').values(rows)
+    else:
+        statement = None
+    with db.engine.begin() as conn:
+        if statement is None:
+            conn.execute(table.delete().where(table.c.city_id.in_(
+                [row['city_id'] for row in rows])))
+            statement = table.insert().values(rows)
+        conn.execute(statement)
+
+
+def refresh_snapshots(api_key, max_age, batch_size=500, concurrency=10,
+                      states=None):
+    """Fetches the forecasts of the cities whose snapshot is missing or
+    older than max_age seconds and saves them.
+
+    Notes:
+        Stale cities are fetched batch_size at a time, the most subscribed
+            first, each batch from the weather provider with up to
+            'concurrency' requests in flight, and saved as soon as it is
+            fetched, so an interrupted refresh keeps the batches it did.
+        Cities that fail keep their old snapshot. Once the weather API
+            quota is used up the remaining cities are left for the next
+            refresh.
+
+    Args:
+        api_key (str): weather API key.
+        max_age (int): seconds after which a snapshot is refreshed.
+        batch_size (int): number of cities fetched and saved at a time.
+            Defaults to 500.
+        concurrency (int): max number of requests in flight.
+            Defaults to 10.
+        states (list): only refresh the cities of these states.
+            Defaults to None meaning every state.
+
+    Returns:
+        dict with the number of stale, refreshed and failed cities, the
+        ones left for lack of quota and the seconds it took
+
+    Raises:
+        SQLAlchemyError: If database data is unavailable.
+    """
+    started = time.perf_counter()
+    stale = get_stale_cities(datetime.utcnow() - timedelta(seconds=max_age),
+                             states)
+    refreshed = failed = 0
+    remaining = len(stale)
+    for start in range(0, len(stale), batch_size):
+        batch = stale[start:start + batch_size]
+        forecasts, errors = forecast_cache.provider.fetch_many(
+            api_key, [(city, state) for _, city, state in batch], concurrency)
+        fetched_at = datetime.utcnow()
+        rows = []
+        for city_id, city, state in batch:
+            forecast = forecasts.get((city, state))
+            if forecast is not None:
+                rows.append({'city_id': city_id,
+                             'temperature': forecast.temperature,
+                             'conditions': forecast.conditions,
+                             'fetched_at': fetched_at})
+        if rows:
+            save_snapshots(rows)
+        refreshed += len(rows)
+        failed += len(errors)
+        remaining -= len(batch)
+        for (city, state), error in list(errors.items())[:10]:
+            app.logger.warning('Unable to refresh the forecast of %s, %s: %s',
+                               city, state, error)
+        if any(is_quota_error(error) for error in errors.values()):
+            break
+    summary = {'stale': len(stale), 'refreshed': refreshed, 'failed': failed,
+               'remaining': remaining,
+               'elapsed': round(time.perf_counter() - started, 3)}
+    app.logger.info('Refreshed forecast snapshots: %s', summary)
+    return summary
@@ -65,7 +65,8 @@ def get_city_data(loadfile='top_100_city_state_sorted.txt'):
     """Returns city,state data from text file in data directory.
 
     Args:
-        loadfile (str): Filename containing city, state data.
+        loadfile (str): Filename containing city, state data, either in the
+            data directory or an absolute path.
 
     Returns:
         Generator of list objects
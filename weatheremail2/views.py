@@ -5,17 +5,26 @@
 
 """
 
-from flask import request, redirect, render_template, url_for, flash, session
+from collections import namedtuple
+
+from flask import (request, redirect, render_template, url_for, flash, session,
+                   abort, Response)
+from markupsafe import Markup, escape
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import BadRequest
 
-from weatheremail2 import app, cache, recaptcha
+from weatheremail2 import app, cache, recaptcha, metrics
 from .app_error import AppError
 from .forms import ContactForm
-from .models import db, Person, City
+from .loaders import cities_generation
+from .models import db, City
+from .page_cache import cached_page_response
+from .signups import subscribe
 from .utils import encode_to_json_for_session
 
+CityChoices = namedtuple('CityChoices', ['cities', 'by_id', 'options_html'])
+
 
 @app.route('/', methods=['GET', 'POST'])
 def signup():
@@ -26,6 +35,9 @@ def signup():
             Returns page with form allowing user to enter email and
             select from drop down list a city from which to receive
             weather status updates.
+            Unless there are flashed messages to show, the page is served
+            from the page cache with the session's CSRF token injected and
+            ETag/Last-Modified validators for conditional GETs.
         POST request:
             Communicates errors via flash messages.
             For a form submission to be successful, the following must be
@@ -33,14 +45,14 @@ def signup():
                 1) email element is not empty
                 2) the Google Recaptcha was satisfied
                 3) form is validated
-                4) the email is not a duplicate of a previous submission
+                4) the city id is one of the cached drop-down cities so we
+                    can confirm it exists on our side and is not malicious
+                    input
+                5) the email is not a duplicate of a previous submission
             If these items are satisfied, then:
-                1) the city id is used to reify a City model from the
-                    database so we can confirm it exists on our side and is
-                    not malicious input
-                2) a Person is created using the email and city_id
-                    and persisted to the database
-                3) the city/state/email is put in the users session and
+                1) a Person is inserted in a single statement that leaves
+                    duplicate detection to the unique constraint on email
+                2) the city/state/email is put in the users session and
                     via a Post/Redirect/Get, the user is presented with
                     a success page
 
@@ -49,6 +61,9 @@ def signup():
     """
     form = ContactForm()
     try:
+        if request.method == 'GET' and not session.get('_flashes'):
+            return cached_page_response(cities_cache_key('signup_page'),
+                                        lambda: render_signup_page(form))
         if request.method == 'POST':
             if not (form.email.data and recaptcha.verify()):
                 flash(
@@ -60,29 +75,36 @@ def signup():
 
                 if form.validate_on_submit():
                     email = form.email.data
-                    person_exists = Person.query.filter_by(email=email).first()
+                    selected_city = get_all_cities().by_id.get(
+                        request.form.get('location', type=int))
 
-                    if person_exists:
+                    subscribed = None
+                    if selected_city is not None:
+                        try:
+                            subscribed = subscribe(email, selected_city[0])
+                        except OSError as journal_exc:
+                            app.logger.error('Unable to journal the signup '
+                                             'of %s: %s', email, journal_exc)
+
+                    if selected_city is None:
+                        flash(
+                            "Please select a city from the list!",
+                            category='error')
+                    elif subscribed is None:
+                        flash(
+                            "We could not save your signup - please try "
+                            "again!",
+                            category='error')
+                    elif not subscribed:
                         flash(
                             "We have your email - please check your inbox or "
                             "provide another address!",
                             category='info')
                     else:
-
-                        city = request.form.get('location')
-
-                        selected_city = City.query.filter_by(
-                            id=int(city)).first()
-
-                        person = Person(email=email, city_id=selected_city.id)
-                        db.session.add(person)
-                        db.session.commit()
-                        session['city'] = encode_to_json_for_session(
-                            selected_city.name)
-                        session['state'] = encode_to_json_for_session(
-                            selected_city.state)
-                        session['email'] = encode_to_json_for_session(
-                            person.email)
+                        _, city, state = selected_city
+                        session['city'] = encode_to_json_for_session(city)
+                        session['state'] = encode_to_json_for_session(state)
+                        session['email'] = encode_to_json_for_session(email)
 
                         flash("thank you for signing up for weather alerts",
                               category='success')
@@ -94,16 +116,41 @@ def signup():
                         "try again!",
                         category='error')
 
-        cached_cities = get_all_cities()
-        return render_template('signup.html', title='weather email signup',
-                               form=form, cities=cached_cities)
+        return render_signup_page(form)
     except (SQLAlchemyError, AppError, BadRequest) as gen_exc:
         app.logger.error(
             'We got the following exception during in email signup page: %s',
             gen_exc)
 
 
-@cache.cached(timeout=600, key_prefix='all_cities')
+def render_signup_page(form):
+    """Renders the signup page with the cached city drop-down."""
+    return render_template('signup.html', title='weather email signup',
+                           form=form,
+                           city_options=get_all_cities().options_html)
+
+
+def cities_cache_key(name):
+    """Returns the cache key of an entry built from the cities, versioned
+    with the cities generation that load_cities() bumps.
+
+    Notes:
+        The generation is read from the cache rather than the database, so
+            serving the page from the cache does not query the database.
+            Web servers see a load_data run at once when CACHE_TYPE is a
+            backend shared with the command, e.g. redis.
+
+    Args:
+        name (str): name of the cache entry.
+
+    Returns:
+        str
+    """
+    return '{name}/{generation}'.format(name=name,
+                                        generation=cities_generation())
+
+
+@cache.cached(timeout=600, key_prefix=lambda: cities_cache_key('all_cities'))
 def get_all_cities():
     """Method returns cities for drop-down select on signup page.
 
@@ -112,13 +159,25 @@ def get_all_cities():
             data access for every page load.
         City data returned by method is great candidate for caching since it
             will rarely become change.
+        Only plain (id, name, state) tuples are cached, never ORM instances,
+            along with the <option> elements of the drop-down rendered once
+            so page loads do no per city work. The entry is keyed by
+            cities_cache_key(), so it is replaced once cities are loaded.
+        Signups validate the submitted city id against by_id instead of
+            querying the database.
+
+    Returns:
+        CityChoices of the city tuples, the tuples keyed by id and the
+            escaped <option> markup
 
     Raises:
          AppError: If no city results returned from database.
     """
     try:
-        cities = City.query.order_by('name').all()
-        return cities
+        cities = tuple(tuple(row) for row in db.session.query(
+            City.id, City.name, City.state).order_by(City.name))
+        return CityChoices(cities, {city[0]: city for city in cities},
+                           render_city_options(cities))
     except NoResultFound as nrf_exc:
         raise AppError(
             'No city data was returned from the database for which to '
@@ -126,6 +185,18 @@ def get_all_cities():
             nrf_exc)
 
 
+def render_city_options(cities):
+    """Returns the <option> elements of the city drop-down as Markup.
+
+    Args:
+        cities: iterable of (id, name, state) tuples.
+    """
+    return Markup('\n'.join(
+        '<option value="{id}">{name}, {state}</option>'.format(
+            id=city_id, name=escape(name), state=escape(state))
+        for city_id, name, state in cities))
+
+
 @app.route('/success', methods=['GET'])
 def success():
     """Route for confirmation page.
@@ -154,6 +225,21 @@ def success():
         return render_template('error_bookmarked_url.html')
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Route exposing the mailing run stage histograms to Prometheus.
+
+    Notes:
+        Includes the latest run of every shard saved to METRICS_RUN_DIR as
+            well as anything timed by this process.
+        Returns a 404 when METRICS_ENABLED is False.
+    """
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render_prometheus(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.errorhandler(404)
 def page_not_found(err_404):
     """Error handler for HTTP Status code 404 errors"""
@@ -0,0 +1,205 @@
+"""
+.. module:: webclient
+   :synopsis: Module containing the shared, connection pooled HTTP client
+        used to access the weather API.
+.. moduleauthor:: John Pappas <jstevenpappas at gmail.com>
+
+"""
+
+import logging
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (ConnectionError, HTTPError,
+                                 RequestException, Timeout)
+
+from .ratelimit import TokenBucket
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def is_transport_error(exc):
+    """Returns whether an exception, or one it wraps, is a failure to reach
+    the weather API: a connection error, a timeout or a 5xx response, as
+    opposed to e.g. an unknown city or an unparsable response."""
+    while exc is not None:
+        if isinstance(exc, HTTPError):
+            return exc.response is None or exc.response.status_code >= 500
+        if isinstance(exc, RequestException):
+            return True
+        exc = getattr(exc, 'original_exception', None)
+    return False
+
+
+class HttpClient(object):
+    """Wraps a requests.Session shared by every weather API request.
+
+    Notes:
+        The session keeps connections to the API host alive in a pool of
+            WEATHER_API_POOL_SIZE connections so requests after the first do
+            not pay for a new TCP connect and DNS lookup.
+        Connection errors, timeouts and 429/5xx responses are retried up to
+            WEATHER_API_MAX_RETRIES times with exponential backoff.
+            Retries also draw from a budget of WEATHER_API_RETRY_BUDGET
+            shared by all requests until reset_budget() is called, so a
+            dead upstream costs a bounded number of retries per mailing run
+            rather than max retries for every city.
+        Every request, retries included, first takes a token from
+            rate_limiter, which holds requests back to
+            WEATHER_API_CALLS_PER_MINUTE and refuses them once
+            WEATHER_API_CALLS_PER_DAY have been made.
+
+    Attributes:
+        session (requests.Session): pooled session used for requests.
+        connect_timeout (float): seconds to wait for a connection.
+        read_timeout (float): seconds to wait for response data.
+        max_retries (int): max retries of a single request.
+        backoff_factor (float): first retry waits this many seconds, doubling
+            for each following retry.
+        retry_budget (int): retries allowed between calls to reset_budget().
+        retries_left (int): retries left in the current budget.
+        rate_limiter (TokenBucket): quota of the weather API.
+        requests (int): number of requests made, including retries.
+        retries (int): number of retries made.
+        total_latency (float): summed latency of all requests in seconds.
+        max_latency (float): latency of the slowest request in seconds.
+    """
+
+    def __init__(self, app=None):
+        self.session = None
+        self.connect_timeout = 3.05
+        self.read_timeout = 10
+        self.max_retries = 3
+        self.backoff_factor = 0.5
+        self.retry_budget = 100
+        self.retries_left = self.retry_budget
+        self.rate_limiter = TokenBucket()
+        self.logger = logging.getLogger(__name__)
+        self._lock = Lock()
+        self.reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Initializes the session from the WEATHER_API_* settings of the app.
+
+        Args:
+            app: Flask application instance
+        """
+        self.connect_timeout = app.config['WEATHER_API_CONNECT_TIMEOUT']
+        self.read_timeout = app.config['WEATHER_API_READ_TIMEOUT']
+        self.max_retries = app.config['WEATHER_API_MAX_RETRIES']
+        self.backoff_factor = app.config['WEATHER_API_BACKOFF_FACTOR']
+        self.retry_budget = app.config['WEATHER_API_RETRY_BUDGET']
+        self.rate_limiter = TokenBucket(
+            per_minute=app.config['WEATHER_API_CALLS_PER_MINUTE'],
+            per_day=app.config['WEATHER_API_CALLS_PER_DAY'],
+            burst=app.config['WEATHER_API_BURST'],
+            max_wait=app.config['WEATHER_API_MAX_RATE_WAIT'],
+            state_path=app.config['WEATHER_API_RATE_STATE_PATH'])
+        self.logger = app.logger
+        pool_size = app.config['WEATHER_API_POOL_SIZE']
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.session is not None:
+            self.session.close()
+        self.session = session
+        self.reset_budget()
+        self.reset_stats()
+
+    def reset_budget(self):
+        """Refills the retry budget, e.g. at the start of a mailing run."""
+        with self._lock:
+            self.retries_left = self.retry_budget
+
+    def reset_stats(self):
+        """Zeroes the request counters and latencies."""
+        self.rate_limiter.reset_stats()
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.total_latency = 0.0
+            self.max_latency = 0.0
+
+    def get(self, uri, label=None):
+        """Sends a GET request, retrying failures within the retry budget.
+
+        Args:
+            uri (str): URI to request.
+            label (str): description of the request used when logging its
+                latency instead of the URI, which may contain an API key.
+                Defaults to None.
+
+        Returns:
+            requests.Response
+
+        Raises:
+            RequestException: If the request failed and could not be
+                retried.
+            QuotaExceeded: If the rate limiter refused the request.
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            started = time.time()
+            try:
+                try:
+                    response = self.session.get(
+                        uri, timeout=(self.connect_timeout, self.read_timeout))
+                finally:
+                    self._record_latency(label, time.time() - started)
+                response.raise_for_status()
+                return response
+            except (ConnectionError, Timeout, HTTPError) as req_exc:
+                if not (self._is_retryable(req_exc) and
+                        attempt < self.max_retries and self._take_retry()):
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                self.logger.warning('Retrying request for %s in %.2fs: %s',
+                                    label, delay, req_exc)
+                attempt += 1
+                time.sleep(delay)
+
+    def stats(self):
+        """Returns the request counters, average latency and the rate
+        limiter's counters as a dict."""
+        with self._lock:
+            stats = {'requests': self.requests,
+                     'retries': self.retries,
+                     'retries_left': self.retries_left,
+                     'avg_latency': (self.total_latency / self.requests
+                                     if self.requests else 0.0),
+                     'max_latency': self.max_latency}
+        if self.rate_limiter.enabled:
+            stats['rate_limit'] = self.rate_limiter.stats()
+        return stats
+
+    @staticmethod
+    def _is_retryable(req_exc):
+        if isinstance(req_exc, HTTPError):
+            return req_exc.response is not None and \
+                req_exc.response.status_code in RETRY_STATUS_CODES
+        return True
+
+    def _take_retry(self):
+        with self._lock:
+            if self.retries_left <= 0:
+                return False
+            self.retries_left -= 1
+            self.retries += 1
+            return True
+
+    def _record_latency(self, label, latency):
+        with self._lock:
+            self.requests += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        self.logger.debug('Request for %s took %.3fs', label, latency)
+
+
+http_client = HttpClient()
@@ -7,10 +7,10 @@
 
 import json
 
-import requests
 from requests.exceptions import RequestException
 
 from .app_error import AppError
+from .webclient import http_client
 
 
 class Forecast(object):
@@ -19,6 +19,9 @@ class Forecast(object):
     Intended to be instantiated via the forecast_factory()
     classmethod herein.
 
+    Requests go through the app wide http_client so they share its pooled
+    connections, timeouts and retry budget.
+
     Attributes:
         API_BASE_URI (str): base URI to access Wunderground
         API_URI (str): preformatted for which to later populate
@@ -69,28 +72,51 @@ class Forecast(object):
             Forecast instance
 
         Raises:
-            AppError: If RequestException or wrapped KeyError occur
+            AppError: If RequestException occurs or the response has no
+                conditions (e.g. for a city the API does not know)
 
         """
         try:
             forecast = Forecast(api_key)
-            forecast_dict = forecast.__dict__
-            request_formatted_city = city.replace(" ", "_")
-            forecast_dict.update(
-                {'state': state, 'city': request_formatted_city})
-            request_uri = ('{uri}'.format(
-                uri=forecast.build_api_uri(forecast.API_URI, forecast_dict)))
-            response = requests.get(request_uri).text
-            response_json = json.loads(response)
-            forecast.temperature = response_json["current_observation"][
-                'temp_f']
-            forecast.conditions = response_json["current_observation"]['icon']
+            request_uri = forecast.request_uri(state, city)
+            response = http_client.get(
+                request_uri, label='{state}/{city}'.format(
+                    state=forecast.state, city=forecast.city)).text
+            forecast.parse_response(response)
             return forecast
-        except (RequestException, AppError) as re_exc:
+        except (RequestException, AppError, KeyError, TypeError,
+                ValueError) as re_exc:
             raise AppError(
                 'An error occurred while accessing weather forecast API data.',
                 re_exc)
 
+    def request_uri(self, state, city):
+        """Returns the API URI of the conditions of a city.
+
+        Args:
+            city (str): Name of city.
+            state (str): 2 char abbrev. for US state
+
+        Raises:
+            AppError: If the URI could not be built
+        """
+        forecast_dict = self.__dict__
+        request_formatted_city = city.replace(" ", "_")
+        forecast_dict.update(
+            {'state': state, 'city': request_formatted_city})
+        return '{uri}'.format(uri=self.build_api_uri(self.API_URI,
+                                                     forecast_dict))
+
+    def parse_response(self, response):
+        """Sets temperature and conditions from the body of an API response.
+
+        Args:
+            response (str): JSON returned by the API.
+        """
+        response_json = json.loads(response)
+        self.temperature = response_json["current_observation"]['temp_f']
+        self.conditions = response_json["current_observation"]['icon']
+
     @staticmethod
     def build_api_uri(api_uri, data):
         """Builds API URI using dict of values.